@@ -2,17 +2,20 @@ from flask import Blueprint, url_for, request, jsonify, redirect
 from nsweb.models.analyses import (Analysis, AnalysisSet, TopicAnalysis,
                                    TermAnalysis, CustomAnalysis)
 from .schemas import AnalysisSchema
+from nsweb.models.search import analysis_search
+from nsweb.models.names import name_registry
 from nsweb.api import images
 from nsweb.core import cache
-from .utils import make_cache_key
+from .utils import make_cache_key, conditional
+from .pagination import datatable_page
 import re
-from sqlalchemy import asc, desc
 
 
 bp = Blueprint('api_analyses', __name__, url_prefix='/api/analyses')
 
 
 @bp.route('/')
+@conditional
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_analyses():
     """
@@ -98,6 +101,10 @@ def find_analysis(name, type=None):
     ''' Retrieve analysis by either id (when int) or name (when string) '''
     if re.match('\d+$', name):
         return Analysis.query.get(name)
+    if type in ('term', 'topic'):
+        id = name_registry.find(name, type)
+        if id is not None:
+            return Analysis.query.get(id)
     query = Analysis.query.filter_by(name=name)
     if type is not None:
         query = query.filter_by(type=type)
@@ -156,9 +163,7 @@ def get_studies(val):
 
 @bp.route('/term_names/')
 def get_term_names():
-    # optimize this later--select only names
-    names = [f.name for f in TermAnalysis.query.all()]
-    return jsonify(data=names)
+    return jsonify(data=name_registry.names('term'))
 
 
 @bp.route('/<string:type>/<string:name>/images/<string:image>/')
@@ -179,34 +184,16 @@ def get_topic_image_file(topic_set, number, image):
 @bp.route('/terms/')
 def list_terms():
 
-    results_per_page = int(request.args['length'])
-    offset = int(request.args['start'])
-
-    data = TermAnalysis.query
-
-    search = str(request.args['search[value]']).strip()
-    if search:  # No empty search on my watch
-        search = '%{}%'.format(search)
-        data = data.filter(TermAnalysis.name.ilike(search))
-
-    direction = str(request.args['order[0][dir]'])
-    ord_col = ['name', 'n_studies', 'n_activations'][
-        int(request.args['order[0][column]'])]
-    dir_func = asc if direction == 'asc' else desc
-    data = data.order_by(dir_func(ord_col))
-
-    data = data.paginate(page=(offset / results_per_page) + 1,
-                         per_page=results_per_page, error_out=False)
-    result = {}
-    result['draw'] = int(request.args['draw'])  # for security
-    result['recordsTotal'] = TermAnalysis.query.count()
-    result['recordsFiltered'] = data.total
+    columns = [TermAnalysis.name, TermAnalysis.n_studies,
+               TermAnalysis.n_activations]
+    data, result = datatable_page(TermAnalysis.query, columns,
+                                  analysis_search.matches)
     result['data'] = [
         ['<a href={0}>{1}</a>'.format(
             url_for('analyses.show_term', term=d.name), d.name),
          d.n_studies,
          d.n_activations,
-         ] for d in data.items]
+         ] for d in data]
     return jsonify(**result)
 
 
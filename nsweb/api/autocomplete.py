@@ -0,0 +1,66 @@
+from flask import Blueprint, request, jsonify, url_for, abort
+from nsweb.models.names import name_registry, KINDS
+from .utils import conditional
+
+
+bp = Blueprint('api_autocomplete', __name__, url_prefix='/api/autocomplete')
+
+
+def _url(match):
+    if match['kind'] == 'term':
+        return url_for('analyses.show_term', term=match['name'])
+    if match['kind'] == 'gene':
+        return url_for('genes.show', symbol=match['name'])
+    return url_for('analyses.show_analysis', id=match['id'])
+
+
+@bp.route('/')
+@conditional
+def autocomplete():
+    """
+    Suggest terms, topics and genes matching a partial name
+    ---
+    tags:
+        - autocomplete
+    responses:
+        200:
+            description: Matching names, best first
+    parameters:
+        - in: query
+          name: q
+          description: Text typed so far. Matches names starting with it,
+            names with a later word starting with it, and (if there are few
+            of those) misspelled names.
+          required: true
+          type: string
+        - in: query
+          name: kind
+          description: Kinds of names to suggest (term, topic, gene; default
+            = all)
+          required: false
+          collectionFormat: csv
+          type: array
+          items:
+            type: string
+        - in: query
+          name: limit
+          description: Maximum number of suggestions (default = 10; max = 50)
+          required: false
+          type: integer
+    """
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        abort(400)
+    kinds = None
+    if request.args.get('kind'):
+        kinds = request.args['kind'].split(',')
+        if any(k not in KINDS for k in kinds):
+            abort(400)
+
+    matches = name_registry.complete(request.args.get('q', ''), kinds, limit)
+    for match in matches:
+        match['url'] = _url(match)
+    return jsonify(data=matches)
@@ -1,11 +1,13 @@
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, request, jsonify, abort, url_for
 from nsweb.models.analyses import CustomAnalysis
 from nsweb.models.images import CustomAnalysisImage
 from nsweb.models.studies import Study
 from nsweb.models.frequencies import Frequency
 from nsweb.core import db
 from nsweb.initializers import settings
+from nsweb.initializers.data_version import data_version
 from nsweb import tasks
+from nsweb.api.jobs import submit_job, job_response, finalizer
 from flask_login import current_user
 from flask_user import login_required
 import datetime as dt
@@ -75,6 +77,7 @@ def save_custom_analysis():
             freq = Frequency(analysis_id=custom_analysis.id, pmid=pmid)
             db.session.add(freq)
     db.session.commit()
+    data_version.bump()
 
     return jsonify(dict(result='success', uuid=uid, id=custom_analysis.id))
 
@@ -134,6 +137,7 @@ def copy_custom_analysis(uid):
         new_freq = Frequency(analysis_id=new_custom.id, pmid=freq.pmid)
         db.session.add(new_freq)
     db.session.commit()
+    data_version.bump()
 
     response = dict(uuid=uid, result="success")
     return jsonify(response)
@@ -156,6 +160,7 @@ def delete_custom_analysis(uid):
     # TODO: instead of deleting, consider setting a deleted flag instead
     db.session.delete(custom)
     db.session.commit()
+    data_version.bump()
     return jsonify(dict(result='success'))
 
 
@@ -163,51 +168,73 @@ def delete_custom_analysis(uid):
 @login_required
 def run_custom_analysis(uid):
     """
-    Given a uuid, kick off the analysis run and return the same id once
-    the run is complete.
+    Given a uuid, kick off the analysis run. Returns the same id if the
+    analysis is up to date, and otherwise a job to poll until the run is
+    complete.
     """
     custom = CustomAnalysis.query.filter_by(uuid=uid).first()
 
     if not custom or not custom.studies:
         abort(404)
 
+    job = start_custom_analysis(custom)
+    if job is not None:
+        return job_response(
+            job, url_for('api_custom.get_custom_analysis', uid=uid))
+
+    return uid
+
+
+def start_custom_analysis(custom):
+    """ Start a job to generate the images for a custom analysis. Returns the
+    Job, or None if the existing images are up to date. """
+
     # Only generate images if the analysis has never been run, if changes have
     # been made since the last run, or if images are missing.
-    if not custom.last_run_at or (custom.last_run_at < custom.updated_at) or \
-            not custom.images:
-
-        ids = [s.pmid for s in custom.studies]
-        if tasks.run_metaanalysis.delay(ids, custom.uuid).wait():
-            # Update analysis record
-            rev_inf = '%s_association-test_z_FDR_0.01.nii.gz' % custom.uuid
-            rev_inf = join(settings.IMAGE_DIR, 'custom', rev_inf)
-            fwd_inf = '%s_uniformity-test_FDR_0.01.nii.gz' % custom.uuid
-            fwd_inf = join(settings.IMAGE_DIR, 'custom', fwd_inf)
-            if exists(rev_inf):
-                images = [
-                    CustomAnalysisImage(
-                        name='%s (uniformity test)' % custom.name,
-                        image_file=fwd_inf,
-                        label='%s (uniformity test)' % custom.name,
-                        stat='z-score',
-                        display=1,
-                        download=1
-                    ),
-                    CustomAnalysisImage(
-                        name='%s (association test)' % custom.name,
-                        image_file=rev_inf,
-                        label='%s (association test)' % custom.name,
-                        stat='z-score',
-                        display=1,
-                        download=1
-                    )
-                ]
-                custom.images = images
-                custom.last_run_at = dt.datetime.utcnow()
-                db.session.add(custom)
-                db.session.commit()
-                return uid
+    if custom.last_run_at and (custom.last_run_at >= custom.updated_at) and \
+            custom.images:
+        return None
 
+    ids = [s.pmid for s in custom.studies]
+    return submit_job('custom', tasks.run_metaanalysis,
+                      args=(ids, custom.uuid), params={'uuid': custom.uuid})
+
+
+@finalizer('custom')
+def _finish_custom_analysis(job, result):
+    custom = CustomAnalysis.query.filter_by(uuid=job.params['uuid']).first()
+    if not result or custom is None:
         return None
 
-    return uid
+    # Update analysis record
+    rev_inf = '%s_association-test_z_FDR_0.01.nii.gz' % custom.uuid
+    rev_inf = join(settings.IMAGE_DIR, 'custom', rev_inf)
+    fwd_inf = '%s_uniformity-test_FDR_0.01.nii.gz' % custom.uuid
+    fwd_inf = join(settings.IMAGE_DIR, 'custom', fwd_inf)
+    if not exists(rev_inf):
+        return None
+
+    images = [
+        CustomAnalysisImage(
+            name='%s (uniformity test)' % custom.name,
+            image_file=fwd_inf,
+            label='%s (uniformity test)' % custom.name,
+            stat='z-score',
+            display=1,
+            download=1
+        ),
+        CustomAnalysisImage(
+            name='%s (association test)' % custom.name,
+            image_file=rev_inf,
+            label='%s (association test)' % custom.name,
+            stat='z-score',
+            display=1,
+            download=1
+        )
+    ]
+    custom.images = images
+    custom.last_run_at = dt.datetime.utcnow()
+    db.session.add(custom)
+    db.session.commit()
+    data_version.bump()
+    return url_for('api_custom.get_custom_analysis', uid=custom.uuid)
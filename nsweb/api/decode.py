@@ -1,28 +1,37 @@
-from flask import jsonify, request, Blueprint, abort, send_file
+from flask import jsonify, request, Blueprint, abort, url_for
 from nsweb.api.schemas import DecodingSchema
 from nsweb.models.decodings import Decoding, DecodingSet
 from nsweb.core import cache, db
 from nsweb.models.images import Image
 from nsweb.initializers import settings
 from nsweb import tasks
-from .utils import send_nifti
+from nsweb.tasks.engine import engine
+from .utils import send_nifti, send_file_compat
+from .jobs import submit_job, refresh_job, job_response, finalizer
+from .singleflight import single_flight, flight_key
+from contextlib import ExitStack
+from itertools import chain
+from urllib.parse import parse_qsl
 import json
 import re
 import uuid
+import gzip
+import hashlib
 import requests
 from os.path import join, basename, exists
 import os
 from datetime import datetime
 from email.utils import parsedate
 import pandas as pd
-from .utils import make_cache_key, json_with_status
+from .utils import make_cache_key, json_with_status, is_complete
 
 
 bp = Blueprint('api_decode', __name__, url_prefix='/api/decode')
 
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@cache.cached(timeout=3600, key_prefix=make_cache_key,
+              response_filter=is_complete)
 def get_decoding():
     """
     Retrieve decoding data for a single image
@@ -55,9 +64,18 @@ def get_decoding():
           description: URL of Nifti image to decode
           type: string
           required: false
+        - in: query
+          name: hash
+          description: SHA-1 hash of the uncompressed contents of a previously
+            decoded Nifti image
+          type: string
+          required: false
     """
     status, dec = _get_decoding_object()
 
+    if status == 202:
+        return job_response(dec.job)
+
     if status == 200:
         schema = DecodingSchema()
         return jsonify(data=schema.dump(dec).data)
@@ -70,7 +88,12 @@ def _get_decoding_object(filter_display=True):
     dec = None
 
     if 'uuid' in request.args:
-        dec = dec.filter_by(uuid=request.args['uuid']).first()
+        dec = Decoding.query.filter_by(uuid=request.args['uuid']).first()
+        dec = 404 if dec is None else dec
+
+    elif 'hash' in request.args:
+        dec = _get_decoding(image_hash=request.args['hash'])
+        dec = 404 if dec is None else dec
 
     elif 'image' in request.args:
         dec = decode_analysis_image(request.args['image'])
@@ -85,19 +108,16 @@ def _get_decoding_object(filter_display=True):
         dec = 99 # No search params provided
 
     if isinstance(dec, int):
-        if dec == 415:
-            msg = ("Invalid image extension; currently the decoder "
-                   "only accepts images in nifti format.")
+        return dec, _error_message(dec)
 
-        elif dec == 404:
-            msg = "No image was found at the provided URL."
-
-        elif dec== 413:
-            msg = ("The requested Nifti image is too large. "
-                   "Files must be under 4 MB in size.")
-        else:
-            msg = ("An unspecified decoding error occurred.")
-        return dec, msg
+    # Decodings run in the background are returned along with their job
+    if dec is not None and dec.image_decoded_at is None and \
+            dec.job is not None:
+        refresh_job(dec.job)
+        if dec.job.pending:
+            return 202, dec
+        if dec.job.status == 'failed':
+            return 500, _error_message(500)
 
     # Make sure we don't return non-displayable images
     if filter_display and dec is not None and not \
@@ -107,6 +127,134 @@ def _get_decoding_object(filter_display=True):
     return 200, dec
 
 
+def _error_message(status):
+    """ Map a decoding status code onto a user-facing error message. """
+    if status == 415:
+        return ("Invalid image extension; currently the decoder "
+                "only accepts images in nifti format.")
+    elif status == 404:
+        return "No image was found at the provided URL."
+    elif status == 413:
+        return ("The requested Nifti image is too large. "
+                "Files must be under 4 MB in size.")
+    elif status == 400:
+        return "Image IDs must be integers."
+    return "An unspecified decoding error occurred."
+
+
+@bp.route('/batch/', methods=['GET', 'POST'])
+def get_batch_decoding():
+    """
+    Decode several images at once
+    ---
+    tags:
+        - decode
+    responses:
+        200:
+            description: Decoding data for each requested image, in the order
+                the images appear in the query string (or JSON body), then in
+                the form data, with uploaded files last
+        default:
+            description: No images provided or too many images requested
+    parameters:
+        - in: query
+          name: image
+          description: IDs of images to decode
+          required: false
+          collectionFormat: csv
+          type: array
+          items:
+            type: integer
+        - in: query
+          name: neurovault
+          description: NeuroVault IDs of images to decode
+          required: false
+          collectionFormat: csv
+          type: array
+          items:
+            type: integer
+        - in: query
+          name: uuid
+          description: IDs of existing decodings (e.g., the results of an
+            earlier batch)
+          required: false
+          collectionFormat: csv
+          type: array
+          items:
+            type: string
+        - in: query
+          name: url
+          description: URLs of Nifti images to decode (may be repeated)
+          required: false
+          collectionFormat: multi
+          type: array
+          items:
+            type: string
+        - in: formData
+          name: file
+          description: Nifti images to upload and decode (may be repeated)
+          required: false
+          type: file
+    """
+    args = request.get_json(silent=True) or {}
+
+    # (type, value) of each requested image, in the order of the request
+    requested = []
+    for name, vals in args.items():
+        if name in BATCH_DECODERS and name != 'file':
+            vals = vals if isinstance(vals, list) else [vals]
+            requested += [(name, v) for v in vals if v]
+    # (MultiDicts group values by name, so parse the query string directly)
+    query = parse_qsl(request.query_string.decode('utf-8', 'replace'))
+    for name, val in chain(query, request.form.items(multi=True)):
+        if name not in BATCH_DECODERS or name == 'file' or name in args:
+            continue
+        vals = [val] if name == 'url' else \
+            re.split(r'[\s,]+', val.strip(' ,'))
+        requested += [(name, v) for v in vals if v]
+    requested += [('file', f) for f in request.files.getlist('file')]
+
+    if not requested:
+        return json_with_status(400, "No images were provided for decoding.")
+    if len(requested) > settings.DECODER_MAX_BATCH:
+        return json_with_status(
+            413, "At most %d images can be decoded in a single batch." %
+            settings.DECODER_MAX_BATCH)
+
+    # Collect existing decodings, and defer new ones so they can all be run
+    # in a single pass over the reference images. Images requested more than
+    # once are only decoded once.
+    found = {}
+    with PendingDecodings() as pending:
+        for name, val in requested:
+            key = (name, id(val) if name == 'file' else val)
+            if key not in found:
+                found[key] = BATCH_DECODERS[name](val, pending=pending)
+        _run_batch_decoder(pending)
+    decs = [found[(name, id(val) if name == 'file' else val)]
+            for name, val in requested]
+
+    schema = DecodingSchema()
+    data = []
+    for dec in decs:
+        if isinstance(dec, int) or dec is None:
+            status = 404 if dec is None else dec
+            data.append({'error': _error_message(status), 'status': status})
+            continue
+        if dec.image_decoded_at is None and dec.job is not None:
+            refresh_job(dec.job)
+        if dec.image_decoded_at is None and dec.job is not None and \
+                dec.job.pending:
+            data.append({'status': 202, 'id': dec.uuid,
+                         'location': url_for('api_jobs.get_job',
+                                             job_id=dec.job.id)})
+        elif dec.image_decoded_at is None:
+            data.append({'error': _error_message(500), 'status': 500})
+        else:
+            data.append(schema.dump(dec).data)
+    return jsonify(data=data)
+
+
 @cache.memoize(timeout=3600)
 def get_voxel_data(x, y, z, reference='terms', get_json=True, get_pp=True):
     """ Return the value at the specified voxel for all images in the named
@@ -120,43 +268,137 @@ def get_voxel_data(x, y, z, reference='terms', get_json=True, get_pp=True):
             addition to reverse inference z-scores).
     """
     # Make sure users don't request illegal sets
-    valid_references = ['terms', 'topics']
+    valid_references = ['terms', 'topics', 'genes']
     if reference not in valid_references:
         reference = valid_references[0]
-    result = tasks.get_voxel_data.delay(
-        reference, x, y, z, get_pp).wait()
+    result = engine.get_voxel_data(reference, x, y, z, get_pp)
     return result if get_json else pd.read_json(result)
 
 
+def _get_set_name():
+    """ Name of the requested DecodingSet. Default to reduced term reference
+    set. Also allow 'terms' or 'topics' shorthand. """
+    name = request.args.get('set', 'terms_20k')
+    if name in ['terms', 'topics']:
+        name += '_20k'
+    return name
+
+
 def _get_decoding(**kwargs):
     """ Check if a Decoding matching the passed criteria already exists. """
-    name = request.args.get('set', 'terms_20k')
+    name = _get_set_name()
     return Decoding.query.filter_by(**kwargs).join(DecodingSet) \
         .filter(DecodingSet.name == name).first()
 
 
-def _run_decoder(**kwargs):
-
+def _make_decoding(**kwargs):
+    """ Initialize a new (not yet decoded) Decoding. """
     kwargs['uuid'] = kwargs.get('uuid', uuid.uuid4().hex)
-    # Default to reduced term reference set. Also allow
-    # 'terms' or 'topics' shorthand.
-    ds_name = request.args.get('set', 'terms_20k')
-    if ds_name in ['terms', 'topics']:
-        ds_name += '_20k'
-    reference = DecodingSet.query.filter_by(name=ds_name).first()
-    dec = Decoding(display=True, download=False, ip=request.remote_addr,
-                   decoding_set=reference, **kwargs)
-
-    # run decoder and wait for it to terminate
-    result = tasks.decode_image.delay(dec.filename, reference.name,
-                                      dec.uuid).wait()
-
-    if result:
-        dec.image_decoded_at = datetime.utcnow()
-        db.session.add(dec)
-        db.session.commit()
+    reference = DecodingSet.query.filter_by(name=_get_set_name()).first()
+    return Decoding(display=True, download=False, ip=request.remote_addr,
+                    decoding_set=reference, **kwargs)
+
+
+class PendingDecodings(list):
+    """ New Decodings collected from a batch request, to be decoded together
+    once all of them are known. Single-flight locks taken while collecting
+    them are held until the batch has been saved (i.e., until the context is
+    exited), so that concurrent requests for the same images find the
+    Decodings instead of starting their own.
+
+    Two batches that take the same locks in a different order wait on each
+    other for at most settings.SINGLE_FLIGHT_WAIT seconds, after which one
+    of them goes ahead without the lock. """
+
+    def __init__(self):
+        super(PendingDecodings, self).__init__()
+        self._locks = ExitStack()
+        self._held = set()
+
+    def find(self, image_hash):
+        """ Return the pending Decoding of the image with the given hash, if
+        there is one. """
+        if image_hash is None:
+            return None
+        for dec in self:
+            if dec.image_hash == image_hash:
+                return dec
+        return None
 
-    return dec
+    def hold(self, name, *args):
+        """ Take a single-flight lock until the batch has been saved. """
+        key = flight_key(name, *args)
+        if key not in self._held:
+            self._locks.enter_context(single_flight(name, *args))
+            self._held.add(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._locks.close()
+        return False
+
+
+def _run_decoder(**kwargs):
+    return _run_batch_decoder([_make_decoding(**kwargs)])[0]
+
+
+def _run_batch_decoder(decs):
+    """ Run the decoder on a list of new Decodings. Decodings are grouped by
+    reference, and each group is decoded in a single pass--in-process if it's
+    small enough, and otherwise by a background job. """
+    groups = {}
+    for dec in decs:
+        groups.setdefault(dec.decoding_set.name, []).append(dec)
+
+    for reference, group in groups.items():
+        if not engine.runs_locally(len(group)):
+            # Concurrent requests for the same images share the job, so its
+            # Decodings may include ones from other requests
+            filenames = [d.filename for d in group]
+            job = submit_job('decode', tasks.decode_images,
+                             args=(filenames, reference),
+                             params={'uuids': [d.uuid for d in group],
+                                     'filenames': filenames})
+            for dec in group:
+                dec.job = job
+                db.session.add(dec)
+            continue
+
+        results = engine.decode_images([d.filename for d in group],
+                                       reference)
+        for dec, values in zip(group, results):
+            if values is not None:
+                dec.values = values
+                dec.image_decoded_at = datetime.utcnow()
+                db.session.add(dec)
+
+    db.session.commit()
+    return decs
+
+
+@finalizer('decode')
+def _finish_decoding(job, results):
+    """ Store the results of a decode job in every Decoding waiting on it,
+    matching them up by filename. """
+    uuids = job.params['uuids']
+    filenames = job.params['filenames']
+    results = dict(zip(filenames, results or [False] * len(filenames)))
+    decoded = []
+    for dec in job.decodings:
+        values = results.get(dec.filename)
+        if values:
+            dec.values = values
+            dec.image_decoded_at = datetime.utcnow()
+            decoded.append(dec.uuid)
+    db.session.commit()
+
+    if not decoded:
+        return None
+    if len(uuids) == 1:
+        return url_for('api_decode.get_decoding', uuid=uuids[0])
+    return url_for('api_decode.get_batch_decoding', uuid=','.join(uuids))
 
 
 @bp.route('/<string:uuid>/data/')
@@ -164,11 +406,15 @@ def get_data(uuid):
     dec = Decoding.query.filter_by(uuid=uuid).first()
     if dec is None:
         abort(404)
-    data = open(join(settings.DECODING_RESULTS_DIR,
-                     dec.uuid + '.txt')).read().splitlines()
-    data = [x.split('\t') for x in data]
+    if dec.image_decoded_at is None and dec.job is not None:
+        refresh_job(dec.job)
+        if dec.job.pending:
+            return job_response(dec.job)
+    data = dec.get_series()
+    if data is None:
+        abort(404)
     data = [{'analysis': f, 'r': round(float(v), 3)}
-            for (f, v) in data if v.strip()]
+            for (f, v) in data.dropna().items()]
     return jsonify(data=data)
 
 
@@ -195,13 +441,13 @@ def get_scatter(uuid, analysis):
         dec = Decoding.query.filter_by(uuid=uuid).first()
         if dec is None:
             abort(404)
-        result = tasks.make_scatterplot.delay(
-            dec.filename, analysis, dec.uuid, outfile=outfile,
-            x_lab=dec.name).wait()
-        if not exists(outfile):
-            abort(404)
-    return send_file(
-        outfile, as_attachment=False, attachment_filename=basename(outfile))
+        job = submit_job('scatter', tasks.make_scatterplot,
+                         args=(dec.filename, analysis, dec.uuid),
+                         kwargs={'outfile': outfile, 'x_lab': dec.name},
+                         result_url=request.path)
+        return job_response(job)
+    return send_file_compat(
+        outfile, as_attachment=False, download_name=basename(outfile))
 
 
 # @bp.route('/data/')
@@ -213,7 +459,10 @@ def get_scatter(uuid, analysis):
 #     return get_data(id)
 
 
-def decode_url(url, metadata={}):
+def decode_url(url, metadata={}, pending=None):
+    """ Decode the Nifti image at the given URL. If PendingDecodings are
+    passed as pending, new Decodings are added to them rather than run
+    immediately. """
 
     # Basic URL validation
     if not re.search('^https?\:\/\/', url):
@@ -232,10 +481,23 @@ def decode_url(url, metadata={}):
             int(headers['content-length']) > 4000000:
         return 413
 
+    # Concurrent requests for the same image should only decode it once
+    flight = ('decode_url', url, _get_set_name())
+    if pending is not None:
+        pending.hold(*flight)
+        return _decode_new_url(url, ext.group(0), headers, metadata, pending)
+    with single_flight(*flight):
+        return _decode_new_url(url, ext.group(0), headers, metadata, pending)
+
+
+def _decode_new_url(url, ext, headers, metadata, pending):
+    """ Download and decode an image, unless it's already been decoded. """
     dec = _get_decoding(url=url)
 
-    # Delete old record if caching is disabled or the file can't be found
-    if dec is not None and (not exists(dec.filename) or not settings.CACHE_DECODINGS):
+    # Delete old record if caching is disabled, the file can't be found, or
+    # the decoder failed
+    if dec is not None and (not exists(dec.filename) or _failed(dec) or
+                            not settings.CACHE_DECODINGS):
         db.session.delete(dec)
         db.session.commit()
         dec = None
@@ -243,11 +505,17 @@ def decode_url(url, metadata={}):
     if dec is None:
 
         unique_id = uuid.uuid4().hex
-        filename = join(settings.DECODED_IMAGE_DIR, unique_id + ext.group(0))
+        filename = join(settings.DECODED_IMAGE_DIR, unique_id + ext)
 
         f = requests.get(url)
         with open(filename, 'wb') as outfile:
             outfile.write(f.content)
+
+        # The same image is often available from several URLs
+        image_hash, dec = _find_duplicate(filename, pending)
+        if dec is not None:
+            return dec
+
         # Make sure celery worker has permission to overwrite
         os.chmod(filename, 0o666)
 
@@ -261,10 +529,11 @@ def decode_url(url, metadata={}):
             'name': metadata.get('name', basename(url)),
             'image_modified_at': modified,
             'filename': filename,
-            'neurovault_id': metadata.get('nv_id', None)
+            'neurovault_id': metadata.get('nv_id', None),
+            'image_hash': image_hash
         }
 
-        dec = _run_decoder(**kwargs)
+        dec = _defer_or_run_decoder(pending, **kwargs)
 
     return dec
 
@@ -274,7 +543,84 @@ def decode_url(url, metadata={}):
     #     return dec.uuid
 
 
-def decode_neurovault(id):
+def hash_image(filename):
+    """ Return a SHA-1 hash of the uncompressed contents of a Nifti image, so
+    the same image is recognized no matter where it came from or how it was
+    compressed. Returns None if the file can't be read. """
+    opener = gzip.open if filename.endswith('.gz') else open
+    sha = hashlib.sha1()
+    try:
+        with opener(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    except (IOError, OSError, EOFError):
+        return None
+    return sha.hexdigest()
+
+
+def _find_duplicate(filename, pending=None):
+    """ Hash a newly retrieved image and look for an existing decoding of the
+    same image, including any in the pending batch. If one is found, the new
+    file is deleted. Returns a tuple of (hash, Decoding or None). """
+    image_hash = hash_image(filename)
+    if image_hash is None:
+        return image_hash, None
+    dec = pending.find(image_hash) if pending is not None else None
+    if dec is not None:
+        os.unlink(filename)
+        return image_hash, dec
+    if not settings.CACHE_DECODINGS:
+        return image_hash, None
+    dec = _get_decoding(image_hash=image_hash)
+    if dec is None or not exists(dec.filename) or _failed(dec):
+        return image_hash, None
+    os.unlink(filename)
+    return image_hash, dec
+
+
+def _failed(dec):
+    """ Whether a decoding was run as a background job that failed. """
+    return dec.job is not None and dec.job.status == 'failed'
+
+
+def _defer_or_run_decoder(pending, **kwargs):
+    if pending is None:
+        return _run_decoder(**kwargs)
+    dec = _make_decoding(**kwargs)
+    pending.append(dec)
+    return dec
+
+
+def decode_upload(upload, pending=None):
+    """ Decode an uploaded Nifti image (a werkzeug FileStorage). """
+    ext = re.search(r'\.nii(\.gz)?$', upload.filename or '')
+    if ext is None:
+        return 415
+
+    unique_id = uuid.uuid4().hex
+    filename = join(settings.DECODED_IMAGE_DIR, unique_id + ext.group(0))
+    upload.save(filename)
+    if os.path.getsize(filename) > 4000000:
+        os.unlink(filename)
+        return 413
+
+    image_hash, dec = _find_duplicate(filename, pending)
+    if dec is not None:
+        return dec
+
+    # Make sure celery worker has permission to overwrite
+    os.chmod(filename, 0o666)
+
+    kwargs = {
+        'uuid': unique_id,
+        'name': basename(upload.filename),
+        'filename': filename,
+        'image_hash': image_hash
+    }
+    return _defer_or_run_decoder(pending, **kwargs)
+
+
+def decode_neurovault(id, pending=None):
     resp = requests.get('http://neurovault.org/api/images/%s/?format=json'
                         % str(id))
     metadata = json.loads(resp.content)
@@ -282,17 +628,20 @@ def decode_neurovault(id):
         # return render_template('decode/missing.html')
         return None
     metadata['nv_id'] = id
-    return decode_url(metadata['file'], metadata)
+    return decode_url(metadata['file'], metadata, pending)
 
 
-def decode_analysis_image(image):
+def decode_analysis_image(image, pending=None):
 
-    image = int(image)
+    try:
+        image = int(image)
+    except (TypeError, ValueError):
+        return 400
 
     dec = _get_decoding(image_id=image)
 
     # Delete old record
-    if not settings.CACHE_DECODINGS and dec is not None:
+    if dec is not None and (_failed(dec) or not settings.CACHE_DECODINGS):
         db.session.delete(dec)
         db.session.commit()
         dec = None
@@ -300,14 +649,34 @@ def decode_analysis_image(image):
     if dec is None:
 
         image = Image.query.get(image)
+        if image is None:
+            return 404
         filename = image.image_file
 
         kwargs = {
             'name': image.name,
             'filename': filename,
-            'image_id': image.id
+            'image_id': image.id,
+            'image_hash': hash_image(filename)
         }
 
-        dec = _run_decoder(**kwargs)
+        if pending is not None:
+            dec = pending.find(kwargs['image_hash'])
+        if dec is None:
+            dec = _defer_or_run_decoder(pending, **kwargs)
 
     return dec
+
+
+def _get_existing_decoding(uuid, pending=None):
+    return Decoding.query.filter_by(uuid=uuid).first()
+
+
+# How each type of image in a batch request is decoded
+BATCH_DECODERS = {
+    'image': decode_analysis_image,
+    'neurovault': decode_neurovault,
+    'url': decode_url,
+    'file': decode_upload,
+    'uuid': _get_existing_decoding
+}
@@ -0,0 +1,122 @@
+""" Downloads of the bulk data snapshots written by the database builder (see
+DatabaseBuilder.write_dumps). Files are served with Range support, so large
+downloads can be resumed. """
+
+from flask import Blueprint, jsonify, abort, url_for
+from nsweb.initializers import settings
+from .utils import conditional, send_file_compat
+import json
+import os
+import re
+
+
+bp = Blueprint('api_dumps', __name__, url_prefix='/api/dumps')
+
+VERSION = re.compile(r'^\d{8}-\d{6}$')
+
+# Snapshots never change once written, so files can be cached for a long time
+MAX_AGE = 30 * 24 * 3600
+
+
+def _versions():
+    if not os.path.isdir(settings.DUMP_DIR):
+        return []
+    return sorted((d for d in os.listdir(settings.DUMP_DIR)
+                   if VERSION.match(d)), reverse=True)
+
+
+def _manifest(version):
+    filename = os.path.join(settings.DUMP_DIR, version, 'manifest.json')
+    if not os.path.exists(filename):
+        abort(404)
+    with open(filename) as f:
+        manifest = json.load(f)
+    for f in manifest['files']:
+        f['url'] = url_for('api_dumps.get_file', version=version,
+                           filename=f['name'], _external=True)
+    return manifest
+
+
+@bp.route('/')
+@conditional
+def get_dumps():
+    """
+    Describe the latest bulk data snapshot
+    ---
+    tags:
+        - dumps
+    responses:
+        200:
+            description: Manifest of the latest snapshot of studies, peaks,
+                term frequencies, analyses and decoder labels (compressed
+                NumPy .npz files), with the size, SHA-256 checksum and download
+                URL of each file, and the versions of all available snapshots
+        404:
+            description: No snapshot has been written yet
+    """
+    versions = _versions()
+    if not versions:
+        abort(404)
+    manifest = _manifest(versions[0])
+    manifest['versions'] = versions
+    return jsonify(data=manifest)
+
+
+@bp.route('/<string:version>/')
+def get_dump(version):
+    """
+    Describe a bulk data snapshot
+    ---
+    tags:
+        - dumps
+    responses:
+        200:
+            description: Manifest of the snapshot
+        404:
+            description: No such snapshot
+    parameters:
+        - in: path
+          name: version
+          description: Version of the snapshot, as listed by /api/dumps/
+          required: true
+          type: string
+    """
+    if not VERSION.match(version):
+        abort(404)
+    return jsonify(data=_manifest(version))
+
+
+@bp.route('/<string:version>/<string:filename>')
+def get_file(version, filename):
+    """
+    Download a file of a bulk data snapshot
+    ---
+    tags:
+        - dumps
+    responses:
+        200:
+            description: The file. Supports Range requests.
+        404:
+            description: No such snapshot or file
+    parameters:
+        - in: path
+          name: version
+          description: Version of the snapshot
+          required: true
+          type: string
+        - in: path
+          name: filename
+          description: Name of the file, as listed in the manifest
+          required: true
+          type: string
+    """
+    if not VERSION.match(version) or \
+            not re.match(r'^[\w.-]+$', filename) or filename.startswith('.'):
+        abort(404)
+    path = os.path.join(settings.DUMP_DIR, version, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    resp = send_file_compat(path, as_attachment=True, download_name=filename,
+                            conditional=True, max_age=MAX_AGE)
+    resp.cache_control.public = True
+    return resp
@@ -0,0 +1,200 @@
+""" Streaming bulk exports of studies, peaks and study-term frequencies.
+
+Exports are written out as they are read from the database--through a
+server-side cursor where the database supports one--so memory use stays flat
+however many rows are exported. Clients that accept gzip get the output
+compressed on the fly.
+"""
+
+from flask import Blueprint, Response, request, abort, stream_with_context
+from nsweb.models.studies import Study
+from nsweb.models.peaks import Peak
+from nsweb.models.frequencies import Frequency
+from nsweb.models.analyses import Analysis
+from nsweb.core import db
+from nsweb.initializers import settings
+import csv
+import io
+import json
+import re
+import zlib
+
+
+bp = Blueprint('api_exports', __name__, url_prefix='/api/exports')
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _export_query(kind):
+    """ Return the query for an export and the names of its columns. """
+    if kind == 'studies':
+        columns = [Study.pmid, Study.doi, Study.title, Study.authors,
+                   Study.journal, Study.year, Study.space]
+        query = db.session.query(*columns)
+        pmid = Study.pmid
+        names = [c.key for c in columns]
+    elif kind == 'peaks':
+        query = db.session.query(Peak.pmid, Peak.table, Peak.x, Peak.y,
+                                 Peak.z).order_by(Peak.pmid, Peak.id)
+        pmid = Peak.pmid
+        names = ['pmid', 'table', 'x', 'y', 'z']
+    elif kind == 'frequencies':
+        query = db.session.query(Frequency.pmid, Analysis.name,
+                                 Frequency.frequency) \
+            .join(Analysis, Frequency.analysis_id == Analysis.id) \
+            .filter(Analysis.type == 'term') \
+            .order_by(Frequency.pmid, Analysis.name)
+        pmid = Frequency.pmid
+        names = ['pmid', 'term', 'frequency']
+    else:
+        abort(404)
+    for criterion in _filters(pmid):
+        query = query.filter(criterion)
+    if kind == 'studies':
+        query = query.order_by(Study.pmid)
+    return query, names
+
+
+def _filters(pmid):
+    """ Filters on the PubMed ID column of an export, from the query
+    arguments. """
+    filters = []
+    if 'pmid' in request.args:
+        try:
+            ids = [int(x) for x in
+                   re.split(r'[\s,]+', request.args['pmid'].strip(' ,'))]
+        except ValueError:
+            abort(400)
+        filters.append(pmid.in_(ids))
+
+    if 'term' in request.args:
+        studies = db.session.query(Frequency.pmid) \
+            .join(Analysis, Frequency.analysis_id == Analysis.id) \
+            .filter(Analysis.type == 'term',
+                    Analysis.name == request.args['term'])
+        filters.append(pmid.in_(studies))
+
+    years = []
+    try:
+        if 'min_year' in request.args:
+            years.append(Study.year >= int(request.args['min_year']))
+        if 'max_year' in request.args:
+            years.append(Study.year <= int(request.args['max_year']))
+    except ValueError:
+        abort(400)
+    if years:
+        filters.append(pmid.in_(db.session.query(Study.pmid).filter(*years)))
+    return filters
+
+
+def _ndjson(names, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(names, row))) + '\n'
+
+
+def _csv(names, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(names)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _chunks(lines, size):
+    """ Join lines into chunks of about size characters, so that the response
+    isn't written one row at a time. """
+    chunk, length = [], 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(lines, mimetype, filename=None):
+    """ Return a streaming response of lines of text, gzipped on the fly if the
+    client accepts it. """
+    chunks = _chunks(lines, settings.EXPORT_CHUNK_SIZE)
+    headers = {'Vary': 'Accept-Encoding'}
+    if filename is not None:
+        headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    if request.accept_encodings['gzip']:
+        chunks = _gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers=headers)
+
+
+@bp.route('/<string:kind>.<string:format>')
+def export(kind, format):
+    """
+    Export studies, peaks or study-term frequencies in bulk
+    ---
+    tags:
+        - exports
+    responses:
+        200:
+            description: All matching rows, streamed as newline-delimited JSON
+                or CSV (gzipped if the client accepts gzip)
+        404:
+            description: Unknown export or format
+    parameters:
+        - in: path
+          name: kind
+          description: What to export--studies, peaks or frequencies
+          required: true
+          type: string
+        - in: path
+          name: format
+          description: ndjson or csv
+          required: true
+          type: string
+        - in: query
+          name: pmid
+          description: PubMed ID(s) of the studies to export
+          required: false
+          collectionFormat: csv
+          type: array
+          items:
+            type: integer
+        - in: query
+          name: term
+          description: Only export studies associated with this term
+          required: false
+          type: string
+        - in: query
+          name: min_year
+          description: Only export studies published in or after this year
+          required: false
+          type: integer
+        - in: query
+          name: max_year
+          description: Only export studies published in or before this year
+          required: false
+          type: integer
+    """
+    if format not in FORMATS:
+        abort(404)
+    query, names = _export_query(kind)
+    rows = query.yield_per(settings.EXPORT_BATCH_SIZE)
+    lines = _ndjson(names, rows) if format == 'ndjson' else _csv(names, rows)
+    return stream(lines, FORMATS[format], '%s.%s' % (kind, format))
@@ -1,12 +1,14 @@
 import re
 from os.path import exists, join, basename
 
-from flask import jsonify, request, Blueprint, abort, send_file, url_for
-from sqlalchemy import asc, desc
+from flask import jsonify, request, Blueprint, abort, url_for
 
-from .utils import make_cache_key
+from .utils import make_cache_key, conditional, send_file_compat
+from .pagination import datatable_page
+from .jobs import submit_job, job_response
 from nsweb.api.schemas import GeneSchema
 from nsweb.models.genes import Gene
+from nsweb.models.search import gene_search
 from nsweb.core import cache
 from nsweb.tasks import make_scatterplot
 from nsweb.initializers import settings
@@ -16,6 +18,7 @@ bp = Blueprint('api_genes', __name__, url_prefix='/api/genes')
 
 
 @bp.route('/')
+@conditional
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_genes():
     """
@@ -80,38 +83,15 @@ def get_genes():
 @bp.route('/dt/')
 def datatable_genes():
 
-    results_per_page = int(request.args['length'])
-    offset = int(request.args['start'])
-
-    data = Gene.query
-
-    search = str(request.args['search[value]']).strip()
-
-    if search:
-        search = '%{}%'.format(search)
-        data = data.filter(Gene.name.ilike(search) |
-                           Gene.symbol.ilike(search) |
-                           Gene.synonyms.ilike(search))
-
-    direction = str(request.args['order[0][dir]'])
-    ord_col = ['symbol', 'name', 'synonyms', 'locus_type'][
-        int(request.args['order[0][column]'])]
-    dir_func = asc if direction == 'asc' else desc
-    data = data.order_by(dir_func(ord_col))
-
-    data = data.paginate(page=(offset / results_per_page) + 1,
-                         per_page=results_per_page, error_out=False)
-    result = {}
-    result['draw'] = int(request.args['draw'])  # for security
-    result['recordsTotal'] = Gene.query.count()
-    result['recordsFiltered'] = data.total
+    columns = [Gene.symbol, Gene.name, Gene.synonyms, Gene.locus_type]
+    data, result = datatable_page(Gene.query, columns, gene_search.matches)
     result['data'] = [
         ['<a href={0}>{1}</a>'.format(
             url_for('genes.show', symbol=d.symbol), d.symbol),
          d.name,
          d.synonyms,
          d.locus_type
-         ] for d in data.items]
+         ] for d in data]
     return jsonify(**result)
 
 
@@ -125,9 +105,12 @@ def get_scatter(val, analysis):
         gene = Gene.query.filter_by(symbol=val).first()
         if gene is None:
             abort(404)
-        make_scatterplot.delay(
-            gene.images[0].image_file, analysis, gene.symbol,
-            x_lab='%s expression level' % gene.symbol, outfile=outfile,
-            gene_masks=True).wait()
-    return send_file(outfile, as_attachment=False,
-                     attachment_filename=basename(outfile))
+        job = submit_job(
+            'scatter', make_scatterplot,
+            args=(gene.images[0].image_file, analysis, gene.symbol),
+            kwargs={'x_lab': '%s expression level' % gene.symbol,
+                    'outfile': outfile, 'gene_masks': True},
+            result_url=request.path)
+        return job_response(job)
+    return send_file_compat(outfile, as_attachment=False,
+                            download_name=basename(outfile))
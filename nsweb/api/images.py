@@ -1,13 +1,13 @@
 from flask import Blueprint, request, jsonify, abort
 from nsweb.models.images import Image
+from nsweb.models.search import image_search
 from nsweb.models.downloads import Download
 from .schemas import ImageSchema
 from nsweb.core import cache
-from .utils import make_cache_key
+from .utils import make_cache_key, conditional
 import re
 from nsweb.core import db
 from .utils import send_nifti
-from nsweb.initializers import settings
 from nsweb.initializers.settings import IMAGE_DIR
 from nsweb.controllers import error_page
 from nsweb.api.decode import decode_analysis_image
@@ -18,6 +18,7 @@ bp = Blueprint('api_images', __name__, url_prefix='/api/images')
 
 
 @bp.route('/')
+@conditional
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_images():
     """
@@ -76,9 +77,7 @@ def get_images():
         images = images.filter(Image.id.in_([int(x) for x in ids]))
 
     if 'search' in request.args and len(request.args['search']) > 1:
-        search = '%{}%'.format(request.args['search'])
-        images = images.filter(Image.label.ilike(search) |
-                               Image.description.ilike(search))
+        images = image_search.search(images, request.args['search'])
 
     images = images.paginate(page, limit, False).items
     schema = ImageSchema(many=True)
@@ -118,12 +117,10 @@ def get_decoding_data(image, get_json=True):
                           " to make sure there is a valid image with id=%d." %
                           image)
     dec = decode_analysis_image(image)
-    df = os.path.join(settings.DECODING_RESULTS_DIR, dec.uuid + '.txt')
-    if not os.path.exists(df):
+    data = dec.get_series()
+    if data is None:
         return error_page("An unspecified error occurred during decoding.")
-    data = open(df).read().splitlines()
-    data = [x.split('\t') for x in data]
-    data = [[f, round(float(v or '0'), 3)] for (f, v) in data]
+    data = [[f, round(float(v), 3)] for (f, v) in data.fillna(0).items()]
     return jsonify(data=data) if get_json else data
 
 
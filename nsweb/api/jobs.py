@@ -0,0 +1,192 @@
+from flask import Blueprint, jsonify, request, redirect, url_for, abort
+from nsweb.models.jobs import Job
+from nsweb.core import db, celery
+from nsweb.initializers import settings
+from nsweb.api.singleflight import single_flight, flight_key
+from datetime import datetime, timedelta
+import traceback
+import time
+
+
+bp = Blueprint('api_jobs', __name__, url_prefix='/api/jobs')
+
+# Functions run in the web app when a job finishes, keyed by job kind. Each
+# takes the Job and the return value of its task, and returns the URL of the
+# result, or None if the job failed.
+FINALIZERS = {}
+
+
+def finalizer(kind):
+    """ Register a function to run when a job of the given kind finishes. """
+    def decorator(func):
+        FINALIZERS[kind] = func
+        return func
+    return decorator
+
+
+def _default_finalizer(job, result):
+    return None if result is False else job.result_url
+
+
+def find_job(kind, key):
+    """ Return the pending job of the given kind and key, if there is one. """
+    return Job.query.filter_by(kind=kind, key=key, status='pending').first()
+
+
+def submit_job(kind, task, args=(), kwargs=None, params=None,
+               result_url=None):
+    """ Run a Celery task in the background and record it as a Job. If the
+    same task is already running with the same arguments, its job is returned
+    instead of starting a new one, so concurrent requests for the same result
+    share a single task.
+    Args:
+        kind (str): the type of job, which determines the finalizer that's run
+            once the task is done
+        task: the Celery task to run
+        args (tuple), kwargs (dict): arguments to pass to the task
+        params (dict): JSON-serializable data needed by the finalizer
+        result_url (str): URL of the result, if known in advance
+    """
+    kwargs = kwargs or {}
+    key = flight_key(task.name, *args, **kwargs)
+    with single_flight('submit_job', key):
+        job = find_job(kind, key)
+        if job is not None:
+            return job
+        result = task.apply_async(args=args, kwargs=kwargs)
+        job = Job(id=result.id, kind=kind, key=key, result_url=result_url)
+        job.params = params or {}
+        db.session.add(job)
+        db.session.commit()
+    return job
+
+
+def refresh_job(job, wait=0):
+    """ Check on a pending job, waiting up to wait seconds for it to finish,
+    and run its finalizer once it has. Returns the progress reported by the
+    task, if any. """
+    if not job.pending:
+        return None
+
+    result = celery.AsyncResult(job.id)
+    deadline = time.time() + wait
+    while not result.ready() and time.time() < deadline:
+        time.sleep(settings.JOB_POLL_INTERVAL)
+
+    if not result.ready():
+        # Results of lost or long-forgotten tasks never become ready
+        expires = job.created_at + timedelta(seconds=settings.JOB_TIMEOUT)
+        if datetime.utcnow() < expires:
+            return result.info if result.state == 'PROGRESS' else None
+
+    # Make sure only one of the requests polling the job finalizes it
+    with single_flight('refresh_job', job.id):
+        db.session.refresh(job)
+        if not job.pending:
+            return None
+
+        url = None
+        if result.successful():
+            finalize = FINALIZERS.get(job.kind, _default_finalizer)
+            try:
+                url = finalize(job, result.result)
+            except Exception:
+                print(traceback.format_exc())
+                db.session.rollback()
+
+        job.status = 'failed' if url is None else 'done'
+        job.result_url = url
+        job.finished_at = datetime.utcnow()
+        db.session.add(job)
+        db.session.commit()
+    return None
+
+
+def _next_url(job):
+    """ Where to send the client once the job is done. Clients can ask to be
+    sent back to the (local) URL that started the job. """
+    url = request.args.get('next', '')
+    if url.startswith('/') and not url.startswith('//'):
+        return url
+    return job.result_url
+
+
+def _describe(job, progress=None, next_url=None):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': progress,
+        'result': job.result_url,
+        'next': next_url,
+        'created_at': job.created_at.isoformat() + 'Z',
+        'location': url_for('api_jobs.get_job', job_id=job.id)
+    }
+
+
+def job_response(job, next_url=None):
+    """ Respond to a request whose result is being computed by a job. Returns
+    202 Accepted, with the URL to poll in the Location header. Once the job is
+    done, that URL redirects to next_url, which defaults to the URL of the
+    current GET request, or else to the result of the job. """
+    if next_url is None and request.method in ('GET', 'HEAD'):
+        next_url = request.full_path.rstrip('?')
+    location = url_for('api_jobs.get_job', job_id=job.id, next=next_url)
+    data = _describe(job, next_url=next_url or job.result_url)
+    data['location'] = location
+    resp = jsonify(data=data)
+    resp.status_code = 202
+    resp.headers['Location'] = location
+    return resp
+
+
+@bp.route('/<string:job_id>/')
+def get_job(job_id):
+    """
+    Check on a background job
+    ---
+    tags:
+        - jobs
+    responses:
+        200:
+            description: Job status and progress
+        303:
+            description: The job is done; redirects to its result
+        404:
+            description: No job found
+    parameters:
+        - in: path
+          name: job_id
+          description: ID of the job, as returned by the endpoint that
+            started it
+          required: true
+          type: string
+        - in: query
+          name: wait
+          description: Number of seconds to wait for the job to finish before
+            responding (long polling)
+          required: false
+          type: number
+        - in: query
+          name: redirect
+          description: Set to 0 to get the status of a finished job instead of
+            being redirected to its result
+          required: false
+          type: integer
+    """
+    job = Job.query.filter_by(id=job_id).first()
+    if job is None:
+        abort(404)
+
+    try:
+        wait = float(request.args.get('wait', 0) or 0)
+    except ValueError:
+        abort(400)
+    wait = max(0, min(wait, settings.JOB_MAX_WAIT))
+
+    progress = refresh_job(job, wait)
+    next_url = _next_url(job)
+
+    if job.status == 'done' and request.args.get('redirect') != '0':
+        return redirect(next_url, 303)
+    return jsonify(data=_describe(job, progress, next_url))
@@ -1,13 +1,17 @@
 from flask import jsonify, request, Blueprint, url_for, redirect
-from .utils import make_cache_key
+from .utils import make_cache_key, is_complete, conditional
+from .jobs import submit_job, job_response, finalizer
+from .singleflight import single_flight
 from nsweb.api.schemas import (LocationSchema)
 from nsweb.api.images import get_decoding_data
 from nsweb.models.locations import Location
-from nsweb.models.peaks import Peak
+from nsweb.models.peaks import peak_index, voxel_index
+from nsweb.models.studies import Study
 from nsweb.core import cache
 from sqlalchemy import func
 from flask_user import current_user
 from nsweb.models.images import LocationImage
+from nsweb.models.jobs import Job
 from nsweb.initializers import settings
 from os.path import join, exists
 from nsweb import tasks
@@ -15,27 +19,53 @@ from nsweb.core import db, app
 from nsweb.api.decode import decode_analysis_image, get_voxel_data
 import pandas as pd
 import numpy as np
-from collections import defaultdict
 
 
 bp = Blueprint('api_locations', __name__, url_prefix='/api/locations')
 
 
-def _group_peaks(peaks):
-    # takes list of peaks and returns a new list where redundant peaks (i.e.,
-    # those associated with the same study) are removed, and with a count of
-    # peaks found for each study added.
-    studies = {}
-    for p in peaks:
-        if p.pmid not in studies:
-            studies[p.pmid] = [p, 1]
-        else:
-            studies[p.pmid][1] += 1
-    return list(studies.values())
+def _find_studies(x, y, z, radius, distinct=False):
+    """ Find the studies reporting peaks within radius mm of x, y, z. Returns
+    a list of (pmid, number of peaks) tuples, nearest study first. If distinct
+    is True, repeats of a peak at the same coordinates aren't counted. """
+    # Most requests are for grid points that have been precomputed
+    found = voxel_index.studies(x, y, z, radius)
+    if found is None:
+        found = peak_index.studies(x, y, z, radius)
+    pmids, counts, distinct_counts = found
+    if distinct:
+        counts = distinct_counts
+    return [(int(p), int(c)) for p, c in zip(pmids, counts)]
+
+
+def _study_details(pmids):
+    """ Return a dict mapping pmids onto (title, authors, journal) tuples,
+    loaded in a single query. """
+    if not pmids:
+        return {}
+    rows = db.session.query(Study.pmid, Study.title, Study.authors,
+                            Study.journal).filter(Study.pmid.in_(pmids))
+    return dict((r[0], tuple(r[1:])) for r in rows)
+
+
+def _study_table(studies):
+    """ Format (pmid, count) tuples as DataTables rows. """
+    details = _study_details([pmid for pmid, count in studies])
+    data = []
+    for pmid, count in studies:
+        if pmid not in details:
+            continue
+        title, authors, journal = details[pmid]
+        link = '<a href={0}>{1}</a>'.format(url_for('studies.show',
+                                                    val=pmid), title)
+        data.append([link, authors, journal, count])
+    return data
 
 
 @bp.route('/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@conditional(key=lambda: make_cache_key())
+@cache.cached(timeout=3600, key_prefix=make_cache_key,
+              response_filter=is_complete)
 def get_location():
     """
     Retrieve location data
@@ -80,28 +110,53 @@ def get_location():
 
     loc = Location.query.filter_by(x=x, y=y, z=z).first()
     if loc is None:
-        from nsweb.controllers.locations import make_location
         loc = make_location(x, y, z)
+        if isinstance(loc, Job):
+            return job_response(loc)
 
-    peaks = Peak.closestPeaks(r, x, y, z)
-    peaks = _group_peaks(peaks)
-
-    loc.studies = [p[0].study for p in peaks]
+    loc.studies = [{'pmid': pmid}
+                   for pmid, count in _find_studies(x, y, z, r)]
 
     schema = LocationSchema()
     return jsonify(data=schema.dump(loc).data)
 
 
+def _coactivation_file(x, y, z):
+    filename = 'metaanalytic_coactivation_%d_%d_%d_association-test_z_FDR_0.01.nii.gz' % (
+        x, y, z)
+    return join(settings.IMAGE_DIR, 'coactivation', filename)
+
+
 def make_location(x, y, z):
+    """ Create the Location for a seed voxel. If its coactivation map hasn't
+    been generated yet, starts a job to generate it and returns the Job
+    instead; the Location is created when the job is done. """
+    if not exists(_coactivation_file(x, y, z)):
+        return submit_job('coactivation', tasks.make_coactivation_map,
+                          args=(x, y, z), params={'xyz': [x, y, z]})
+
+    # Concurrent requests for a new location should only create it once
+    with single_flight('make_location', x, y, z):
+        location = Location.query.filter_by(x=x, y=y, z=z).first()
+        return location or _build_location(x, y, z)
+
+
+@finalizer('coactivation')
+def _finish_location(job, result):
+    x, y, z = job.params['xyz']
+    # The map can't be generated for seeds with too few studies nearby, in
+    # which case the Location is created without it.
+    if Location.query.filter_by(x=x, y=y, z=z).first() is None:
+        _build_location(x, y, z)
+    return url_for('api_locations.get_location', x=x, y=y, z=z)
+
+
+def _build_location(x, y, z):
 
     location = Location(x, y, z)
 
     # Add Neurosynth coactivation image if it exists
-    filename = 'metaanalytic_coactivation_%d_%d_%d_association-test_z_FDR_0.01.nii.gz' % (
-        x, y, z)
-    filename = join(settings.IMAGE_DIR, 'coactivation', filename)
-    if not exists(filename):
-        tasks.make_coactivation_map.delay(x, y, z).wait()
+    filename = _coactivation_file(x, y, z)
     if exists(filename):
         ma_image = LocationImage(
             name='Meta-analytic coactivation for seed (%d, %d, %d)' % (
@@ -211,12 +266,16 @@ def check_xyz(x, y, z):
 
 @bp.route('/<string:val>/images')
 @bp.route('/images/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@conditional(key=lambda: make_cache_key())
+@cache.cached(timeout=3600, key_prefix=make_cache_key,
+              response_filter=is_complete)
 def get_images(val=None):
     location = get_params(val, location=True)
     if location is None:
         x, y, z, r = get_params(val)
         location = make_location(x, y, z)
+        if isinstance(location, Job):
+            return job_response(location)
 
     images = [{
         'id': img.id,
@@ -236,7 +295,9 @@ def get_images(val=None):
 
 @bp.route('/<string:val>/compare/')
 @bp.route('/compare/')
-@cache.cached(timeout=3600, key_prefix=make_cache_key)
+@conditional(key=lambda: make_cache_key())
+@cache.cached(timeout=3600, key_prefix=make_cache_key,
+              response_filter=is_complete)
 def compare_location(val=None, decimals=2):
     """ Compare this voxel to various image sets using various approaches.
     Currently returns correlations between the coactivation/functional
@@ -245,53 +306,39 @@ def compare_location(val=None, decimals=2):
     """
     x, y, z, radius = get_params(val)
     location = get_params(val, location=True) or make_location(x, y, z)
+    if isinstance(location, Job):
+        return job_response(location)
     ma = list(zip(*get_decoding_data(location.images[0].id, get_json=False)))
     fc = list(zip(*get_decoding_data(location.images[1].id, get_json=False)))
     ma = pd.Series(ma[1], index=ma[0], name='ma')
     fc = pd.Series(fc[1], index=fc[0], name='fc')
-    # too many gene maps to slice into, so return NAs
+    # Gene maps have no posterior probabilities, so those come back as NAs
     ref_type = request.args.get('set', 'terms_20k').split('_')[0]
-    if ref_type != 'genes':
-        vals = get_voxel_data(x, y, z, ref_type, get_json=False)
-    else:
-        vals = pd.Series([np.nan])
+    vals = get_voxel_data(x, y, z, ref_type, get_json=False,
+                          get_pp=(ref_type != 'genes'))
 
     data = pd.concat([ma, fc, vals], axis=1)
     data = data.apply(lambda x: np.round(x, decimals)).reset_index()
+    data = data.reindex(columns=['index', 'z', 'pp', 'fc', 'ma'])
     data = data.fillna('-')
-    data = data[['index', 'z', 'pp', 'fc', 'ma']]
     return jsonify(data=data.values.tolist())
 
 
 @bp.route('/<string:val>/studies/')
 @bp.route('/studies/')
+@conditional(key=lambda: make_cache_key())
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_studies(val=None):
     x, y, z, radius = get_params(val)
-    points = Peak.closestPeaks(radius, x, y, z)
 
-    # Track number of peaks and study details for each found study,
-    # keeping only peaks that haven't been previously seen for current
+    # Only count peaks that haven't been previously seen for the current
     # study/x/y/z combination.
-    seen = {}
-    study_counts = defaultdict(list)
-    for p in points:
-        key = hash((p.pmid, round(p.x, 2), round(p.y, 2), round(p.z, 2)))
-        if key in seen:
-            continue
-        study_counts[p.pmid].append(p)
-        seen[key] = 1
+    studies = _find_studies(x, y, z, radius, distinct=True)
 
     if 'dt' in request.args:
-        data = []
-        for pmid, peaks in study_counts.items():
-            s = peaks[0].study
-            link = '<a href={0}>{1}</a>'.format(url_for('studies.show',
-                                                        val=pmid), s.title)
-            data.append([link, s.authors, s.journal, len(peaks)])
+        data = _study_table(studies)
     else:
-        data = [{'pmid': pmid, 'peaks': len(peaks)}
-                for pmid, peaks in study_counts.items()]
+        data = [{'pmid': pmid, 'peaks': count} for pmid, count in studies]
     return jsonify(data=data)
 
 
@@ -306,8 +353,7 @@ def location_api(val):
     # Limit search to 20 mm to keep things fast
     if radius > 20:
         radius = 20
-    points = Peak.closestPeaks(radius, x, y, z).all()
-    points = _group_peaks(points)
+    studies = _find_studies(x, y, z, radius)
 
     ### IMAGES ###
     location = Location.query.filter_by(x=x, y=y, z=z).first()
@@ -315,17 +361,11 @@ def location_api(val):
     images = [{'label': i.label, 'id': i.id} for i in images if i.display]
 
     if 'draw' in request.args:
-        data = []
-        for p in points:
-            s = p[0].study
-            link = '<a href={0}>{1}</a>'.format(
-                url_for('studies.show', val=s.pmid), s.title)
-            data.append([link, s.authors, s.journal, p[1]])
-        data = jsonify(data=data)
+        data = jsonify(data=_study_table(studies))
     else:
         data = {
-            'studies': [{'pmid': p[0].study.pmid, 'peaks':p[1]}
-                        for p in points],
+            'studies': [{'pmid': pmid, 'peaks': count}
+                        for pmid, count in studies],
             'images': images
         }
         data = jsonify(data=data)
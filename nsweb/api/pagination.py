@@ -0,0 +1,175 @@
+""" Server-side processing for the DataTables tables of studies, terms, and
+genes.
+
+Two things made these tables slow, especially while the user types in the
+search box:
+- Every request counted all rows, and all rows matching the search. Both
+  counts are now cached until the data version changes, and the count of
+  matches stops at settings.DATATABLE_COUNT_CAP.
+- Pages were fetched with OFFSET, which reads and discards every row before
+  the page. Pages are now fetched by keyset ("seek") pagination where
+  possible: rows are ordered by the sort column and then the primary key, and
+  a page starts after the (value, key) of the last row of the previous page.
+  That position is returned as next_cursor, which clients can pass back as
+  cursor (along with the matching start); DataTables itself only knows
+  offsets, so the server also remembers where each page it served ends, and
+  seeks from there when asked for the following page. Only positions the
+  server found itself are remembered, never ones sent by clients. Other pages
+  (e.g., jumps to the last page) fall back on OFFSET.
+"""
+
+from flask import request, abort
+from sqlalchemy import asc, desc, and_, or_, inspect
+from nsweb.core import cache
+from nsweb.initializers import settings
+from nsweb.initializers.data_version import data_version
+import base64
+import hashlib
+import json
+
+
+def _cache_key(*parts):
+    """ Key of a cached value, tied to the current data version. """
+    version = data_version.get()
+    payload = json.dumps([version and version[0]] + list(parts), default=str)
+    return 'datatable:' + hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def cached_count(query, key, cap=None):
+    """ Count the rows returned by a query, caching the result under key.
+    Args:
+        query: the query whose rows to count
+        key (str): cache key. It's combined with the data version, so counts
+            are recomputed whenever the data change.
+        cap (int): if given, stop counting after cap + 1 rows
+    """
+    key = _cache_key('count', key, cap)
+    count = cache.get(key)
+    if count is None:
+        query = query.order_by(None)
+        if cap is not None:
+            query = query.limit(cap + 1)
+        count = query.count()
+        cache.set(key, count, timeout=settings.DATATABLE_CACHE_TIMEOUT)
+    return count
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(
+        json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+    if not isinstance(cursor, list) or len(cursor) != 5:
+        abort(400)
+    return cursor
+
+
+def _is_value_of(value, column):
+    """ Whether a value from a cursor can be compared with a column. """
+    if value is None:
+        return True
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return False
+    if python_type is float:
+        python_type = (int, float)
+    return isinstance(value, python_type) and not isinstance(value, bool)
+
+
+def _seek(column, pk, value, last, descending):
+    """ Filter for the rows after (value, last) when ordered by column and
+    then pk. NULLs are sorted last. """
+    def after(a, b):
+        return a < b if descending else a > b
+    if value is None:
+        return and_(column.is_(None), after(pk, last))
+    return or_(after(column, value), and_(column == value, after(pk, last)),
+               column.is_(None))
+
+
+def datatable_page(query, columns, search=None, name=None, pk=None):
+    """ Answer a DataTables server-side processing request.
+    Args:
+        query: query for all rows of the table
+        columns (list): the column to sort by for each column of the table
+        search (function): takes the value of the search box, and returns a
+            filter for the query, or None to show all rows
+        name (str): name of the table, used in cache keys. Defaults to the
+            name of the queried table.
+        pk: unique column to break ties in sorting by. Defaults to the
+            primary key.
+    Returns: A tuple of (rows of the page, dict of draw, recordsTotal,
+        recordsFiltered and next_cursor to return to the client).
+    """
+    entity = query.column_descriptions[0]['entity']
+    if pk is None:
+        pk = inspect(entity).primary_key[0]
+    if name is None:
+        name = inspect(entity).local_table.name
+
+    try:
+        start = int(request.args['start'])
+        length = int(request.args['length'])
+        order = int(request.args['order[0][column]'])
+        column = columns[order]
+    except (KeyError, ValueError, IndexError):
+        abort(400)
+    descending = request.args.get('order[0][dir]') == 'desc'
+    value = str(request.args.get('search[value]', '')).strip()
+
+    result = {'draw': int(request.args.get('draw', 0))}  # for security
+    result['recordsTotal'] = cached_count(query, name)
+    criterion = search(value) if value and search else None
+    if criterion is not None:
+        query = query.filter(criterion)
+        result['recordsFiltered'] = min(
+            cached_count(query, [name, value], settings.DATATABLE_COUNT_CAP),
+            settings.DATATABLE_COUNT_CAP)
+    else:
+        result['recordsFiltered'] = result['recordsTotal']
+
+    direction = desc if descending else asc
+    query = query.order_by(column.is_(None), direction(column), direction(pk))
+
+    # Seek from the end of the previous page if we know where that is. A
+    # cursor holds the sort order, the sort value and key of the last row of
+    # the previous page, and the start of the page that follows it.
+    sort = [order, descending]
+    from_client = bool(request.args.get('cursor'))
+    if from_client:
+        cursor = decode_cursor(request.args['cursor'])
+        if cursor[:2] != sort or cursor[4] != start or \
+                not _is_value_of(cursor[2], column) or \
+                not _is_value_of(cursor[3], pk) or cursor[3] is None:
+            abort(400)
+    else:
+        cursor = cache.get_many(
+            _cache_key('cursor', name, value, sort, start))[0]
+    if cursor is not None:
+        query = query.filter(_seek(column, pk, cursor[2], cursor[3],
+                                   descending))
+    elif start > 0:
+        query = query.offset(start)
+    if length > 0:
+        query = query.limit(length)
+    rows = query.all()
+
+    result['next_cursor'] = None
+    if rows and len(rows) == length:
+        cursor = sort + [getattr(rows[-1], column.key),
+                         getattr(rows[-1], pk.key), start + length]
+        # A cursor from the client may not lead where it claims to, so only
+        # remember where pages found by the server end
+        if not from_client:
+            cache.set(_cache_key('cursor', name, value, sort,
+                                 start + length),
+                      cursor, timeout=settings.DATATABLE_CACHE_TIMEOUT)
+        result['next_cursor'] = encode_cursor(cursor)
+    return rows, result
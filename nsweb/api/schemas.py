@@ -1,7 +1,5 @@
 from nsweb.core import marshmallow as mm
-from nsweb.initializers import settings
 from flask import url_for
-from os.path import join
 
 
 class PeakSchema(mm.Schema):
@@ -58,10 +56,11 @@ class LocationSchema(mm.Schema):
 class DecodingSchema(mm.Schema):
 
     def get_values(self, dec):
-        data = open(join(settings.DECODING_RESULTS_DIR,
-                         dec.uuid + '.txt')).read().splitlines()
-        data = [x.split('\t') for x in data]
-        return dict([(f, round(float(v), 3)) for (f, v) in data if v.strip()])
+        data = dec.get_series()
+        if data is None:
+            return {}
+        return dict([(f, round(float(v), 3))
+                     for (f, v) in data.dropna().items()])
 
     image = mm.Nested('ImageSchema', allow_null=True)
     reference = mm.Function(lambda obj: obj.decoding_set.name)
@@ -69,8 +68,8 @@ class DecodingSchema(mm.Schema):
 
     class Meta:
 
-        fields = ('id', 'url', 'neurovault_id', 'comments', 'image',
-                  'reference', 'values')
+        fields = ('id', 'url', 'neurovault_id', 'image_hash', 'comments',
+                  'image', 'reference', 'values')
 
 
 class GeneSchema(mm.Schema):
@@ -0,0 +1,126 @@
+""" Single-flight coordination of expensive operations.
+
+When many requests ask for the same expensive result at once--e.g., the
+coactivation map for a location that was just shared--only one of them should
+start computing it. Callers hold a lock keyed on the operation and its
+arguments while they check for an existing result and, if there isn't one,
+start computing it; everyone else waits for the lock and then finds (and
+shares) the first caller's result.
+
+Locks are held in Redis so that they're shared by all web processes. If Redis
+isn't configured or can't be reached, a lock local to the current process is
+used instead.
+"""
+
+from nsweb.initializers import settings
+from contextlib import contextmanager
+import threading
+import hashlib
+import json
+import traceback
+
+
+def _normalize(value):
+    """ Make equal arguments serialize identically--e.g., 2 and 2.0, or tuples
+    and lists. """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), _normalize(v)) for k, v in value.items())
+    return value
+
+
+def flight_key(name, *args, **kwargs):
+    """ Return a key identifying an operation and its (normalized) arguments.
+    """
+    payload = json.dumps([name, _normalize(args), _normalize(kwargs)],
+                         sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class SingleFlight(object):
+    """ Hands out locks keyed on operations.
+    Args:
+        url (str): URL of the Redis server to hold locks in. If None, only
+            local locks are used. Defaults to settings.SINGLE_FLIGHT_URL.
+        timeout (int): seconds after which a Redis lock expires, in case its
+            holder dies. Defaults to settings.SINGLE_FLIGHT_TIMEOUT.
+        wait (int): longest time (in seconds) to wait for a lock before
+            going ahead without it. Defaults to settings.SINGLE_FLIGHT_WAIT.
+    """
+
+    prefix = 'nsweb:flight:'
+
+    def __init__(self, url=None, timeout=None, wait=None):
+        self.url = url or settings.SINGLE_FLIGHT_URL
+        self.timeout = timeout or settings.SINGLE_FLIGHT_TIMEOUT
+        self.wait = wait or settings.SINGLE_FLIGHT_WAIT
+        self._client = None
+        self._local = {}
+        self._local_guard = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None and self.url:
+            import redis
+            self._client = redis.StrictRedis.from_url(self.url)
+        return self._client
+
+    @contextmanager
+    def _local_lock(self, key):
+        # Keep a count of users, so locks can be discarded when unused
+        with self._local_guard:
+            entry = self._local.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=self.wait)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._local_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._local[key]
+
+    @contextmanager
+    def _redis_lock(self, key):
+        lock = self.client.lock(self.prefix + key, timeout=self.timeout,
+                                blocking_timeout=self.wait)
+        acquired = lock.acquire()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception:
+                    # The lock expired while it was held
+                    pass
+
+    @contextmanager
+    def __call__(self, name, *args, **kwargs):
+        """ Hold the lock for an operation and its arguments. Yields whether
+        the lock was acquired; callers that time out waiting go ahead without
+        it rather than fail. """
+        key = flight_key(name, *args, **kwargs)
+        lock = None
+        if self.client is not None:
+            try:
+                lock = self._redis_lock(key)
+                acquired = lock.__enter__()
+            except Exception:
+                print(traceback.format_exc())
+                lock = None
+        if lock is None:
+            lock = self._local_lock(key)
+            acquired = lock.__enter__()
+        try:
+            yield acquired
+        finally:
+            lock.__exit__(None, None, None)
+
+
+single_flight = SingleFlight()
@@ -1,14 +1,18 @@
 import urllib
 import re
+import json
 
 from flask import jsonify, request, Blueprint, url_for
-from sqlalchemy import asc, desc
 # from flask_user import login_required
 
-from .utils import make_cache_key
+from .utils import make_cache_key, conditional
+from .pagination import datatable_page
+from .exports import stream
 from nsweb.api.schemas import StudySchema
 from nsweb.models.studies import Study
+from nsweb.models.search import study_search
 from nsweb.core import cache
+from nsweb.initializers import settings
 from nsweb import tasks
 
 
@@ -16,6 +20,7 @@ bp = Blueprint('api_studies', __name__, url_prefix='/api/studies')
 
 
 @bp.route('/')
+@conditional
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_studies():
     """
@@ -68,11 +73,8 @@ def get_studies():
         studies = studies.filter(Study.pmid.in_([int(x) for x in ids]))
 
     if 'search' in request.args and len(request.args['search']) > 1:
-        search = '%{}%'.format(request.args['search'])
-        studies = studies.filter(Study.title.ilike(search) |
-                                 Study.authors.ilike(search) |
-                                 Study.journal.ilike(search) |
-                                 Study.year.like(search))
+        search = request.args['search']
+        studies = study_search.search(studies, search, _match_number(search))
 
     studies = studies.paginate(page, limit, False).items
     schema = StudySchema(many=True)
@@ -99,45 +101,34 @@ def get_tables(val):
     return jsonify(data=list(tables.values()))
 
 
+def _match_number(val):
+    """ Filter for studies published in, or with the PubMed ID, val. """
+    try:
+        int_val = int(val)
+    except ValueError:
+        return None
+    return (Study.year == int_val) | (Study.pmid == int_val)
+
+
+def _search_studies(val):
+    q = study_search.matches(val)
+    number = _match_number(val)
+    if number is not None:
+        q = number if q is None else q | number
+    return q
+
+
 @bp.route('/dt/')
+@conditional
 @cache.cached(timeout=3600, key_prefix=make_cache_key)
 def get_study_list():
 
     # if 'expression' in request.args:
     #     return get_studies_by_expression(request.args['expression'])
 
-    data = Study.query
-
-    val = str(request.args['search[value]']).strip()
-    if val:
-        str_val = '%{}%'.format(val)
-        q = Study.title.ilike(str_val) | Study.authors.ilike(str_val) | \
-            Study.journal.ilike(str_val)
-        try:
-            int_val = int(val)
-            q = q | (Study.year == int_val) | (Study.pmid == int_val)
-        except Exception as e:
-            pass
-        data = data.filter(q)
-
-    # Sorting
-    direction = str(request.args['order[0][dir]'])
-    ord_col = ['title', 'authors', 'journal', 'year', 'pmid'][
-        int(request.args['order[0][column]'])]
-    dir_func = asc if direction == 'asc' else desc
-    data = data.order_by(dir_func(ord_col))
-
-    # Pagination
-    results_per_page = int(request.args['length'])
-    offset = int(request.args['start'])
-    data = data.paginate(
-        page=(offset / results_per_page) + 1, per_page=results_per_page,
-        error_out=False)
-
-    result = {}
-    result['draw'] = int(request.args['draw'])  # for security
-    result['recordsTotal'] = Study.query.count()
-    result['recordsFiltered'] = data.total
+    columns = [Study.title, Study.authors, Study.journal, Study.year,
+               Study.pmid]
+    data, result = datatable_page(Study.query, columns, _search_studies)
     result['data'] = [['<a href={0}>{1}</a>'.format(
         url_for('studies.show', val=d.pmid),
         d.title),
@@ -145,7 +136,7 @@ def get_study_list():
         d.journal,
         d.year,
         '<a href=http://www.ncbi.nlm.nih.gov/pubmed/{0}>{0}</a>'.format(
-            d.pmid)] for d in data.items]
+            d.pmid)] for d in data]
     return jsonify(**result)
 
 
@@ -182,15 +173,18 @@ def get_study_peaks(val):
 
 
 @bp.route('/all/')
+@conditional
 def get_all_studies():
     """
     :return: JSON object containing all studies
     """
-    key = str(Study.query.count())
-    if request.headers.get('If-None-Match') == key:
-        return '', 304, {}
-    all_studies = Study.query.all()
-    response = jsonify(dict(studies=[s.serialize() for s in all_studies]))
-    response.headers['ETag'] = key
+    def generate():
+        # Streamed, so that all studies needn't be held in memory at once
+        yield '{"studies": ['
+        studies = Study.query.yield_per(settings.EXPORT_BATCH_SIZE)
+        for i, study in enumerate(studies):
+            yield (', ' if i else '') + json.dumps(study.serialize())
+        yield ']}'
+    response = stream(generate(), 'application/json')
     response.headers['Cache-Control'] = 'max-age=600'
     return response
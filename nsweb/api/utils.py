@@ -1,8 +1,14 @@
-from flask import send_file, abort, request, Response
+from flask import send_file, abort, request, Response, make_response
 from nsweb.initializers.settings import IMAGE_DIR
+from nsweb.initializers.data_version import data_version
+from functools import wraps
+from importlib import metadata
+import calendar
 import datetime as dt
+import hashlib
 import os
 import json
+import re
 
 
 def make_cache_key():
@@ -11,6 +17,77 @@ def make_cache_key():
     return request.path + request.query_string.decode('utf-8')
 
 
+def is_complete(response):
+    ''' Whether a response can be cached--i.e., it isn't a 202 for a job that
+    is still running. '''
+    return getattr(response, 'status_code', 200) != 202
+
+
+def _not_modified(etag, modified):
+    """ Whether the client's copy of the response is still current. """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None:
+        return int(modified) <= calendar.timegm(since.utctimetuple())
+    return False
+
+
+def conditional(view=None, key=None):
+    """ Make a read-only view answer conditional GETs. Successful responses
+    get an ETag--derived from the data version and the URL, or from
+    key() if given (e.g., the view's cache key)--and a Last-Modified date;
+    requests whose copy is still current get a 304 before the view (or the
+    cache) is called. """
+    if view is None:
+        return lambda view: conditional(view, key)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version = data_version.get()
+        if version is None or request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+
+        token, modified = version
+        path = request.full_path if key is None else key()
+        etag = hashlib.sha1(('%s %s' % (token, path)).encode('utf-8')) \
+            .hexdigest()
+        if _not_modified(etag, modified):
+            resp = Response(status=304)
+            weak = request.if_none_match.is_weak(etag)
+        else:
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            # Compressed and uncompressed responses aren't byte-for-byte
+            # equal, so their ETag is weak
+            weak = 'Content-Encoding' in resp.headers
+        resp.set_etag(etag, weak=weak)
+        resp.last_modified = int(modified)
+        return resp
+    return wrapper
+
+
+# Flask 2.0 renamed some arguments of send_file(), and 2.2 removed the old
+# names
+_FLASK_VERSION = tuple(int(v) for v in
+                       re.findall(r'\d+', metadata.version('flask'))[:2])
+_SEND_FILE_ARGS = {
+    'download_name': 'attachment_filename',
+    'max_age': 'cache_timeout',
+    'etag': 'add_etags'
+}
+
+
+def send_file_compat(path, **kwargs):
+    """ Call send_file() with the argument names of the installed Flask.
+    Takes the current names (download_name, max_age, etag). """
+    if _FLASK_VERSION < (2, 0):
+        kwargs = dict((_SEND_FILE_ARGS.get(k, k), v)
+                      for k, v in kwargs.items())
+    return send_file(path, **kwargs)
+
+
 def send_nifti(filename, attachment_filename=None):
     """ Sends back a cache-controlled nifti image to the browser """
     if not os.path.exists(filename) or '..' in filename or \
@@ -20,9 +97,10 @@ def send_nifti(filename, attachment_filename=None):
     if attachment_filename is None:
         attachment_filename = os.path.basename(filename)
 
-    resp = send_file(os.path.join(IMAGE_DIR, filename), as_attachment=True,
-                     attachment_filename=attachment_filename, conditional=True,
-                     add_etags=True)
+    resp = send_file_compat(os.path.join(IMAGE_DIR, filename),
+                            as_attachment=True,
+                            download_name=attachment_filename,
+                            conditional=True, etag=True)
     resp.last_modified = dt.datetime.fromtimestamp(os.path.getmtime(filename))
     resp.make_conditional(request)
     return resp
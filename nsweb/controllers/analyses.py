@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, redirect, url_for, abort
 from nsweb.models.analyses import (Analysis, AnalysisSet, TopicAnalysis,
                                    TermAnalysis)
+from nsweb.models.names import name_registry
 import json
 import re
 from flask_user import login_required, current_user
@@ -24,6 +25,10 @@ def find_analysis(name, type=None):
     ''' Retrieve analysis by either id (when int) or name (when string) '''
     if re.match('\d+$', name):
         return Analysis.query.get(name)
+    if type in ('term', 'topic'):
+        id = name_registry.find(name, type)
+        if id is not None:
+            return Analysis.query.get(id)
     query = Analysis.query.filter_by(name=name)
     if type is not None:
         query = query.filter_by(type=type)
@@ -78,12 +83,10 @@ def show_topic(topic_set, number):
         TopicAnalysis.number == number, AnalysisSet.name == topic_set).first()
     if topic is None:
         return render_template('analyses/missing.html', analysis=None)
-    terms = [t[0] for t in TermAnalysis.query.with_entities(
-        TermAnalysis.name).all()]
     top = topic.terms.split(', ')
 
     def map_url(x):
-        if x in terms:
+        if name_registry.find(x, 'term') is not None:
             return '<a href="%s">%s</a>' % (url_for('analyses.show_term',
                                                     term=x), x)
         return x
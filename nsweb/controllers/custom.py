@@ -1,10 +1,9 @@
 from flask import Blueprint, render_template, redirect, url_for, abort
 from nsweb.models.analyses import CustomAnalysis
-from nsweb.api.custom import run_custom_analysis as api_run_custom
+from nsweb.api.custom import start_custom_analysis
 import json
 from flask_user import login_required, current_user
 from nsweb.initializers import settings
-from nsweb.controllers import error_page
 from os.path import join
 
 
@@ -53,11 +52,14 @@ def run_custom_analysis(uid):
     if not custom or not custom.studies:
         abort(404)
 
-    result = api_run_custom(uid)
+    next_url = url_for('analyses.show_custom_analysis', uid=uid)
+    job = start_custom_analysis(custom)
 
-    if result is None:
-        return error_page("An unspecified error occurred while trying "
-                          "to run the custom meta-analysis. Please try "
-                          "again.")
+    if job is not None:
+        return render_template(
+            'shared/job.html', job=job, next_url=next_url,
+            message="Running the custom meta-analysis.",
+            error="An unspecified error occurred while trying to run the "
+                  "custom meta-analysis. Please try again.")
 
-    return redirect(url_for('analyses.show_custom_analysis', uid=uid))
+    return redirect(next_url)
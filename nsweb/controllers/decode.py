@@ -16,6 +16,13 @@ def index():
     if status == 200:
         return show(dec, dec.uuid)
 
+    elif status == 202:
+        return render_template(
+            'shared/job.html', job=dec.job,
+            next_url=url_for('decode.show', uuid=dec.uuid),
+            message="Decoding the image.",
+            error="An error occurred while decoding the image.")
+
     elif status == 99:
         return render_template('decode/index.html')
 
@@ -1,4 +1,5 @@
-from flask import send_file, abort, request
+from flask import abort, request
+from nsweb.api.utils import send_file_compat
 from nsweb.initializers.settings import IMAGE_DIR
 import datetime as dt
 import os
@@ -13,9 +14,10 @@ def send_nifti(filename, attachment_filename=None):
     if attachment_filename is None:
         attachment_filename = os.path.basename(filename)
 
-    resp = send_file(os.path.join(IMAGE_DIR, filename), as_attachment=True,
-                     attachment_filename=attachment_filename, conditional=True,
-                     add_etags=True)
+    resp = send_file_compat(os.path.join(IMAGE_DIR, filename),
+                            as_attachment=True,
+                            download_name=attachment_filename,
+                            conditional=True, etag=True)
     resp.last_modified = dt.datetime.fromtimestamp(os.path.getmtime(filename))
     resp.make_conditional(request)
     return resp
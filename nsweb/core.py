@@ -29,7 +29,9 @@ app = Flask('NSWeb', static_folder=settings.STATIC_FOLDER,
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Caching
-cache = Cache(config={'CACHE_TYPE': 'simple'})
+cache = Cache(config={
+    'CACHE_TYPE': 'nsweb.initializers.cache.VersionedCache',
+    'CACHE_DEFAULT_TIMEOUT': 3600})
 
 # Initialize celery
 celery = make_celery(app)
@@ -90,6 +92,7 @@ def create_app(debug=True, test=False):
 
     # Initialize caching
     db.init_app(app)
+    app.config['CACHE_REDIS_URL'] = None if test else settings.CACHE_REDIS_URL
     cache.init_app(app)
 
     # i18n support
@@ -130,6 +133,10 @@ def register_blueprints():
         'nsweb.api.studies',
         'nsweb.api.decode',
         'nsweb.api.genes',
+        'nsweb.api.jobs',
+        'nsweb.api.autocomplete',
+        'nsweb.api.exports',
+        'nsweb.api.dumps',
         'nsweb.controllers.home',
         'nsweb.controllers.analyses',
         # 'nsweb.controllers.custom',
@@ -1,4 +1,5 @@
 from celery import Celery, Task
+from kombu import Queue
 from nsweb.initializers import settings
 
 
@@ -9,6 +10,21 @@ def make_celery(app):
     celery.conf.update(CELERY_ACCEPT_CONTENT=['json'],
                        CELERY_TASK_SERIALIZER='json',
                        CELERY_RESULT_SERIALIZER = 'json')
+
+    # Route each task to its queue, and apply per-task time limits
+    queues = list(settings.CELERY_TASK_QUEUES)
+    routes, annotations = {}, {}
+    for queue, tasks in settings.CELERY_TASK_QUEUES.items():
+        for task in tasks:
+            routes['nsweb.tasks.' + task] = {'queue': queue}
+    for task, (soft, hard) in settings.CELERY_TASK_TIME_LIMITS.items():
+        annotations['nsweb.tasks.' + task] = {'soft_time_limit': soft,
+                                              'time_limit': hard}
+    celery.conf.update(CELERY_QUEUES=[Queue(q, routing_key=q)
+                                      for q in queues],
+                       CELERY_DEFAULT_QUEUE=queues[0],
+                       CELERY_ROUTES=routes,
+                       CELERY_ANNOTATIONS=annotations)
     TaskBase = celery.Task
 
     class ContextTask(TaskBase):
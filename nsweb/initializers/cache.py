@@ -0,0 +1,348 @@
+""" Shared cache backend for Flask-Caching.
+
+Cached responses are kept in Redis, so that they're shared by all web
+processes and survive restarts. Values are pickled and, if large, compressed.
+
+To keep many requests from computing the same value at once when it's missing
+or expires (a stampede):
+- The first request to miss a key takes a short-lived lock on it. Others wait
+  for it to store the value, and only compute the value themselves if the lock
+  is released (or times out) without it.
+- Values are refreshed early, with a probability that rises as their expiry
+  approaches and with the time they took to compute ("XFetch"), so that a
+  single request usually recomputes a popular value before it expires.
+
+All keys live in a versioned namespace. Bumping the version (see
+bump_version()), e.g., after the database builder republishes data,
+invalidates everything at once.
+
+If no Redis URL is configured, an in-process store with the same interface
+stands in for Redis--e.g., for tests.
+"""
+
+from flask_caching.backends.base import BaseCache
+from nsweb.initializers import settings
+import math
+import pickle
+import random
+import threading
+import time
+import traceback
+import uuid
+import zlib
+
+
+PREFIX = 'nsweb:cache:'
+VERSION_KEY = PREFIX + 'version'
+STATS_KEY = PREFIX + 'stats'
+
+
+class LocalStore(object):
+    """ Minimal in-process stand-in for the Redis client. Implements only the
+    commands used by VersionedCache. """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        value, expires = self._data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key)
+
+    def mget(self, keys):
+        with self._lock:
+            return [self._live(k) for k in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._live(key) is not None:
+                return None
+            self._data[key] = (value, None if ex is None else time.time() + ex)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(k, None) is not None for k in keys)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._live(key) or 0) + amount
+            self._data[key] = (value, None)
+            return value
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            counts = self._live(key) or {}
+            counts[field] = counts.get(field, 0) + amount
+            self._data[key] = (counts, None)
+            return counts[field]
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._live(key) or {})
+
+
+def _connect(url):
+    if url is None:
+        return LocalStore()
+    import redis
+    return redis.StrictRedis.from_url(url)
+
+
+class VersionedCache(BaseCache):
+    """ A Flask-Caching backend storing compressed values in Redis, with
+    stampede protection and hit/miss counters. Use it by setting CACHE_TYPE
+    to 'nsweb.initializers.cache.VersionedCache'; the Redis URL is read from
+    CACHE_REDIS_URL in the app config (None for a local store).
+    """
+
+    def __init__(self, url=None, app=None, default_timeout=300, **kwargs):
+        super(VersionedCache, self).__init__(default_timeout=default_timeout)
+        self.url = url
+        self._store = None
+        self._version = None
+        self._version_checked = 0
+        self._local = threading.local()
+        self._counts = {}
+        self._counts_lock = threading.Lock()
+        self._counts_flushed = time.time()
+        if app is not None:
+            # Release locks on values a request didn't end up storing (e.g.,
+            # responses that weren't cacheable)
+            app.teardown_request(self._release_all)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.pop('ignore_delete_many_errors', None)
+        return cls(config.get('CACHE_REDIS_URL'), app, **kwargs)
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = _connect(self.url)
+        return self._store
+
+    ### Namespacing ###
+    def _get_version(self):
+        now = time.time()
+        if self._version is None or \
+                now - self._version_checked > settings.CACHE_VERSION_CHECK:
+            self._version = int(self.store.get(VERSION_KEY) or 0)
+            self._version_checked = now
+        return self._version
+
+    def _key(self, key):
+        return '%sv%d:%s' % (PREFIX, self._get_version(), key)
+
+    def bump_version(self):
+        """ Invalidate all cached values. Returns the new version. """
+        self._version = self.store.incr(VERSION_KEY)
+        self._version_checked = time.time()
+        return self._version
+
+    ### Serialization ###
+    def _dump(self, entry):
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= settings.CACHE_COMPRESS_MIN:
+            return b'z' + zlib.compress(data)
+        return b'p' + data
+
+    def _load(self, data):
+        if data is None:
+            return None
+        try:
+            if data[:1] == b'z':
+                return pickle.loads(zlib.decompress(data[1:]))
+            return pickle.loads(data[1:])
+        except Exception:
+            print(traceback.format_exc())
+            return None
+
+    ### Stampede protection ###
+    @property
+    def _state(self):
+        # Locks held and values being computed by the current thread
+        if not hasattr(self._local, 'locks'):
+            self._local.locks = {}
+            self._local.started = {}
+        return self._local
+
+    def _acquire(self, key):
+        token = uuid.uuid4().hex
+        if self.store.set(key + ':lock', token, ex=settings.CACHE_LOCK_TIMEOUT,
+                          nx=True):
+            self._state.locks[key] = token
+            return True
+        return False
+
+    def _release(self, key):
+        token = self._state.locks.pop(key, None)
+        if token is None:
+            return
+        held = self.store.get(key + ':lock')
+        if isinstance(held, bytes):
+            held = held.decode('utf-8')
+        if held == token:
+            self.store.delete(key + ':lock')
+
+    def _release_all(self, exc=None):
+        for key in list(self._state.locks):
+            try:
+                self._release(key)
+            except Exception:
+                print(traceback.format_exc())
+        self._state.started.clear()
+
+    def _refresh_early(self, entry):
+        value, delta, expires = entry
+        if expires is None or not delta:
+            return False
+        beta = settings.CACHE_EARLY_REFRESH
+        return time.time() - delta * beta * math.log(random.random()) >= \
+            expires
+
+    def _miss(self, key, stat):
+        self._state.started[key] = time.time()
+        self._count(stat)
+        return None
+
+    ### Counters ###
+    def _count(self, stat):
+        with self._counts_lock:
+            self._counts[stat] = self._counts.get(stat, 0) + 1
+            if time.time() - self._counts_flushed < settings.CACHE_STATS_FLUSH:
+                return
+            counts, self._counts = self._counts, {}
+            self._counts_flushed = time.time()
+        self._flush_counts(counts)
+
+    def _flush_counts(self, counts):
+        try:
+            for stat, n in counts.items():
+                self.store.hincrby(STATS_KEY, stat, n)
+        except Exception:
+            print(traceback.format_exc())
+
+    def stats(self):
+        """ Return the number of hits, misses, and early refreshes counted by
+        all processes, and the hit rate. """
+        with self._counts_lock:
+            counts, self._counts = self._counts, {}
+            self._counts_flushed = time.time()
+        self._flush_counts(counts)
+        stats = dict((k.decode('utf-8') if isinstance(k, bytes) else k,
+                      int(v)) for k, v in self.store.hgetall(STATS_KEY).items())
+        for stat in ['hits', 'misses', 'early']:
+            stats.setdefault(stat, 0)
+        total = stats['hits'] + stats['misses'] + stats['early']
+        stats['hit_rate'] = float(stats['hits']) / total if total else None
+        return stats
+
+    ### Cache API ###
+    def get(self, key):
+        try:
+            key = self._key(key)
+            entry = self._load(self.store.get(key))
+            if entry is not None:
+                # Usually serve the cached value; occasionally, and only if
+                # nobody else is at it, refresh it ahead of expiry
+                if self._refresh_early(entry) and self._acquire(key):
+                    return self._miss(key, 'early')
+                self._count('hits')
+                return entry[0]
+
+            # Wait for whoever is computing the value, if anyone
+            if not self._acquire(key):
+                deadline = time.time() + settings.CACHE_LOCK_WAIT
+                while time.time() < deadline:
+                    time.sleep(settings.CACHE_LOCK_POLL)
+                    entry = self._load(self.store.get(key))
+                    if entry is not None:
+                        self._count('hits')
+                        return entry[0]
+                    if self._acquire(key):
+                        break
+            return self._miss(key, 'misses')
+        except Exception:
+            print(traceback.format_exc())
+            return None
+
+    def get_many(self, *keys):
+        # Used for bookkeeping (e.g., memoize versions), so no locking
+        try:
+            values = self.store.mget([self._key(k) for k in keys])
+        except Exception:
+            print(traceback.format_exc())
+            return [None] * len(keys)
+        entries = [self._load(v) for v in values]
+        return [None if e is None else e[0] for e in entries]
+
+    def has(self, key):
+        try:
+            return self.store.get(self._key(key)) is not None
+        except Exception:
+            print(traceback.format_exc())
+            return False
+
+    def set(self, key, value, timeout=None):
+        try:
+            key = self._key(key)
+            timeout = self._normalize_timeout(timeout)
+            now = time.time()
+            started = self._state.started.pop(key, None)
+            delta = now - started if started is not None else 0
+            expires = now + timeout if timeout else None
+            data = self._dump((value, delta, expires))
+            self.store.set(key, data, ex=timeout or None)
+            self._release(key)
+            return True
+        except Exception:
+            print(traceback.format_exc())
+            return False
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        return [k for k, v in mapping.items() if self.set(k, v, timeout)]
+
+    def delete(self, key):
+        try:
+            return bool(self.store.delete(self._key(key)))
+        except Exception:
+            print(traceback.format_exc())
+            return False
+
+    def delete_many(self, *keys):
+        return [k for k in keys if self.delete(k)]
+
+    def clear(self):
+        self.bump_version()
+        return True
+
+    def inc(self, key, delta=1):
+        value = (self.get_many(key)[0] or 0) + delta
+        return value if self.set(key, value) else None
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+
+def bump_version(url=None):
+    """ Invalidate all responses cached by the web app--e.g., after the
+    database builder republishes data. Returns the new version, or None if
+    there's no shared cache. """
+    url = url or settings.CACHE_REDIS_URL
+    if url is None:
+        return None
+    return VersionedCache(url).bump_version()
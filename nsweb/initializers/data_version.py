@@ -0,0 +1,78 @@
+""" A token identifying the current version of the site's data.
+
+The token changes whenever the data served by the API might have: when the
+database builder republishes data, and when custom analyses are written. The
+API derives HTTP validators (ETags and Last-Modified dates) from it, so that
+clients can revalidate responses without the server redoing any work.
+
+The token is kept in a small file, so that every process sees the same one
+without a database query.
+"""
+
+from nsweb.initializers import settings
+from os.path import exists, getmtime, dirname
+import json
+import os
+import time
+import uuid
+
+
+class DataVersion(object):
+    """ Reads and bumps the data version token.
+    Args:
+        path (str): the file holding the token. Defaults to
+            settings.DATA_VERSION_FILE.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._mtime = None
+        self._version = None
+        self._build = None
+
+    def _file(self):
+        return self.path or settings.DATA_VERSION_FILE
+
+    def _read(self):
+        filename = self._file()
+        mtime = getmtime(filename) if exists(filename) else None
+        if mtime != self._mtime:
+            self._version = self._build = None
+            if mtime is not None:
+                data = json.load(open(filename))
+                self._version = (data['token'], data['updated_at'])
+                self._build = data.get('build')
+            self._mtime = mtime
+
+    def get(self):
+        """ Return a tuple of (token, time of the last change as a Unix
+        timestamp), or None if no version has been written yet. """
+        self._read()
+        return self._version
+
+    def build(self):
+        """ Return the token of the last build of the database, or None if
+        none has been published. Unlike the token returned by get(), it
+        doesn't change when custom analyses are written. """
+        self._read()
+        return self._build
+
+    def bump(self, build=False):
+        """ Record that the data have changed. Returns the new token.
+        Args:
+            build (bool): whether the change is a new build of the database
+        """
+        filename = self._file()
+        if not exists(dirname(filename)):
+            os.makedirs(dirname(filename))
+        token = uuid.uuid4().hex
+        data = {'token': token, 'updated_at': time.time(),
+                'build': token if build else self.build()}
+        tmp_file = '%s.%s.tmp' % (filename, token)
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_file, filename)
+        return token
+
+
+data_version = DataVersion()
@@ -1,12 +1,14 @@
 
-from nsweb.models.analyses import TermAnalysis, TopicAnalysis, AnalysisSet
+from nsweb.models.analyses import (Analysis, TermAnalysis, TopicAnalysis,
+                                   AnalysisSet)
 from nsweb.models.studies import Study
-from nsweb.models.peaks import Peak
+from nsweb.models.peaks import Peak, VoxelStudyIndex
 from nsweb.models.frequencies import Frequency
 from nsweb.models.decodings import DecodingSet
 from nsweb.models.images import (TermAnalysisImage, GeneImage,
                                  TopicAnalysisImage)
 from nsweb.models.genes import Gene
+from nsweb.models.search import study_search, rebuild_all
 from nsweb.initializers import settings
 import os
 from os.path import join, basename, exists
@@ -16,13 +18,62 @@ from neurosynth.analysis import meta
 import neurosynth as ns
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from sqlalchemy import func
 import random
 from glob import glob
 import json
 import re
 import shutil
+import csv
+import io
 import urllib
 import traceback
+import hashlib
+import multiprocessing
+import tempfile
+import time
+
+
+# The Dataset used by meta-analysis worker processes. It's set before the
+# workers are forked, so that they share it instead of unpickling a copy.
+_meta_dataset = None
+
+
+def _run_meta_analysis(job):
+    ''' Generate the images for one feature (in a worker process). Images are
+    written to a temporary directory and only moved into place once they've
+    all been written. '''
+    feature, name, output_dir, threshold, q = job
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=output_dir)
+    try:
+        ids = _meta_dataset.get_studies(features=feature,
+                                        frequency_threshold=threshold)
+        ma = meta.MetaAnalysis(_meta_dataset, ids, q=q)
+        ma.save_results(output_dir=tmp_dir, prefix=name)
+        files = sorted(os.listdir(tmp_dir))
+        for f in files:
+            os.rename(join(tmp_dir, f), join(output_dir, f))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return name, files
+
+
+# The Masker and the indices of the voxels to keep, shared with the worker
+# processes that read images for memmaps.
+_memmap_inputs = None
+
+
+def _load_memmap_image(img):
+    ''' Read, mask and standardize one image (in a worker process). Returns
+    the standardized data and the [min, max, mean, std] of the raw data. '''
+    masker, voxels = _memmap_inputs
+    # Use unthresholded maps when possible
+    img_file = re.sub('_FDR_*nii.gz', '.nii.gz', img)
+    data = masker.mask(img_file)[voxels]
+    std, mean = data.std(), data.mean()
+    return (((data - mean) / std).astype('float32'),
+            [data.min(), data.max(), mean, std])
 
 
 class DatabaseBuilder:
@@ -53,6 +104,8 @@ class DatabaseBuilder:
             print("WARNING: RESETTING ALL NEUROSYNTH ASSETS!")
             self.reset_assets(download_data)
 
+        from nsweb.tasks.dataset_cache import save_dataset, is_current
+
         # Load or create Neurosynth Dataset instance
         if dataset is None or reset_dataset or (isinstance(dataset, str) and
                                                 not os.path.exists(dataset)):
@@ -64,9 +117,15 @@ class DatabaseBuilder:
             dataset = Dataset(studies)
             dataset.add_features(features)
             dataset.save(settings.PICKLE_DATABASE)
+            save_dataset(dataset, settings.DATASET_CACHE_DIR)
         else:
             print("Loading existing Dataset...")
+            filename = dataset
             dataset = Dataset.load(dataset)
+            # Keep the fast-loading copy used by workers up to date
+            if filename == settings.PICKLE_DATABASE and not is_current(
+                    settings.DATASET_CACHE_DIR, filename):
+                save_dataset(dataset, settings.DATASET_CACHE_DIR)
             if features is not None:
                 dataset.add_features(features)
 
@@ -273,6 +332,37 @@ class DatabaseBuilder:
         self.db.session.add(analysis)
         self.db.session.commit()
 
+    def _bulk_insert(self, table, columns, rows, batch_size=10000):
+        """ Insert rows (tuples of values for columns) into a table, bypassing
+        the ORM. On Postgres the rows are streamed in with COPY; elsewhere
+        they're inserted with executemany() in a single transaction, so
+        SQLite prepares the INSERT statement once and syncs to disk once. """
+        if not rows:
+            return
+        engine = self.db.engine
+        if engine.dialect.name == 'postgresql':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for row in rows:
+                writer.writerow(['\\N' if v is None else v for v in row])
+            buf.seek(0)
+            conn = engine.raw_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.copy_expert(
+                    "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+                    % (table.name, ', '.join('"%s"' % c for c in columns)),
+                    buf)
+                conn.commit()
+            finally:
+                conn.close()
+        else:
+            with engine.begin() as conn:
+                for start in range(0, len(rows), batch_size):
+                    conn.execute(table.insert(),
+                                 [dict(zip(columns, row)) for row in
+                                  rows[start:start + batch_size]])
+
     def add_studies(self, analyses=None, threshold=0.001, limit=None,
                     reset=False):
         """ Add studies to the DB.
@@ -289,9 +379,14 @@ class DatabaseBuilder:
             matches. This ensures that we can gracefully add new analysis
             associations without mucking up the DB. To explicitly replace old
             records, pass reset=True.
+
+            Records are inserted in bulk, bypassing the ORM, so no ORM events
+            fire for them; the study search index is rebuilt instead.
         """
         if reset:
             Study.query.delete()
+        # Flush pending ORM changes before inserting behind the session's back
+        self.db.session.commit()
 
         # For efficiency, get all analysis data up front, so we only need to
         # densify array once
@@ -309,62 +404,132 @@ class DatabaseBuilder:
         # SQL DBs generally don't like numpy dtypes
         study_inds = [int(ind) for ind in study_inds]
 
-        all_rows = self.dataset.activations.query('id in @study_inds')
+        all_rows = self.dataset.activations
+        all_rows = all_rows[all_rows['id'].isin(study_inds)] \
+            .sort_values('id', kind='mergesort')
         all_rows[['doi', 'table_num']] = all_rows[['doi', 'table_num']] \
                                             .astype(str).replace('nan', '')
 
-        # Create Study records
-        for i, pmid in enumerate(study_inds):
-
-            activ = all_rows.query('id == @pmid')
-
-            study = Study.query.get(pmid)
-
-            if study is None:
-                peaks = [Peak(x=p['x'], y=p['y'], z=p['z'],
-                              table=p['table_num'])
-                         for (ind, p) in activ.iterrows()]
-
-                # Track in Python to avoid issuing SQL count() queries
-                n_peaks = len(peaks)
-
-                data = activ.iloc[0, :]
-                study = Study(
-                    pmid=int(pmid),
-                    space=data['space'],
-                    doi=data['doi'],
-                    title=data['title'],
-                    journal=data['journal'],
-                    authors=data['authors'],
-                    year=int(data['year']))
-                study.peaks.extend(peaks)
-                self.db.session.add(study)
-
-            # Map analyses onto studies via a Frequency join table that also
-            # stores frequency info
-            pmid_frequencies = feature_data.loc[pmid, :]
-            to_keep = pmid_frequencies[pmid_frequencies >= threshold]
-            for analysis_name, freq in to_keep.iteritems():
-                freq_inst = Frequency(
-                    study=study, analysis=self.analyses[analysis_name][0],
-                    frequency=freq)
-                self.db.session.add(freq_inst)
-
-                # Track number of studies and peaks so we can update
-                # Analysis table more efficiently later
-                self.analyses[analysis_name][1] += 1
-                self.analyses[analysis_name][2] += n_peaks
-
-        # Commit records in batches to conserve memory and speed up querying.
-            if (i + 1) % 100 == 0:
-                print("Saving study %d..." % i)
-                self.db.session.commit()
-
-        self.db.session.commit()  # Commit any remaining studies
+        # Track in Python to avoid issuing SQL count() queries
+        n_peaks = all_rows.groupby('id').size()
+
+        # Don't recreate existing studies (or their peaks)
+        existing = set(pmid for (pmid,) in
+                       self.db.session.query(Study.pmid).all())
+        new_rows = all_rows[~all_rows['id'].isin(existing)]
+
+        studies = new_rows.drop_duplicates('id')
+        study_cols = ['pmid', 'space', 'doi', 'title', 'journal', 'authors',
+                      'year']
+        study_rows = list(zip(
+            studies['id'].astype(int).tolist(), studies['space'].tolist(),
+            studies['doi'].tolist(), studies['title'].tolist(),
+            studies['journal'].tolist(), studies['authors'].tolist(),
+            studies['year'].astype(int).tolist()))
+        print("Adding %d studies..." % len(study_rows))
+        self._bulk_insert(Study.__table__, study_cols, study_rows)
+        study_search.rebuild()
+
+        peak_cols = ['pmid', 'x', 'y', 'z', 'table']
+        peak_rows = list(zip(
+            new_rows['id'].astype(int).tolist(),
+            new_rows['x'].astype(float).tolist(),
+            new_rows['y'].astype(float).tolist(),
+            new_rows['z'].astype(float).tolist(),
+            new_rows['table_num'].tolist()))
+        print("Adding %d peaks..." % len(peak_rows))
+        self._bulk_insert(Peak.__table__, peak_cols, peak_rows)
+
+        # Map analyses onto studies via a Frequency join table that also
+        # stores frequency info
+        pmids = n_peaks.index.values.astype(int)
+        names = list(feature_data.columns)
+        freqs = self._frequency_matrix(feature_data, pmids, threshold)
+
+        # Leave existing mappings alone
+        analysis_ids = np.array([self.analyses[n][0].id for n in names])
+        coo = freqs.tocoo()
+        existing = self._existing_frequencies(analysis_ids[coo.col],
+                                              pmids[coo.row])
+        coo.data[existing] = 0
+        freqs = coo.tocsr()
+        freqs.eliminate_zeros()
+
+        rows = self._frequency_rows(freqs, pmids, analysis_ids)
+        print("Adding %d study-analysis mappings..." % len(rows))
+        self._bulk_insert(Frequency.__table__,
+                          ['analysis_id', 'pmid', 'frequency'], rows)
+
+        # Track number of studies and peaks so we can update Analysis table
+        # more efficiently later
+        n_studies, n_activations = self._frequency_counts(freqs,
+                                                          n_peaks.values)
+        for name, n_s, n_a in zip(names, n_studies, n_activations):
+            self.analyses[name][1] += int(n_s)
+            self.analyses[name][2] += int(n_a)
 
         # Update all analysis counts
         self._update_analysis_counts()
 
+    def _frequency_matrix(self, feature_data, pmids, threshold):
+        """ Return the frequencies in feature_data (a studies x features
+        DataFrame) as a sparse CSR matrix with one row per pmid (in order;
+        rows of studies missing from feature_data are empty), keeping only
+        those >= threshold. The matrix is built one column at a time, so the
+        full dense matrix is never held in memory. """
+        # Position of each study of feature_data in pmids (-1 if not there)
+        positions = pd.Index(pmids).get_indexer(
+            feature_data.index.astype(int))
+        rows, cols, values = [], [], []
+        for j in range(feature_data.shape[1]):
+            column = feature_data.iloc[:, j]
+            if isinstance(column.dtype, pd.SparseDtype):
+                # Only look at the stored values
+                idx = column.array.sp_index.indices
+                vals = column.array.sp_values
+            else:
+                vals = column.to_numpy()
+                idx = np.arange(len(vals))
+            keep = (vals >= threshold) & (vals != 0) & (positions[idx] >= 0)
+            rows.append(positions[idx[keep]])
+            cols.append(np.full(keep.sum(), j))
+            values.append(vals[keep].astype(float))
+        shape = (len(pmids), feature_data.shape[1])
+        if not rows:
+            return sparse.csr_matrix(shape)
+        return sparse.csr_matrix((np.concatenate(values),
+                                  (np.concatenate(rows),
+                                   np.concatenate(cols))), shape=shape)
+
+    def _frequency_rows(self, freqs, pmids, analysis_ids):
+        """ Return (analysis_id, pmid, frequency) rows for the Frequency table
+        from a sparse matrix returned by _frequency_matrix(). """
+        coo = freqs.tocoo()
+        return list(zip(np.asarray(analysis_ids)[coo.col].astype(int).tolist(),
+                        np.asarray(pmids)[coo.row].astype(int).tolist(),
+                        coo.data.astype(float).tolist()))
+
+    def _frequency_counts(self, freqs, n_peaks):
+        """ Return the number of studies and of activations mapped onto each
+        feature (column) of a sparse frequency matrix, given the number of
+        peaks in each study (row). """
+        included = (freqs != 0).astype('int64')
+        n_studies = np.asarray(included.sum(axis=0)).ravel()
+        n_activations = included.T.dot(np.asarray(n_peaks, dtype='int64'))
+        return n_studies, n_activations
+
+    def _existing_frequencies(self, analysis_ids, pmids):
+        """ Return a boolean array flagging the (analysis_id, pmid) pairs
+        that are already in the Frequency table. """
+        existing = self.db.session.query(Frequency.analysis_id,
+                                         Frequency.pmid).all()
+        if not existing:
+            return np.zeros(len(pmids), dtype=bool)
+        existing = np.array(existing, dtype='int64')
+        keys = np.asarray(analysis_ids, dtype='int64') << 32 | \
+            np.asarray(pmids, dtype='int64')
+        return np.isin(keys, existing[:, 0] << 32 | existing[:, 1])
+
     def _map_analysis_to_studies(self, analysis):
         pass
 
@@ -389,8 +554,8 @@ class DatabaseBuilder:
                 associate them with the corresponding Analysis record.
             overwrite: if True, always generate new meta-analysis images. If
                 False, will skip any analyses that already have images.
-            kwargs: optional keyword arguments to pass onto the Neurosynth
-                meta-analysis.
+            kwargs: optional keyword arguments to pass onto
+                run_meta_analyses().
         """
         # Set up defaults
         if image_dir is None:
@@ -402,16 +567,9 @@ class DatabaseBuilder:
         if analyses is None:
             analyses = self._get_feature_names()
 
-        # Remove analyses that already exist
-        if not overwrite:
-            files = glob(
-                join(settings.IMAGE_DIR, 'analyses', '*_association-test_z.nii.gz'))
-            existing = [basename(f).split('_')[0] for f in files]
-            analyses = list(set(analyses) - set(existing))
-
         # Meta-analyze all images
-        meta.analyze_features(self.dataset, analyses, output_dir=image_dir,
-                              q=0.01, **kwargs)
+        self.run_meta_analyses(analyses, image_dir, q=0.01,
+                               overwrite=overwrite, **kwargs)
 
         # Create AnalysisImage records
         if add_to_db:
@@ -420,6 +578,113 @@ class DatabaseBuilder:
 
             self.db.session.commit()
 
+    def run_meta_analyses(self, features, output_dir, prefix=None,
+                          threshold=0.001, q=0.01, overwrite=True,
+                          processes=None):
+        """ Generate meta-analysis images for a list of features, in parallel.
+        Finished features are recorded in a manifest in output_dir, so that if
+        the build is interrupted, running it again picks up where it left off.
+        Args:
+            features: list of names of features to meta-analyze.
+            output_dir: folder in which to store images.
+            prefix: optional string to prepend to image names (followed by an
+                underscore), as in meta.analyze_features().
+            threshold: minimum frequency of a feature in a study for the study
+                to be included.
+            q: the FDR rate used for multiple comparisons correction.
+            overwrite: if True, regenerate all images. If False, skip features
+                whose images were already generated from the same studies and
+                settings (or, for images without a manifest entry, whose
+                images exist).
+            processes: number of worker processes to use. Defaults to
+                settings.BUILD_PROCESSES, or the number of CPUs.
+        Returns:
+            A list of the features that were meta-analyzed.
+        """
+        global _meta_dataset
+
+        if not exists(output_dir):
+            os.makedirs(output_dir)
+        manifest_file = join(output_dir, 'manifest.jsonl')
+
+        def _name(f):
+            return f if prefix is None else prefix + '_' + f
+
+        # Identify the inputs to each meta-analysis, so that images are
+        # regenerated when the data they're based on changes
+        activations = self.dataset.activations[['id', 'x', 'y', 'z']]
+        dataset_hash = hashlib.sha1(
+            np.ascontiguousarray(activations.values, dtype='float64')
+        ).hexdigest()
+
+        def _fingerprint(f):
+            ids = self.dataset.get_studies(features=f,
+                                           frequency_threshold=threshold)
+            payload = json.dumps([dataset_hash, sorted(int(i) for i in ids),
+                                  threshold, q])
+            return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+        fingerprints = dict((_name(f), _fingerprint(f)) for f in features)
+
+        todo = list(features)
+        if not overwrite:
+            done = set()
+            if exists(manifest_file):
+                for line in open(manifest_file):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written by a crashed build
+                    files = [join(output_dir, f) for f in entry['files']]
+                    if fingerprints.get(entry['name']) == \
+                            entry['fingerprint'] and all(map(exists, files)):
+                        done.add(entry['name'])
+                    else:
+                        done.discard(entry['name'])
+            else:
+                # Images generated before manifests were kept
+                suffix = '_association-test_z_FDR_%s.nii.gz' % q
+                existing = set(basename(f)[:-len(suffix)] for f in
+                               glob(join(output_dir, '*' + suffix)))
+                done = set(_name(f) for f in features) & existing
+            todo = [f for f in features if _name(f) not in done]
+            print("Skipping %d previously generated analyses." %
+                  (len(features) - len(todo)))
+
+        if not todo:
+            return []
+
+        jobs = [(f, _name(f), output_dir, threshold, q) for f in todo]
+        processes = processes or settings.BUILD_PROCESSES or \
+            multiprocessing.cpu_count()
+        processes = min(processes, len(jobs))
+
+        _meta_dataset = self.dataset
+        pool = None
+        try:
+            if processes > 1:
+                pool = multiprocessing.get_context('fork').Pool(processes)
+                results = pool.imap_unordered(_run_meta_analysis, jobs)
+            else:
+                results = map(_run_meta_analysis, jobs)
+
+            with open(manifest_file, 'a') as manifest:
+                for i, (name, files) in enumerate(results):
+                    manifest.write(json.dumps({
+                        'name': name,
+                        'fingerprint': fingerprints[name],
+                        'files': files}) + '\n')
+                    manifest.flush()
+                    if (i + 1) % 100 == 0:
+                        print("Generated images for %d of %d analyses..." %
+                              (i + 1, len(jobs)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _meta_dataset = None
+
+        return todo
+
     def add_genes(self, gene_dir=None, reset=True, update_images=True):
         """ Add records for genes, working from a directory containing gene
         images. """
@@ -473,7 +738,7 @@ class DatabaseBuilder:
         self.db.session.commit()
 
     def add_topics(self, generate_images=True, add_images=True, top_n=20,
-                   reset=False):
+                   reset=False, overwrite=True):
         """ Seed the database with topics.
         Args:
             generate_images (bool): if True, generates meta-analysis images for
@@ -483,6 +748,9 @@ class DatabaseBuilder:
             top_n: number of top-loading words to save.
             reset: if True, drops all existing TopicSets and TopicAnalysis
                 records before repopulating.
+            overwrite (bool): if False, topic images that were already
+                generated from the same data are kept (see
+                run_meta_analyses()).
         """
         if reset:
             for ts in AnalysisSet.query.filter_by(type='topics').all():
@@ -499,8 +767,11 @@ class DatabaseBuilder:
 
         topic_image_dir = join(settings.IMAGE_DIR, 'topics')
 
-        # Get all valid Study ids for speed
-        study_ids = [x[0] for x in set(self.db.session.query(Study.pmid).all())]
+        # Get all valid Study ids, and their number of peaks, for speed
+        counts = self.db.session.query(Study.pmid, func.count(Peak.id)) \
+            .outerjoin(Peak).group_by(Study.pmid).all()
+        study_ids = np.array([c[0] for c in counts], dtype=int)
+        n_peaks = np.array([c[1] for c in counts], dtype=int)
 
         for ts in topic_sets:
             data = json.load(open(ts))
@@ -518,10 +789,10 @@ class DatabaseBuilder:
 
             # Generate full set of topic images
             if generate_images:
-                meta.analyze_features(
-                    self.dataset, self.dataset.get_feature_names(),
-                    output_dir=topic_set_image_dir, threshold=0.05, q=0.01,
-                    prefix=data['name'])
+                self.run_meta_analyses(
+                    self.dataset.get_feature_names(), topic_set_image_dir,
+                    prefix=data['name'], threshold=0.05, q=0.01,
+                    overwrite=overwrite)
 
             ts = AnalysisSet(name=data['name'],
                              description=data['description'], n_analyses=n,
@@ -531,43 +802,38 @@ class DatabaseBuilder:
             feature_data = self.dataset.feature_table.data
             feature_names = self.dataset.get_feature_names()
 
-            for i, fn in enumerate(feature_names):
-
-                number = int(fn.split('_')[0])
-                name = '%s_%s' % (ts.name, fn)
-
-                # Disable autoflush temporarily because it causes problems
-                with self.db.session.no_autoflush:
+            topics = []
+            # Disable autoflush temporarily because it causes problems
+            with self.db.session.no_autoflush:
+                for fn in feature_names:
+                    number = int(fn.split('_')[0])
+                    name = '%s_%s' % (ts.name, fn)
                     terms = ', '.join(key_data[number].split()[2:][:top_n])
                     # Topics are not always in natsort order; get correct number
                     topic = TopicAnalysis(name=name, terms=terms, number=number)
+                    ts.analyses.append(topic)
+                    topics.append(topic)
+            self.db.session.commit()
 
-                    self.db.session.add(topic)
-                    self.db.session.commit()
-
-                    # Map onto studies
-                    freqs = feature_data[fn]
-                    above_thresh = freqs[freqs >= 0.05]
-                    srsly = 0
-                    for s_id, f in above_thresh.iteritems():
-                        s_id = int(s_id)
-                        if s_id in study_ids:
-                            srsly += 1
-                            self.db.session.add(Frequency(
-                                pmid=s_id, analysis=topic, frequency=f))
-
-                    # Update counts
-                    topic.n_studies = len(above_thresh)
-
-                    self.db.session.commit()
-
-                    if add_images:
-                        self.add_analysis_images(topic, topic_set_image_dir)
-
-                ts.analyses.append(topic)
-
+            # Map onto studies
+            freqs = self._frequency_matrix(feature_data[feature_names],
+                                           study_ids, 0.05)
+            self._bulk_insert(
+                Frequency.__table__, ['analysis_id', 'pmid', 'frequency'],
+                self._frequency_rows(freqs, study_ids,
+                                     [t.id for t in topics]))
+
+            # Update counts
+            n_studies, n_activations = self._frequency_counts(freqs, n_peaks)
+            for topic, n_s, n_a in zip(topics, n_studies, n_activations):
+                topic.n_studies = int(n_s)
+                topic.n_activations = int(n_a)
             self.db.session.commit()
 
+            if add_images:
+                for topic in topics:
+                    self.add_analysis_images(topic, topic_set_image_dir)
+
         # Restore original features
         # self.dataset.feature_table = feature_table
 
@@ -600,10 +866,41 @@ class DatabaseBuilder:
         self.db.session.commit()
 
     def memory_map_images(self, include=['terms', 'topics', 'genes'],
-                          reset=False):
+                          reset=False, dtype=None, tolerance=None,
+                          layouts=None, block_size=None, processes=None):
         """ Create memory-mapped arrays containing all image data for one or
         more AnalysisSets.
+        Args:
+            include (list): the image sets to memory-map.
+            reset (bool): if True, deletes existing DecodingSet records.
+            dtype (str): storage type of the memmaps ('float32', 'float16',
+                or 'int8'). Defaults to settings.MEMMAP_DTYPE.
+            tolerance (float): the maximum absolute difference between
+                correlations computed from quantized and float32 data. A
+                ValueError is raised if it's exceeded. Defaults to
+                settings.MEMMAP_TOLERANCE.
+            layouts (list): the memmap layouts to write. 'voxels' (one row
+                per voxel) is always written; 'images' adds an image-major
+                copy. Defaults to settings.MEMMAP_LAYOUTS.
+            block_size (int): the number of images read and written at a
+                time, which bounds memory use. Defaults to
+                settings.MEMMAP_BUILD_BLOCK_SIZE.
+            processes (int): the number of processes reading images. Defaults
+                to settings.BUILD_PROCESSES, or the number of CPUs.
         """
+        from nsweb.tasks.memmaps import quantize, quantization_error
+
+        if dtype is None:
+            dtype = settings.MEMMAP_DTYPE
+        if tolerance is None:
+            tolerance = settings.MEMMAP_TOLERANCE
+        if layouts is None:
+            layouts = settings.MEMMAP_LAYOUTS
+        layouts = ['voxels'] + [l for l in layouts if l != 'voxels']
+        if block_size is None:
+            block_size = settings.MEMMAP_BUILD_BLOCK_SIZE
+        processes = processes or settings.BUILD_PROCESSES or \
+            multiprocessing.cpu_count()
 
         mm_dir = settings.MEMMAP_DIR
         if not exists(mm_dir):
@@ -621,9 +918,17 @@ class DatabaseBuilder:
                 for ds in dec:
                     self.db.session.delete(ds)
 
-            # print term_labels
-            open(join(mm_dir, '%s_labels.txt' % name), 'w') \
-                .write('\n'.join(labels))
+            # Every file of the memmap is written under a temporary name, and
+            # only moved into place once all of them are complete, so that a
+            # failed build never mixes with the previous one.
+            files = {
+                'labels': join(mm_dir, '%s_labels.txt' % name),
+                'stats': join(mm_dir, '%s_stats.txt' % name),
+                'metadata': join(mm_dir, '%s_metadata.json' % name),
+                'voxels': join(mm_dir, '%s_images.dat' % name)
+            }
+            if 'images' in layouts:
+                files['images'] = join(mm_dir, '%s_images_t.dat' % name)
 
             sampled_vox = np.arange(mask_voxels)
             is_subsampled = (voxels is not None)
@@ -635,56 +940,119 @@ class DatabaseBuilder:
                                                    replace=False)
                 else:
                     sampled_vox = voxels
-                np.save(join(mm_dir, '%s_voxels.npy' % name), sampled_vox)
+                files['index'] = join(mm_dir, '%s_voxels.npy' % name)
 
-            # Initialize memmap
             n_images = len(images)
-            mm_file = join(mm_dir, '%s_images.dat' % name)
-            temp_map = np.zeros((len(sampled_vox), n_images), dtype='float32')
+            n_voxels = len(sampled_vox)
+
+            def remove_tmp():
+                for f in files.values():
+                    if exists(f + '.tmp'):
+                        os.remove(f + '.tmp')
+
+            with open(files['labels'] + '.tmp', 'w') as f:
+                f.write('\n'.join(labels))
+            if 'index' in files:
+                # np.save() would add .npy to the temporary name
+                with open(files['index'] + '.tmp', 'wb') as f:
+                    np.save(f, sampled_vox)
+
+            # Images are read in parallel, a block at a time, and written
+            # straight to the memmaps, so that only one block is ever held in
+            # memory.
+            mm = np.memmap(files['voxels'] + '.tmp', dtype=dtype, mode='w+',
+                           shape=(n_voxels, n_images))
+            mm_t = None
+            if 'images' in layouts:
+                mm_t = np.memmap(files['images'] + '.tmp', dtype=dtype,
+                                 mode='w+', shape=(n_images, n_voxels))
 
             # Save key image stats--will need these to reconstruct raw values
-            stats = np.zeros((n_images, 4))
-
-            # Populate with standardized image data
-            for i, img in enumerate(images):
-                if not i % 100:
-                    print("Processing image %i..." % i)
-                # Use unthresholded maps when possible
-                img_file = re.sub('_FDR_*nii.gz', '.nii.gz', img)
-                data = masker.mask(img_file)[sampled_vox]
-                std, mean = data.std(), data.mean()
-                temp_map[:, i] = (data - mean) / std
-                stats[i, :] = [data.min(), data.max(), mean, std]
+            stats = np.zeros((n_images, 5))
+            error = 0.
+
+            global _memmap_inputs
+            _memmap_inputs = (masker, sampled_vox)
+            pool = None
+            try:
+                if processes > 1:
+                    pool = multiprocessing.get_context('fork').Pool(processes)
+                load = pool.map if pool is not None else \
+                    lambda f, items: list(map(f, items))
+
+                # Reduce precision if needed, making sure the decoder will
+                # still produce (nearly) the same correlations with a sample
+                # of the images
+                if dtype != 'float32':
+                    probes = np.random.choice(n_images, min(20, n_images),
+                                              replace=False)
+                    probes = np.column_stack(
+                        [r[0] for r in load(_load_memmap_image,
+                                            [images[i] for i in probes])])
+
+                for start in range(0, n_images, block_size):
+                    stop = min(start + block_size, n_images)
+                    print("Processing images %d-%d..." % (start, stop - 1))
+                    results = load(_load_memmap_image, images[start:stop])
+                    block = np.column_stack([r[0] for r in results])
+                    data, scale = quantize(block, dtype)
+                    if dtype != 'float32':
+                        error = max(error, quantization_error(
+                            block, data, scale, probes=probes))
+                    mm[:, start:stop] = data
+                    if mm_t is not None:
+                        mm_t[start:stop] = data.T
+                    stats[start:stop, :4] = [r[1] for r in results]
+                    stats[start:stop, 4] = scale
+                    del results, block, data
+            except Exception:
+                del mm, mm_t
+                remove_tmp()
+                raise
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                _memmap_inputs = None
+
+            print("Flushing...")
+            del mm, mm_t
+
+            if dtype != 'float32':
+                print("Maximum correlation error for %s: %.5f" %
+                      (dtype, error))
+                if error > tolerance:
+                    remove_tmp()
+                    raise ValueError(
+                        "Storing the %s memmap as %s changes correlations by "
+                        "up to %.5f, which exceeds the tolerance of %.5f." %
+                        (name, dtype, error, tolerance))
 
             stats = pd.DataFrame(stats, index=labels,
-                                 columns=['min', 'max', 'mean', 'std'])
-            stats.to_csv(join(mm_dir, '%s_stats.txt' % name), sep='\t')
+                                 columns=['min', 'max', 'mean', 'std',
+                                          'scale'])
+            stats.to_csv(files['stats'] + '.tmp', sep='\t')
 
             # Write metadata
             metadata = {
                 'name': name,
-                'n_voxels': len(sampled_vox),
+                'n_voxels': n_voxels,
                 'n_images': n_images,
-                'is_subsampled': is_subsampled
+                'is_subsampled': is_subsampled,
+                'dtype': dtype,
+                'layouts': layouts
             }
-            md_file = join(mm_dir, '%s_metadata.json' % name)
-            open(md_file, 'w').write(json.dumps(metadata))
-
-            # Copy to memmap
-            print("Initializing memmap...")
-            mm = np.memmap(mm_file, dtype='float32', mode='w+',
-                           shape=(len(sampled_vox), n_images))
-            print("Storing data...")
-            mm[:] = temp_map[:]
-            print("Flushing...")
-            del mm
+            with open(files['metadata'] + '.tmp', 'w') as f:
+                f.write(json.dumps(metadata))
+
+            for f in files.values():
+                os.rename(f + '.tmp', f)
 
             # Create DB record
             self.db.session.add(
                 DecodingSet(name=name, n_images=n_images,
                             n_voxels=len(sampled_vox),
                             is_subsampled=is_subsampled,
-                            analysis_set=analysis_set))
+                            analysis_set=analysis_set, labels=labels))
             self.db.session.commit()
 
         ### TERMS ###
@@ -755,6 +1123,167 @@ class DatabaseBuilder:
             voxels = np.nonzero(voxels)[0]
             save_memmap('genes', None, images, labels, voxels)
 
+    def build_location_index(self, radii=None):
+        """ Precompute the studies reporting peaks near every in-mask voxel,
+        so location pages don't have to search the peaks.
+        Args:
+            radii (list): radii (in mm) to index. Defaults to
+                settings.LOCATION_INDEX_RADII.
+        Notes:
+            The index isn't used until publish() is called.
+        """
+        from nsweb.tasks.memmaps import MaskIndex
+        if radii is None:
+            radii = settings.LOCATION_INDEX_RADII
+        voxels = MaskIndex(self.dataset.masker).table
+        VoxelStudyIndex.write(settings.LOCATION_INDEX_DIR, voxels, radii)
+
+    def build_search_index(self):
+        """ Re-index all studies, genes, analyses and images for full-text
+        search. Writes through the ORM keep the index up to date, so this is
+        only needed after changes made behind its back. """
+        rebuild_all()
+
+    def write_dumps(self, path=None, keep=None):
+        """ Write a snapshot of the database for bulk download, as compressed
+        NumPy (.npz) files, with a manifest listing their SHA-256 checksums.
+        Each snapshot goes in its own directory, named by the time it was
+        taken; latest.json points to the newest.
+        Args:
+            path (str): directory to write snapshots to. Defaults to
+                settings.DUMP_DIR.
+            keep (int): number of snapshots to keep, including this one.
+                Defaults to settings.DUMP_KEEP.
+        Returns: The manifest of the snapshot.
+        """
+        if path is None:
+            path = settings.DUMP_DIR
+        if keep is None:
+            keep = settings.DUMP_KEEP
+        version = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        out_dir = join(path, version)
+        tmp_dir = out_dir + '.tmp'
+        if exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        session = self.db.session
+
+        def text(values):
+            return np.array(['' if v is None else v for v in values],
+                            dtype=str)
+
+        files = []
+
+        def save(filename, description, arrays):
+            np.savez_compressed(join(tmp_dir, filename), **arrays)
+            files.append({'name': filename, 'description': description})
+
+        rows = session.query(Study.pmid, Study.doi, Study.title,
+                             Study.authors, Study.journal, Study.year,
+                             Study.space).order_by(Study.pmid).all()
+        cols = list(zip(*rows)) or [[]] * 7
+        pmids = np.array(cols[0], dtype='int64')
+        save('studies.npz', 'One entry per study, by PubMed ID. Missing '
+             'years are -1.', dict(
+                 pmid=pmids, doi=text(cols[1]), title=text(cols[2]),
+                 authors=text(cols[3]), journal=text(cols[4]),
+                 year=np.array([-1 if y is None else y for y in cols[5]],
+                               dtype='int32'),
+                 space=text(cols[6])))
+
+        rows = session.query(Peak.pmid, Peak.table, Peak.x, Peak.y, Peak.z) \
+            .order_by(Peak.pmid, Peak.id).all()
+        cols = list(zip(*rows)) or [[]] * 5
+        save('peaks.npz', 'One entry per reported activation peak (MNI '
+             'coordinates, in mm).', dict(
+                 pmid=np.array(cols[0], dtype='int64'), table=text(cols[1]),
+                 x=np.array(cols[2], dtype='float32'),
+                 y=np.array(cols[3], dtype='float32'),
+                 z=np.array(cols[4], dtype='float32')))
+
+        rows = session.query(Analysis.id, Analysis.name, Analysis.type,
+                             AnalysisSet.name, Analysis.n_studies,
+                             Analysis.n_activations) \
+            .outerjoin(AnalysisSet,
+                       Analysis.analysis_set_id == AnalysisSet.id) \
+            .filter(Analysis.type.in_(['term', 'topic'])) \
+            .order_by(Analysis.id).all()
+        cols = list(zip(*rows)) or [[]] * 6
+        save('analyses.npz', 'One entry per term or topic analysis.', dict(
+             id=np.array(cols[0], dtype='int64'), name=text(cols[1]),
+             type=text(cols[2]), analysis_set=text(cols[3]),
+             n_studies=np.array(cols[4], dtype='int32'),
+             n_activations=np.array(cols[5], dtype='int32')))
+
+        # Study x term matrix, in the format of scipy.sparse.save_npz(), so
+        # that scipy.sparse.load_npz() can read it
+        terms = session.query(TermAnalysis.id, TermAnalysis.name) \
+            .order_by(TermAnalysis.name).all()
+        columns = dict((id, j) for j, (id, name) in enumerate(terms))
+        rows = session.query(Frequency.pmid, Frequency.analysis_id,
+                             Frequency.frequency) \
+            .filter(Frequency.analysis_id.in_(list(columns))).all()
+        cols = list(zip(*rows)) or [[]] * 3
+        freqs = sparse.coo_matrix(
+            (np.array(cols[2], dtype='float32'),
+             (np.searchsorted(pmids, np.array(cols[0], dtype='int64')),
+              np.array([columns[id] for id in cols[1]], dtype='int64'))),
+            shape=(len(pmids), len(terms))).tocsr()
+        save('frequencies.npz', 'Frequency of each term in each study, as a '
+             'sparse matrix (rows as in studies.npz, columns as in terms).',
+             dict(format=np.array('csr'), shape=np.array(freqs.shape),
+                  data=freqs.data, indices=freqs.indices, indptr=freqs.indptr,
+                  pmids=pmids, terms=text([t[1] for t in terms])))
+
+        labels = dict((ds.name, text(ds.labels))
+                      for ds in DecodingSet.query.all())
+        save('decoding_labels.npz', 'Labels of the reference images of each '
+             'decoding set, by set name, in the order of decoding values.',
+             labels)
+
+        # Checksums, also in a form sha256sum -c understands
+        for f in files:
+            filename = join(tmp_dir, f['name'])
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    sha.update(block)
+            f['sha256'] = sha.hexdigest()
+            f['bytes'] = os.path.getsize(filename)
+        with open(join(tmp_dir, 'SHA256SUMS'), 'w') as f:
+            f.writelines('%s  %s\n' % (f_['sha256'], f_['name'])
+                         for f_ in files)
+        manifest = {
+            'version': version,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'files': files
+        }
+        with open(join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_dir, out_dir)
+
+        # Point to the new snapshot, and remove the oldest ones
+        latest = join(path, 'latest.json')
+        with open(latest + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(latest + '.tmp', latest)
+        versions = sorted(d for d in os.listdir(path)
+                          if re.match(r'\d{8}-\d{6}$', d))
+        for old in versions[:-keep]:
+            shutil.rmtree(join(path, old))
+        return manifest
+
+    def publish(self):
+        """ Announce that the data have changed: bump the data version, so
+        clients revalidating API responses get fresh ones, and invalidate all
+        cached responses. The location index is marked as belonging to this
+        build. Call once the build is done. """
+        from nsweb.initializers.data_version import data_version
+        from nsweb.initializers.cache import bump_version
+        build = data_version.bump(build=True)
+        VoxelStudyIndex.stamp(settings.LOCATION_INDEX_DIR, build)
+        bump_version()
+
     def _filter_analyses(self, analyses):
         """ Remove any invalid analysis names """
         # Remove analyses that start with a number
@@ -1,5 +1,6 @@
 import os
 from os.path import join
+from collections import OrderedDict
 
 
 # The root location of the app. Should not need to be changed.
@@ -20,12 +21,29 @@ RESET_ASSETS = True
 # Path to pickled Neurosynth Dataset instance
 PICKLE_DATABASE = join(ASSET_DIR, 'neurosynth_dataset.pkl')
 
+# Directory of memory-mappable arrays holding the same Dataset, which loads
+# much faster than the pickle. Written by the database builder; workers fall
+# back on the pickle if it's missing or older than the pickle.
+DATASET_CACHE_DIR = join(ASSET_DIR, 'neurosynth_dataset')
+
 # Main image folder
 IMAGE_DIR = join(DATA_DIR, 'images')
 
 # Path to analysis/location flat filies
 LOCATION_ANALYSIS_DIR = join(DATA_DIR, 'locations', 'analyses')
 
+# Path to the precomputed index of studies near each voxel
+LOCATION_INDEX_DIR = join(DATA_DIR, 'locations', 'index')
+
+# File holding the current version of the data, from which the API derives
+# ETags. Written by the database builder and when custom analyses change.
+DATA_VERSION_FILE = join(DATA_DIR, 'data_version.json')
+
+# Where the database builder writes bulk data snapshots (studies, peaks,
+# frequencies, ...) for download, and how many snapshots to keep
+DUMP_DIR = join(DATA_DIR, 'dumps')
+DUMP_KEEP = 3
+
 # Static content
 STATIC_FOLDER = join(ROOT_DIR, 'nsweb', 'static')
 
@@ -40,6 +58,10 @@ TEMPLATE_FOLDER = join(ROOT_DIR, 'nsweb', 'templates')
 # column (named 'keep'). If None, all analyses are loaded into the DB.
 ANALYSIS_FILTER_FILE = None
 
+# Number of processes the database builder runs in parallel for CPU-bound
+# steps such as generating meta-analysis images. If None, uses all CPUs.
+BUILD_PROCESSES = None
+
 ### DECODER-RELATED PATHS ###
 # Path to decoded images
 DECODED_IMAGE_DIR = join(DATA_DIR, 'images', 'decoded')
@@ -47,7 +69,8 @@ DECODED_IMAGE_DIR = join(DATA_DIR, 'images', 'decoded')
 # Path to saved decoding image array--this is kept active in memory
 DECODING_DATA = join(ASSET_DIR, 'decoding.msg')
 
-# Path to output decoding results (flat .txt files)
+# Path to decoding results from older versions of the site (flat .txt files).
+# New results are stored in the database.
 DECODING_RESULTS_DIR = join(DATA_DIR, 'decoding', 'results')
 
 # Path to output decoded image scatter plots
@@ -64,6 +87,117 @@ CACHE_DECODINGS = True
 # local disk image rather than the host.
 MEMMAP_DIR = join(DATA_DIR, 'memmaps')
 
+# Storage type for memmapped reference images: 'float32', 'float16', or
+# 'int8' (scaled per image). Lower precision shrinks the memmaps by 2-4x,
+# at the cost of small errors in decoder correlations.
+MEMMAP_DTYPE = 'float32'
+
+# Maximum tolerated absolute difference between decoder correlations computed
+# from float32 and lower-precision memmaps. The build fails if it's exceeded.
+MEMMAP_TOLERANCE = 0.005
+
+# Memmap layouts to build. 'voxels' (one row per voxel) is always built and
+# serves voxel lookups and decoding; 'images' adds an image-major copy that
+# makes extracting a single map (e.g., for scatterplots) a contiguous read.
+MEMMAP_LAYOUTS = ['voxels', 'images']
+
+# Number of images read and written at a time when building a memmap. Memory
+# use during the build is about n_voxels x block size x 4 bytes (~90 MB for
+# 100 whole-brain images).
+MEMMAP_BUILD_BLOCK_SIZE = 100
+
+# Number of voxels (memmap rows) read at a time when correlating a batch of
+# images with a reference. Larger blocks mean fewer reads but more memory.
+DECODER_BLOCK_SIZE = 4096
+
+# Maximum number of images that can be decoded in a single batch request.
+DECODER_MAX_BATCH = 100
+
+# Where decoder work runs. 'local' answers voxel lookups and decodings inside
+# the web process, using the same read-only memmaps as the Celery workers;
+# 'celery' sends everything to the workers. Use 'celery' if the web server
+# can't see MEMMAP_DIR.
+DECODER_MODE = 'local'
+
+# In 'local' mode, batches with more images than this still go to Celery.
+DECODER_LOCAL_MAX_IMAGES = 10
+
+### BACKGROUND JOBS ###
+# Longest time (in seconds) a request to the jobs API can wait for a job to
+# finish before responding (long polling).
+JOB_MAX_WAIT = 30
+
+# How often (in seconds) a waiting request checks whether its job is done.
+JOB_POLL_INTERVAL = 0.5
+
+# Jobs that haven't finished this many seconds after they were started are
+# marked as failed.
+JOB_TIMEOUT = 3600
+
+# Redis server holding the locks that stop concurrent requests from starting
+# the same expensive task more than once. If None, locks are only shared
+# within each web process.
+SINGLE_FLIGHT_URL = 'redis://redis:6379/1'
+
+# Seconds after which a lock expires, in case the process holding it dies.
+SINGLE_FLIGHT_TIMEOUT = 120
+
+# Longest time (in seconds) to wait for another request to release a lock
+# before going ahead anyway.
+SINGLE_FLIGHT_WAIT = 60
+
+# Seconds between checks for peaks added to or removed from the database by
+# other processes (e.g., the database builder), after which the in-memory
+# peak index used for location queries is rebuilt.
+PEAK_INDEX_REFRESH = 300
+
+# Radii (in mm) at which studies near each voxel are precomputed. Location
+# queries at other radii (the location page offers 1-20 mm) are answered from
+# the in-memory peak index instead, which is slower but still doesn't query
+# the database. The index grows with the cube of the radius: at 6 mm (the
+# default radius) it takes a few hundred MB, so indexing every radius up to
+# 20 mm isn't practical.
+LOCATION_INDEX_RADII = [6]
+
+
+### RESPONSE CACHE ###
+# Redis server holding cached API responses, shared by all web processes. If
+# None, each process keeps its own cache in memory (as in tests).
+CACHE_REDIS_URL = 'redis://redis:6379/2'
+
+# Cached values larger than this many bytes (pickled) are compressed.
+CACHE_COMPRESS_MIN = 1024
+
+# When a value is missing, the first request to ask for it computes it while
+# others wait up to CACHE_LOCK_WAIT seconds (checking every CACHE_LOCK_POLL
+# seconds) for it to be stored. The lock expires after CACHE_LOCK_TIMEOUT
+# seconds, in case the request holding it dies.
+CACHE_LOCK_TIMEOUT = 30
+CACHE_LOCK_WAIT = 10
+CACHE_LOCK_POLL = 0.1
+
+# How eagerly values are recomputed before they expire. Higher values refresh
+# earlier; 0 disables early refreshes.
+CACHE_EARLY_REFRESH = 1.0
+
+# Seconds between checks for a new cache version (bumped to invalidate all
+# cached responses when the data change).
+CACHE_VERSION_CHECK = 5
+
+# Seconds between writes of each process's hit/miss counts to Redis.
+CACHE_STATS_FLUSH = 10
+
+
+# Row counts shown by searchable tables (e.g., studies) are cached for this
+# many seconds, or until the data version changes. Counts of search results
+# stop at DATATABLE_COUNT_CAP rows, so that broad searches stay cheap.
+DATATABLE_CACHE_TIMEOUT = 3600
+DATATABLE_COUNT_CAP = 10000
+
+# Bulk exports read this many rows from the database at a time, and write
+# their output in chunks of about EXPORT_CHUNK_SIZE characters.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 65536
 
 ### CONTENT-SPECIFIC DIRECTORIES ###
 MASK_DIR = join(IMAGE_DIR, 'masks')
@@ -95,6 +229,48 @@ LOGGING_LEVEL = 'DEBUG'
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
+# Queues that background tasks are routed to, each served by its own workers
+# (see docker-compose.yml). Quick tasks that users wait on go to
+# 'interactive'; everything else goes to 'heavy', so that a backlog of long
+# jobs never holds up the quick ones. decode_images only reaches Celery for
+# batches too big to decode in-process, so it's always a long job. Unlisted
+# tasks go to the first queue.
+CELERY_TASK_QUEUES = OrderedDict([
+    ('interactive', ['decode_image', 'get_voxel_data']),
+    ('heavy', ['decode_images', 'save_uploaded_image',
+               'get_studies_by_expression', 'make_coactivation_map',
+               'make_scatterplot', 'run_metaanalysis'])
+])
+
+# Soft and hard time limits (in seconds) for each task. When the soft limit
+# is reached the task fails; at the hard limit, the process running it is
+# killed. Tasks not listed here get the worker's default limit.
+CELERY_TASK_TIME_LIMITS = {
+    'save_uploaded_image': (30, 45),
+    'decode_image': (30, 45),
+    'decode_images': (120, 150),
+    'get_voxel_data': (10, 15),
+    'get_studies_by_expression': (30, 45),
+    'make_coactivation_map': (600, 660),
+    'make_scatterplot': (300, 360),
+    'run_metaanalysis': (900, 960)
+}
+
+# Resources that workers for each queue load before they start taking tasks
+# (and before they fork their pool processes, which then share them). Any of
+# 'dataset', 'masker', 'mask_index', 'masks', 'references' and 'anatomical'.
+# A worker serving several queues loads the resources of all of them.
+# Anything else is loaded by the first task that needs it.
+WORKER_PRELOAD = {
+    'interactive': ['masker', 'mask_index', 'masks', 'references'],
+    'heavy': ['masker', 'mask_index', 'masks', 'anatomical', 'references',
+              'dataset']
+}
+
+# Queues whose workers read the reference memmaps into the page cache at
+# startup.
+WORKER_TOUCH_MEMMAPS = ['interactive']
+
 ### Flask-Mail settings ###
 MAIL_ENABLE = True
 MAIL_USERNAME = os.getenv('MAIL_USERNAME', 'email@example.com')
@@ -1,9 +1,14 @@
 import datetime
 from nsweb.core import db
+from nsweb.initializers import settings
 from nsweb.models.users import User
 from nsweb.models.analyses import AnalysisSet
 from nsweb.models.images import Image
+from nsweb.models.jobs import Job
 from sqlalchemy.ext.hybrid import hybrid_property
+from os.path import join, exists
+import numpy as np
+import pandas as pd
 import json
 
 
@@ -18,6 +23,24 @@ class DecodingSet(db.Model):
     n_images = db.Column(db.Integer)
     n_voxels = db.Column(db.Integer)
     is_subsampled = db.Column(db.Boolean)
+    _labels = db.Column('labels', db.Text, nullable=True)
+
+    @property
+    def labels(self):
+        """ Names of the reference images, in the order in which decoding
+        values are stored. """
+        if self._labels is not None:
+            return self._labels.split('\n')
+        # Fall back on the memmap labels for sets built before labels were
+        # stored in the DB
+        lab_file = join(settings.MEMMAP_DIR, self.name + '_labels.txt')
+        if exists(lab_file):
+            return open(lab_file).read().splitlines()
+        return []
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = '\n'.join(labels)
 
 
 class Decoding(db.Model):
@@ -26,12 +49,14 @@ class Decoding(db.Model):
     url = db.Column(db.String(255), nullable=True)
     neurovault_id = db.Column(db.String(100), nullable=True)
     filename = db.Column(db.String(200))
+    image_hash = db.Column(db.String(40), nullable=True, index=True)
     uuid = db.Column(db.String(32), unique=True)
     name = db.Column(db.String(200))
     comments = db.Column(db.Text, nullable=True)
     display = db.Column(db.Boolean)
     download = db.Column(db.Boolean)
     _data = db.Column('data', db.Text, nullable=True)
+    _values = db.Column('results', db.LargeBinary, nullable=True)
     ip = db.Column(db.String(15))
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     image_decoded_at = db.Column(db.DateTime,
@@ -49,6 +74,9 @@ class Decoding(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=True)
     user = db.relationship(
         User, backref=db.backref('uploads', cascade='all, delete-orphan'))
+    # Background job computing the results, when not decoded in-process
+    job_id = db.Column(db.String(36), db.ForeignKey(Job.id), nullable=True)
+    job = db.relationship(Job, backref=db.backref('decodings'))
 
     @hybrid_property
     def data(self):
@@ -57,3 +85,56 @@ class Decoding(db.Model):
     @data.setter
     def data(self, value):
         self._data = json.dumps(value)
+
+    @property
+    def values(self):
+        """ Decoding results as a float32 vector, ordered like the labels of
+        the DecodingSet. """
+        if self._values is None:
+            return None
+        return np.frombuffer(self._values, dtype='float32')
+
+    @values.setter
+    def values(self, values):
+        self._values = np.asarray(values, dtype='float32').tobytes()
+
+    def get_series(self):
+        """ Return decoding results as a pandas Series indexed by image name,
+        or None if there are no results. """
+        if self._values is not None:
+            return pd.Series(self.values, index=self.decoding_set.labels)
+        return self._read_results_file()
+
+    def top(self, k=10):
+        """ Return the k reference images most similar to this image. """
+        series = self.get_series()
+        return None if series is None else series.nlargest(k)
+
+    @classmethod
+    def get_values(cls, uuids):
+        """ Return results for many decodings at once as a pandas DataFrame,
+        with reference images in rows and decoding uuids in columns. """
+        decs = cls.query.filter(cls.uuid.in_(uuids)).all()
+        series = {}
+        for dec in decs:
+            s = dec.get_series()
+            if s is not None:
+                series[dec.uuid] = s
+        cols = [u for u in uuids if u in series]
+        return pd.DataFrame(series, columns=cols)
+
+    def _read_results_file(self):
+        # Results of decodings run before values were stored in the DB live
+        # in flat text files.
+        res_file = join(settings.DECODING_RESULTS_DIR, self.uuid + '.txt')
+        if not exists(res_file):
+            return None
+        data = {}
+        for line in open(res_file).read().splitlines():
+            f, v = (line.split('\t') + [''])[:2]
+            try:
+                data[f] = float(v)
+            except ValueError:
+                data[f] = np.nan
+        data.pop('', None)  # header row, if any
+        return pd.Series(data)
@@ -0,0 +1,31 @@
+import datetime
+from nsweb.core import db
+import json
+
+
+class Job(db.Model):
+    ''' A Celery task submitted on behalf of a web request. Clients poll the
+    job through the jobs API instead of holding a request open until the
+    task finishes. '''
+    id = db.Column(db.String(36), primary_key=True)  # Celery task id
+    kind = db.Column(db.String(20))
+    # Hash of the task name and arguments, so that requests for the same
+    # result can share a job
+    key = db.Column(db.String(255), nullable=True, index=True)
+    _params = db.Column('params', db.Text, nullable=True)
+    status = db.Column(db.String(20), default='pending')
+    result_url = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def params(self):
+        return {} if self._params is None else json.loads(self._params)
+
+    @params.setter
+    def params(self, params):
+        self._params = json.dumps(params)
+
+    @property
+    def pending(self):
+        return self.status == 'pending'
@@ -0,0 +1,153 @@
+from nsweb.core import db
+from nsweb.models.analyses import TermAnalysis, TopicAnalysis
+from nsweb.models.genes import Gene
+from nsweb.initializers.data_version import data_version
+from bisect import bisect_left
+from itertools import islice
+import re
+import string
+import threading
+
+KINDS = ['term', 'topic', 'gene']
+
+# Characters tried when looking for misspelled names
+ALPHABET = string.ascii_lowercase + string.digits + ' -'
+
+
+class NameRegistry(object):
+    ''' In-memory registry of the names of terms, topics and genes (symbols),
+    for autocompletion and for looking names up without the database. It's
+    built on first use, and rebuilt whenever the data version changes.
+
+    Names are kept as a sorted list of lowercase keys--one for the whole name
+    and one starting at each later word--so that the names starting with a
+    prefix, or having a word that does, are found by binary search. '''
+
+    def __init__(self):
+        self._data = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def _entries(self):
+        entries = []
+        for kind, model in [('term', TermAnalysis), ('topic', TopicAnalysis)]:
+            entries += [(kind, id, name, n or 0) for id, name, n in
+                        db.session.query(model.id, model.name,
+                                         model.n_studies)]
+        entries += [('gene', id, symbol, 0) for id, symbol in
+                    db.session.query(Gene.id, Gene.symbol)]
+        return entries
+
+    def load(self, entries=None):
+        ''' (Re)build the registry.
+        Args:
+            entries (list): tuples of (kind, id, name, weight), where weight
+                ranks otherwise equally good matches (e.g., the number of
+                studies of a term). Defaults to all terms, topics and genes in
+                the database.
+        '''
+        version = data_version.get()
+        if entries is None:
+            entries = self._entries()
+        entries = [e for e in entries if e[2]]
+        keys = []
+        for i, (kind, id, name, weight) in enumerate(entries):
+            name = name.lower()
+            keys.append((name, i, False))
+            for m in re.finditer(r'[\s_/-]+', name):
+                if m.end() < len(name):
+                    keys.append((name[m.end():], i, True))
+        keys.sort()
+        ids = {}
+        for kind, id, name, weight in entries:
+            ids.setdefault((kind, name), id)
+        self._data = (entries, [k[0] for k in keys],
+                      [k[1:] for k in keys], ids)
+        self._token = version and version[0]
+
+    def _get_data(self):
+        version = data_version.get()
+        token = version and version[0]
+        with self._lock:
+            if self._data is None or token != self._token:
+                self.load()
+            return self._data
+
+    def find(self, name, kind):
+        ''' Return the id of the term, topic or gene with exactly the given
+        name (or symbol), or None if there isn't one. '''
+        return self._get_data()[3].get((kind, name))
+
+    def names(self, kind):
+        ''' Return all names of the given kind, in alphabetical order. '''
+        return sorted(e[2] for e in self._get_data()[0] if e[0] == kind)
+
+    def _scan(self, data, prefix):
+        # Positions of the entries with a key starting with prefix, and
+        # whether the key is a later word of the name
+        entries, keys, refs, ids = data
+        j = bisect_left(keys, prefix)
+        while j < len(keys) and keys[j].startswith(prefix):
+            yield refs[j]
+            j += 1
+
+    @staticmethod
+    def _edits(word):
+        ''' All strings one deletion, transposition, substitution or insertion
+        away from word. '''
+        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        edits = set(a + b[1:] for a, b in splits if b)
+        edits.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+        edits.update(a + c + b[1:] for a, b in splits if b for c in ALPHABET)
+        edits.update(a + c + b for a, b in splits for c in ALPHABET)
+        edits.discard(word)
+        return edits
+
+    def complete(self, query, kinds=None, limit=10, fuzzy=True):
+        ''' Find the names best matching what the user has typed so far.
+        Args:
+            query (str): the text typed
+            kinds (list): the kinds of names to include. Defaults to all.
+            limit (int): maximum number of matches to return
+            fuzzy (bool): if True and there are fewer than limit matches,
+                also return names that start with a one-letter misspelling of
+                query (for queries of at least three characters)
+        Returns: A list of dicts of the name, kind and id of each match, best
+            first: exact matches, then names starting with query, names with
+            a later word starting with query, and finally misspelled names.
+            Ties are broken by weight.
+        '''
+        query = query.lower().strip()
+        if not query:
+            return []
+        data = self._get_data()
+        entries = data[0]
+        scores = {}
+
+        def add(i, quality):
+            kind, id, name, weight = entries[i]
+            if kinds is not None and kind not in kinds:
+                return
+            score = (quality, weight, -len(name))
+            if score > scores.get(i, (-1,)):
+                scores[i] = score
+
+        for i, word in self._scan(data, query):
+            exact = not word and entries[i][2].lower() == query
+            add(i, 3 if exact else 1 if word else 2)
+
+        if fuzzy and len(scores) < limit and len(query) >= 3:
+            for edit in self._edits(query):
+                if len(edit) < 3:
+                    continue
+                for i, word in islice(self._scan(data, edit), limit):
+                    if i not in scores:
+                        add(i, 0)
+
+        best = sorted(scores, key=lambda i: (
+            [-s for s in scores[i]], entries[i][2]))[:limit]
+        return [dict(name=entries[i][2], kind=entries[i][0], id=entries[i][1])
+                for i in best]
+
+
+name_registry = NameRegistry()
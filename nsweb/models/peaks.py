@@ -1,4 +1,15 @@
 from nsweb.core import db
+from nsweb.initializers import settings
+from nsweb.initializers.data_version import data_version
+from sqlalchemy import func, event
+from nsweb.tasks.memmaps import xyz_to_ijk, ijk_to_xyz, in_volume
+from scipy.spatial import cKDTree
+from os.path import join, exists, dirname, getmtime
+import numpy as np
+import json
+import os
+import threading
+import time
 
 
 class Peak(db.Model):
@@ -22,3 +33,246 @@ class Peak(db.Model):
                          cls.y <= y+radius, cls.y >= y-radius,
                          cls.z <= z+radius, cls.z >= z-radius,
                          (x-cls.x)*(x-cls.x)+(y-cls.y)*(y-cls.y)+(z-cls.z)*(z-cls.z) <= radius**2)
+
+
+class PeakIndex(object):
+    ''' In-memory spatial index (a KD-tree) over the coordinates of all peaks,
+    for radius queries that don't touch the database. The index is built on
+    first use, and rebuilt when peaks are added or removed--immediately for
+    changes made by this process, and otherwise within
+    settings.PEAK_INDEX_REFRESH seconds. '''
+
+    def __init__(self):
+        self._data = None
+        self._signature = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.stale = False
+
+    def _current_signature(self):
+        return tuple(db.session.query(func.count(Peak.id),
+                                      func.max(Peak.id)).one())
+
+    def load(self):
+        ''' (Re)build the index from the database. '''
+        signature = self._current_signature()
+        rows = db.session.query(Peak.id, Peak.pmid, Peak.x, Peak.y, Peak.z) \
+            .filter(Peak.pmid != None).order_by(Peak.id).all()
+        rows = np.array(rows, dtype='float64').reshape(-1, 5)
+        ids = rows[:, 0].astype(int)
+        pmids = rows[:, 1].astype(int)
+        xyz = rows[:, 2:]
+
+        # Flag repeats of a peak within a study (same rounded coordinates),
+        # keeping the first one
+        _, first = np.unique(np.column_stack([pmids, np.round(xyz, 2)]),
+                             axis=0, return_index=True)
+        distinct = np.zeros(len(ids), dtype=bool)
+        distinct[first] = True
+
+        tree = cKDTree(xyz) if len(ids) else None
+        self._data = (tree, ids, pmids, xyz, distinct)
+        self._signature = signature
+        self._checked_at = time.time()
+        self.stale = False
+
+    def _get_data(self):
+        with self._lock:
+            expired = time.time() - self._checked_at > \
+                settings.PEAK_INDEX_REFRESH
+            if self._data is None or self.stale:
+                self.load()
+            elif expired:
+                if self._current_signature() != self._signature:
+                    self.load()
+                self._checked_at = time.time()
+            return self._data
+
+    def _find(self, x, y, z, radius):
+        # Positions of the peaks in the sphere, nearest first, and their
+        # squared distances from the center
+        tree, ids, pmids, xyz, keep = self._get_data()
+        if tree is None:
+            return np.array([], dtype=int), np.array([])
+        center = np.array([x, y, z], dtype='float64')
+        found = np.array(tree.query_ball_point(center, radius + 1e-6),
+                         dtype=int)
+        d2 = ((xyz[found] - center) ** 2).sum(axis=1)
+        mask = d2 <= radius ** 2
+        found, d2 = found[mask], d2[mask]
+        order = np.argsort(d2, kind='mergesort')
+        return found[order], d2[order]
+
+    def query(self, x, y, z, radius, distinct=False):
+        ''' Find the peaks within radius mm of x, y, z.
+        Args:
+            x, y, z (float): coordinates of the center of the sphere
+            radius (float): radius of the sphere, in mm
+            distinct (bool): if True, peaks that repeat an earlier peak of the
+                same study at the same coordinates are left out.
+        Returns: A tuple of arrays of (peak ids, pmids, distances), ordered by
+            increasing distance.
+        '''
+        tree, ids, pmids, xyz, keep = self._get_data()
+        found, d2 = self._find(x, y, z, radius)
+        if distinct:
+            found, d2 = found[keep[found]], d2[keep[found]]
+        return ids[found], pmids[found], np.sqrt(d2)
+
+    def studies(self, x, y, z, radius):
+        ''' Find the studies reporting peaks within radius mm of x, y, z.
+        Returns: A tuple of arrays of (pmids, number of peaks, number of
+            distinct peaks), nearest study first.
+        '''
+        tree, ids, pmids, xyz, keep = self._get_data()
+        found, d2 = self._find(x, y, z, radius)
+        studies, first, inverse = np.unique(
+            pmids[found], return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(studies))
+        distinct = np.bincount(inverse, weights=keep[found],
+                               minlength=len(studies)).astype(int)
+        order = np.argsort(first)
+        return studies[order], counts[order], distinct[order]
+
+
+class VoxelStudyIndex(object):
+    ''' Precomputed results of PeakIndex.studies() for every in-mask voxel of
+    the 2 mm grid, at each radius in settings.LOCATION_INDEX_RADII. Written by
+    the database builder (see write()) as compressed sparse rows--one row per
+    voxel--in .npy files that are memory-mapped on first use.
+
+    Results are only used while the index belongs to the current build of the
+    database: the builder stamps it with the build token when it publishes the
+    data (see stamp()), and the index is ignored once another build has been
+    published. Checking this only reads the data version file, so answering
+    from the index never touches the database or the PeakIndex. For stale
+    indexes, and for other coordinates or radii (the UI accepts any radius
+    from 1 to 20 mm, but only LOCATION_INDEX_RADII are indexed), studies()
+    returns None, and callers should fall back on the PeakIndex. '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = None
+        self._mtime = None
+
+    def _meta_file(self):
+        return join(self.path or settings.LOCATION_INDEX_DIR, 'index.json')
+
+    def _get_data(self):
+        meta_file = self._meta_file()
+        mtime = getmtime(meta_file) if exists(meta_file) else None
+        if mtime != self._mtime:
+            self._data = self._load(meta_file) if mtime else None
+            self._mtime = mtime
+        return self._data
+
+    def _load(self, meta_file):
+        path = dirname(meta_file)
+        meta = json.load(open(meta_file))
+
+        def _load_array(name):
+            return np.load(join(path, name + '.npy'), mmap_mode='r')
+
+        radii = dict((r, [_load_array('r%d_%s' % (r, a)) for a in
+                          ['indptr', 'pmids', 'counts', 'distinct']])
+                     for r in meta['radii'])
+        return meta.get('build'), _load_array('voxels'), radii
+
+    def studies(self, x, y, z, radius):
+        ''' Return the same (pmids, counts, distinct counts) tuple as
+        PeakIndex.studies(), or None if the result isn't in the index. '''
+        data = self._get_data()
+        if data is None:
+            return None
+        build, voxels, radii = data
+        # Only grid points are indexed
+        if radius not in radii or any(v != int(v) or int(v) % 2
+                                      for v in (x, y, z)):
+            return None
+        if build is None or build != data_version.build():
+            return None
+        if not in_volume([x, y, z]):
+            return None
+        row = voxels[tuple(xyz_to_ijk([x, y, z]))]
+        if row < 0:
+            return None
+        indptr, pmids, counts, distinct = radii[radius]
+        start, stop = indptr[row], indptr[row + 1]
+        return (np.asarray(pmids[start:stop]),
+                np.asarray(counts[start:stop]),
+                np.asarray(distinct[start:stop]))
+
+    @classmethod
+    def write(cls, path, voxels, radii, index=None):
+        ''' Build the index.
+        Args:
+            path (str): the directory to write the index to
+            voxels (ndarray): a volume in the 2 mm MNI space that maps each
+                voxel to be indexed onto a row number (and all others onto
+                -1)--e.g., the table of a MaskIndex.
+            radii (list): the radii (in mm) to index
+            index (PeakIndex): the peaks to index. Defaults to all peaks in
+                the database.
+        '''
+        if index is None:
+            index = PeakIndex()
+        if not exists(path):
+            os.makedirs(path)
+
+        rows = voxels[voxels >= 0]
+        ijk = np.argwhere(voxels >= 0)[np.argsort(rows)]
+        xyz = ijk_to_xyz(ijk)
+
+        for r in radii:
+            pmids, counts, distinct = [], [], []
+            indptr = np.zeros(len(xyz) + 1, dtype='int64')
+            for i, (x, y, z) in enumerate(xyz):
+                found = index.studies(x, y, z, r)
+                pmids.append(found[0])
+                counts.append(found[1])
+                distinct.append(found[2])
+                indptr[i + 1] = indptr[i] + len(found[0])
+            arrays = {
+                'indptr': indptr,
+                'pmids': np.concatenate(pmids).astype('int32'),
+                'counts': np.concatenate(counts).astype('uint16'),
+                'distinct': np.concatenate(distinct).astype('uint16')
+            }
+            for name, data in arrays.items():
+                np.save(join(path, 'r%d_%s.npy' % (r, name)), data)
+
+        np.save(join(path, 'voxels.npy'), voxels.astype('int32'))
+        # Written last; readers reload the index when it changes
+        cls._write_meta(path, {'radii': list(radii), 'build': None})
+
+    @staticmethod
+    def _write_meta(path, meta):
+        tmp_file = join(path, 'index.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_file, join(path, 'index.json'))
+
+    @classmethod
+    def stamp(cls, path, build):
+        ''' Mark the index in path as belonging to a build of the database,
+        given its token (see DataVersion.build()). Does nothing if there's no
+        index. '''
+        meta_file = join(path, 'index.json')
+        if not exists(meta_file):
+            return
+        with open(meta_file) as f:
+            meta = json.load(f)
+        meta['build'] = build
+        cls._write_meta(path, meta)
+
+
+peak_index = PeakIndex()
+voxel_index = VoxelStudyIndex()
+
+
+def _mark_stale(mapper, connection, target):
+    peak_index.stale = True
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Peak, _event, _mark_stale)
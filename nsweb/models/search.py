@@ -0,0 +1,209 @@
+''' Full-text search over studies, genes, analyses and images.
+
+Each index is a table of the searchable text of one model, keyed by the
+model's primary key: an FTS5 table in SQLite, and a weighted tsvector with a
+GIN index in PostgreSQL. Searches match every word of the query as a prefix
+(so 'work mem' finds 'working memory'), and results are ranked by relevance,
+with matches in earlier fields counting for more.
+
+Indexes are created and dropped along with the other tables, and kept up to
+date by ORM writes. Rows inserted or deleted in bulk, bypassing the ORM (as
+by the database builder), are only picked up by rebuild().
+'''
+
+from nsweb.core import db
+from nsweb.models.studies import Study
+from nsweb.models.genes import Gene
+from nsweb.models.analyses import Analysis
+from nsweb.models.images import Image
+from sqlalchemy import event, inspect, text, column, func, or_, Integer, Float
+import re
+
+# Weights of the fields of an index, in order
+WEIGHTS = ['A', 'B', 'C', 'D']
+BM25_WEIGHTS = [8.0, 4.0, 2.0, 1.0]
+
+
+class SearchIndex(object):
+    ''' A full-text index over some text fields of a model.
+    Args:
+        name (str): name of the table holding the index
+        model: the model class to index
+        fields (list): names of the columns to index, most important first
+    '''
+
+    def __init__(self, name, model, fields):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        mapper = inspect(model)
+        self.pk = mapper.primary_key[0]
+        self._pk_key = mapper.get_property_by_column(self.pk).key
+
+    ### SQL ###
+    def _document(self, values):
+        # tsvector of the given SQL values of the fields, weighted by position
+        return ' || '.join(
+            "setweight(to_tsvector('simple', coalesce(%s, '')), '%s')"
+            % (v, w) for v, w in zip(values, WEIGHTS))
+
+    def _sql(self, dialect, statement):
+        name, fields = self.name, self.fields
+        table = self.model.__table__.name
+        columns = ', '.join(fields)
+        if dialect == 'sqlite':
+            return {
+                'create': ["CREATE VIRTUAL TABLE IF NOT EXISTS %s USING "
+                           "fts5(%s, prefix='2 3')" % (name, columns)],
+                'drop': ['DROP TABLE IF EXISTS %s' % name],
+                'clear': ['DELETE FROM %s' % name],
+                'fill': ['INSERT INTO %s (rowid, %s) SELECT %s, %s FROM %s'
+                         % (name, columns, self.pk.name, columns, table)],
+                'insert': ['INSERT INTO %s (rowid, %s) VALUES (:id, %s)'
+                           % (name, columns,
+                              ', '.join(':' + f for f in fields))],
+                'delete': ['DELETE FROM %s WHERE rowid = :id' % name],
+                'ids': 'SELECT rowid AS id FROM %s WHERE %s MATCH :query'
+                       % (name, name),
+                'match': 'SELECT rowid AS id, -bm25(%s, %s) AS rank FROM %s '
+                         'WHERE %s MATCH :query'
+                         % (name, ', '.join(str(w) for w in
+                                            BM25_WEIGHTS[:len(fields)]),
+                            name, name)
+            }[statement]
+        return {
+            'create': ['CREATE TABLE IF NOT EXISTS %s (id integer '
+                       'PRIMARY KEY, document tsvector)' % name,
+                       'CREATE INDEX IF NOT EXISTS %s_document ON %s USING '
+                       'gin(document)' % (name, name)],
+            'drop': ['DROP TABLE IF EXISTS %s' % name],
+            'clear': ['DELETE FROM %s' % name],
+            'fill': ['INSERT INTO %s (id, document) SELECT %s, %s FROM %s'
+                     % (name, self.pk.name, self._document(fields), table)],
+            'insert': ['INSERT INTO %s (id, document) VALUES (:id, %s)'
+                       % (name, self._document(
+                           ['CAST(:%s AS text)' % f for f in fields]))],
+            'delete': ['DELETE FROM %s WHERE id = :id' % name],
+            'ids': "SELECT id FROM %s WHERE document @@ to_tsquery('simple', "
+                   ":query)" % name,
+            'match': "SELECT id, ts_rank(document, to_tsquery('simple', "
+                     ":query)) AS rank FROM %s WHERE document @@ "
+                     "to_tsquery('simple', :query)" % name
+        }[statement]
+
+    def _execute(self, connection, statement, **params):
+        for sql in self._sql(connection.dialect.name, statement):
+            connection.execute(text(sql), params)
+
+    ### Maintenance ###
+    def create(self, connection):
+        self._execute(connection, 'create')
+
+    def drop(self, connection):
+        self._execute(connection, 'drop')
+
+    def rebuild(self):
+        ''' Re-index all rows of the model. '''
+        with db.engine.begin() as connection:
+            self._execute(connection, 'create')
+            self._execute(connection, 'clear')
+            self._execute(connection, 'fill')
+
+    def _write(self, connection, target, delete=True, insert=True):
+        row = {'id': getattr(target, self._pk_key)}
+        if delete:
+            self._execute(connection, 'delete', **row)
+        if insert:
+            row.update((f, getattr(target, f)) for f in self.fields)
+            self._execute(connection, 'insert', **row)
+
+    def listen(self):
+        ''' Keep the index up to date as the ORM writes rows of the model. '''
+        def after_insert(mapper, connection, target):
+            self._write(connection, target, delete=False)
+
+        def after_update(mapper, connection, target):
+            state = inspect(target)
+            if any(state.attrs[f].history.has_changes() for f in self.fields):
+                self._write(connection, target)
+
+        def after_delete(mapper, connection, target):
+            self._write(connection, target, insert=False)
+
+        for name, listener in [('after_insert', after_insert),
+                               ('after_update', after_update),
+                               ('after_delete', after_delete)]:
+            event.listen(self.model, name, listener, propagate=True)
+
+    ### Searching ###
+    def _match(self, query, rank=True):
+        ''' Subquery of the ids (and, if rank is True, ranks) of the rows
+        matching a query, or None if the query has no words to search for. '''
+        words = re.findall(r'\w+', query.lower(), re.UNICODE)
+        if not words:
+            return None
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            query = ' '.join('"%s"*' % w for w in words)
+        else:
+            query = ' & '.join('%s:*' % w for w in words)
+        columns = [column('id', Integer)]
+        if rank:
+            columns.append(column('rank', Float))
+        sql = self._sql(dialect, 'match' if rank else 'ids')
+        return text(sql).bindparams(query=query).columns(*columns)
+
+    def matches(self, query):
+        ''' Return a filter for the rows matching a search query (None if the
+        query has no words to search for). '''
+        found = self._match(query, rank=False)
+        return None if found is None else self.pk.in_(found)
+
+    def search(self, query, search, extra=None):
+        ''' Filter a query of the model to the rows matching a search query,
+        best matches first.
+        Args:
+            query: the query to filter
+            search (str): the search query
+            extra: an optional filter for rows to include as well (after all
+                matches)
+        '''
+        found = self._match(search)
+        if found is None:
+            return query if extra is None else query.filter(extra)
+        found = found.alias(self.name + '_match')
+        match = found.c.id != None
+        query = query.outerjoin(found, self.pk == found.c.id) \
+            .filter(match if extra is None else or_(match, extra))
+        return query.order_by(func.coalesce(found.c.rank, 0).desc())
+
+
+study_search = SearchIndex('study_search', Study,
+                           ['title', 'authors', 'journal'])
+gene_search = SearchIndex('gene_search', Gene, ['symbol', 'name', 'synonyms'])
+analysis_search = SearchIndex('analysis_search', Analysis, ['name'])
+image_search = SearchIndex('image_search', Image, ['label', 'description'])
+
+INDEXES = [study_search, gene_search, analysis_search, image_search]
+
+
+def rebuild_all():
+    ''' Re-index everything. '''
+    for index in INDEXES:
+        index.rebuild()
+
+
+def _create_all(target, connection, **kwargs):
+    for index in INDEXES:
+        index.create(connection)
+
+
+def _drop_all(target, connection, **kwargs):
+    for index in INDEXES:
+        index.drop(connection)
+
+
+event.listen(db.metadata, 'after_create', _create_all)
+event.listen(db.metadata, 'before_drop', _drop_all)
+for _index in INDEXES:
+    _index.listen()
@@ -4,6 +4,7 @@ from neurosynth import Masker
 from neurosynth.base.dataset import Dataset
 from neurosynth.analysis import meta
 from celery.utils import cached_property
+from celery.signals import worker_init, worker_process_init
 import numpy as np
 import pandas as pd
 import nibabel as nb
@@ -12,10 +13,15 @@ from nsweb.core import celery
 from os import unlink
 from os.path import join, exists
 from nsweb.tasks.scatterplot import scatter
+from nsweb.tasks.memmaps import Reference, MaskIndex, xyz_to_ijk
+from nsweb.tasks.dataset_cache import load_dataset, is_current
 import traceback
 from glob import glob
+import os
 import json
-from collections import OrderedDict
+import gc
+import mmap
+import time
 
 
 MASK_FILES = {
@@ -35,7 +41,7 @@ def load_image(masker, filename, save_resampled=True):
     img = nb.load(filename)
     if img.shape[:3] != (91, 109, 91):
         img = resample_img(
-            img, target_affine=decode_image.anatomical.get_affine(),
+            img, target_affine=resources.anatomical.get_affine(),
             target_shape=(91, 109, 91), interpolation='nearest')
         if save_resampled:
             unlink(filename)
@@ -45,45 +51,29 @@ def load_image(masker, filename, save_resampled=True):
 
 def xyz_to_mat(foci):
     """ Convert an N x 3 array of XYZ coordinates to matrix indices. """
-    foci = np.hstack((foci, np.ones((foci.shape[0], 1))))
-    mat = np.array([[-0.5, 0, 0, 45], [0, 0.5, 0, 63], [0, 0, 0.5, 36]]).T
-    result = np.dot(foci, mat)  # multiply
-    return np.round_(result).astype(int)  # need to round indices to ints
+    return xyz_to_ijk(foci)
 
 
-class Reference(object):
-
-    def __init__(self, name, n_voxels, n_images, is_subsampled):
-
-        self.name = name
-        self.n_voxels = n_voxels
-        self.n_images = n_images
-        self.is_subsampled = is_subsampled
-
-        # Link to memmap data
-        mm_file = join(settings.MEMMAP_DIR, name + '_images.dat')
-        self.data = np.memmap(mm_file, dtype='float32', mode='r',
-                              shape=(n_voxels, n_images))
-        # Link to labels
-        lab_file = join(settings.MEMMAP_DIR, name + '_labels.txt')
-        _labels = open(lab_file).read().splitlines()
-        self.labels = OrderedDict(zip(_labels, range(len(_labels))))
-
-        # Image stats
-        stat_file = join(settings.MEMMAP_DIR, name + '_stats.txt')
-        self.stats = pd.read_csv(stat_file, sep='\t')
-
-
-class NeurosynthTask(Task):
+class Resources(object):
+    """ Data and images needed by the decoder and analysis tasks. Everything
+    is loaded lazily, and only once per process; the same instance is shared
+    by all Celery tasks and by the in-process DecoderEngine. """
 
     @cached_property
     def dataset(self):
+        if is_current(settings.DATASET_CACHE_DIR, settings.PICKLE_DATABASE):
+            return load_dataset(settings.DATASET_CACHE_DIR)
         return Dataset.load(settings.PICKLE_DATABASE)
 
     @cached_property
     def masker(self):
         return Masker(join(settings.IMAGE_DIR, 'anatomical.nii.gz'))
 
+    @cached_property
+    def mask_index(self):
+        """ Lookup table from MNI coordinates to rows of masked data. """
+        return MaskIndex(self.masker)
+
     @cached_property
     def references(self):
         """ For efficiency, cache indices of all labels in all memmaps."""
@@ -111,52 +101,261 @@ class NeurosynthTask(Task):
             maps[m] = load_image(self.masker, img)
         return maps
 
+    def touch_memmaps(self):
+        """ Read a byte from every page of the reference memmaps, so that
+        they're in the page cache (and mapped) before the first query. Returns
+        the number of bytes mapped. """
+        total = 0
+        for ref in self.references.values():
+            for data in (ref.data, ref.image_data):
+                if data is None:
+                    continue
+                pages = data.reshape(-1).view('uint8')[::mmap.PAGESIZE]
+                pages.sum(dtype='int64')
+                total += data.nbytes
+        return total
+
+    def warm_up(self, include=None, touch_memmaps=None, quiet=False):
+        """ Load resources ahead of the first task.
+        Args:
+            include (list): names of the resources to load. Defaults to those
+                in settings.WORKER_PRELOAD for the queues this worker serves.
+            touch_memmaps (bool): whether to also read the reference memmaps
+                into the page cache. Defaults to True if one of the queues
+                is in settings.WORKER_TOUCH_MEMMAPS.
+            quiet (bool): if True, only report failures.
+        """
+        queues = worker_queues()
+        if include is None:
+            include = []
+            for queue in queues:
+                include += [r for r in settings.WORKER_PRELOAD.get(queue, [])
+                            if r not in include]
+        if touch_memmaps is None:
+            touch_memmaps = bool(set(queues) &
+                                 set(settings.WORKER_TOUCH_MEMMAPS))
+        start = time.time()
+        for name in include:
+            try:
+                getattr(self, name)
+            except Exception:
+                print("Failed to preload %s:" % name)
+                print(traceback.format_exc())
+        n_bytes = 0
+        if touch_memmaps and 'references' in include:
+            n_bytes = self.touch_memmaps()
+        if not quiet:
+            print("Worker resources ready in %.1fs (%s; %d MB of memmaps)." %
+                  (time.time() - start, ', '.join(include),
+                   n_bytes // 2 ** 20))
+
+
+def worker_queues():
+    """ The queues this worker serves, as set in CELERY_QUEUES by
+    scripts/run_celery.sh. Defaults to all queues. """
+    queues = os.environ.get('CELERY_QUEUES')
+    if not queues:
+        return list(settings.CELERY_TASK_QUEUES)
+    return [q.strip() for q in queues.split(',') if q.strip()]
+
+
+resources = Resources()
+
+
+@worker_init.connect
+def preload_resources(**kwargs):
+    """ Load resources in the main worker process, before it forks the pool,
+    so that pool processes start warm and share the loaded data. """
+    resources.warm_up()
+    # Keep the garbage collector from touching (and thereby copying) the
+    # preloaded objects in every pool process
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+@worker_process_init.connect
+def check_resources(**kwargs):
+    """ Make sure pool processes have everything loaded. This is a no-op
+    for resources inherited from the main process. """
+    resources.warm_up(touch_memmaps=False, quiet=True)
+
+
+class NeurosynthTask(Task):
+
+    @property
+    def dataset(self):
+        return resources.dataset
+
+    @property
+    def masker(self):
+        return resources.masker
+
+    @property
+    def mask_index(self):
+        return resources.mask_index
+
+    @property
+    def references(self):
+        return resources.references
+
+    @property
+    def anatomical(self):
+        return resources.anatomical
+
+    @property
+    def masks(self):
+        return resources.masks
+
+    def report_progress(self, current, total, message=None):
+        """ Publish progress for the jobs API. Does nothing when the task is
+        called directly instead of being run by a worker. """
+        if self.request.id is None:
+            return
+        self.update_state(state='PROGRESS', meta={
+            'current': current, 'total': total, 'message': message})
+
 
 @celery.task(base=NeurosynthTask)
 def save_uploaded_image(filename, **kwargs):
     pass
 
 
+def load_decoder_data(masker, ref, filename, drop_zeros=False):
+    """ Load an image and standardize it for comparison with a reference.
+    Args:
+        masker (Masker): the Masker used to vectorize the image
+        ref (Reference): the memmapped image set the image will be compared to
+        filename (str): the local path to the image
+        drop_zeros (bool): if True, only non-zero, non-NA voxels in the input
+            map are retained.
+    Returns: A tuple of (voxels, data), where voxels indexes the rows of the
+        reference that were retained and data holds the standardized values.
+    """
+    data = load_image(masker, filename)
+    # Select voxels in sampling mask if it exists
+    if ref.is_subsampled:
+        data = data[ref.voxels]
+
+    # Drop voxels with zeros or NaN in input image
+    voxels = np.arange(len(data))
+    if drop_zeros:
+        voxels = np.where((data != 0) & np.isfinite(data))[0]
+        data = data[voxels]
+    # Otherwise we still need to replace NaNs or bad things happen
+    data = np.nan_to_num(data)
+
+    # standardize image
+    data = (data - data.mean()) / data.std()
+    return voxels, data
+
+
+def decode_files(filenames, reference, drop_zeros=False, progress=None):
+    """ Decode one or more image files in a single pass over the reference.
+    Args:
+        filenames (list): local paths to the images
+        reference (str): the name of the memmapped image set to compare with
+        drop_zeros (bool): if True, only non-zero, non-NA voxels in each input
+            map are used in the comparison.
+        progress (callable): optional function called with the number of
+            steps completed, the total number of steps, and a message.
+    Returns: A list with one entry per image: a float32 vector of
+        correlations with the reference images (in reference label order),
+        or None if the image couldn't be decoded.
+    """
+    ref = resources.references[reference]
+    data = np.zeros((ref.n_voxels, len(filenames)), dtype='float32')
+    loaded = []
+    n_steps = len(filenames) + 1
+    for i, f in enumerate(filenames):
+        if progress is not None:
+            progress(i, n_steps, 'Loading images')
+        try:
+            voxels, img = load_decoder_data(resources.masker, ref, f,
+                                            drop_zeros)
+        except Exception:
+            print(traceback.format_exc())
+            continue
+        # Dropped voxels stay at zero, so they don't contribute to the
+        # dot product--equivalent to decoding each image separately.
+        data[voxels, i] = img
+        loaded.append(i)
+
+    results = [None] * len(filenames)
+    if loaded:
+        if progress is not None:
+            progress(n_steps - 1, n_steps, 'Comparing with reference images')
+        r = ref.correlate(data[:, loaded])
+        for j, i in enumerate(loaded):
+            results[i] = r[:, j]
+    return results
+
+
+def voxel_data(reference, x, y, z, get_pp=True):
+    """ Return the values at an MNI coordinate for all images in a reference.
+    Args:
+        reference (str): the type of reference to use--e.g., 'terms'
+        x, y, z (int): MNI coordinates
+        get_pp (bool): if True, also returns posterior probabilities, when
+            the reference has them.
+    Returns: A pandas DataFrame with images in rows, and z-scores (and
+        posterior probabilities) in columns.
+    """
+    x, y, z = int(x), int(y), int(z)
+    ind = resources.mask_index.xyz_to_rows([[x, y, z]])
+
+    # Subsampled references (e.g., genes) have no '_full' suffix
+    references = resources.references
+    ref = references.get(reference + '_full', references.get(reference))
+    labels = list(ref.labels.keys())
+
+    def _voxel_values(ref, name):
+        # Voxels that aren't in the reference get missing values
+        rows = ref.find_rows(ind)
+        if not len(rows) or rows[0] < 0:
+            values = np.full(ref.n_images, np.nan)
+        else:
+            values = ref.rows(rows[:1]).ravel()
+        values = values * ref.stats['std'].values + ref.stats['mean'].values
+        return pd.Series(values, index=labels, name=name)
+
+    result = _voxel_values(ref, 'z').to_frame()
+
+    # Can get posterior probs as well
+    if get_pp and reference + '_pp_unif' in references:
+        _pp = _voxel_values(references[reference + '_pp_unif'], 'pp')
+        result = pd.concat([result, _pp], axis=1)
+    return result
+
+
 @celery.task(base=NeurosynthTask)
-def decode_image(filename, reference, uuid, mask=None, drop_zeros=False,
-                 **kwargs):
+def decode_image(filename, reference, mask=None, drop_zeros=False, **kwargs):
     """ Decode an image file.
     Args:
         filename (str): the local path to the image
         reference (dict): the name of the memmapped image set to compare with
-        uuid (str): a unique identifier to use when writing the file
         mask (str): the name of an optional mask to use (e.g., 'subcortex')
         drop_zeros (bool): if True, only non-zero, non-NA voxels in the input
             map are used in the comparison.
+    Returns: A list of correlations with the reference images, or False if
+        decoding failed.
     """
-    mm_dir = settings.MEMMAP_DIR
     try:
-        ref = decode_image.references[reference]
-
-        # Load and standardize the target image
-        data = load_image(decode_image.masker, filename)
-        # Select voxels in sampling mask if it exists
-        if ref.is_subsampled:
-            index_file = join(mm_dir, ref.name + '_voxels.npy')
-            if exists(index_file):
-                voxels = np.load(index_file)
-                data = data[voxels]
-
-        # Drop voxels with zeros or NaN in input image
-        voxels = np.arange(len(data))
-        if drop_zeros:
-            voxels = np.where((data != 0) & np.isfinite(data))[0]
-            data = data[voxels]
-        # Otherwise we still need to replace NaNs or bad things happen
-        data = np.nan_to_num(data)
-
-        # standardize image and get correlation
-        data = (data - data.mean()) / data.std()
-        r = np.dot(ref.data[voxels].T, data) / ref.n_voxels
-        outfile = join(settings.DECODING_RESULTS_DIR, uuid + '.txt')
-        labels = list(ref.labels.keys())
-        pd.Series(r, index=labels).to_csv(outfile, sep='\t')
-        return True
+        r = decode_files([filename], reference, drop_zeros)[0]
+        return False if r is None else r.tolist()
+    except Exception as e:
+        print(traceback.format_exc())
+        return False
+
+
+@celery.task(base=NeurosynthTask)
+def decode_images(filenames, reference, drop_zeros=False, **kwargs):
+    """ Decode a batch of image files in a single pass over the reference.
+    See decode_files() for arguments. Returns a list with either a list of
+    correlations or False for each image. """
+    try:
+        results = decode_files(filenames, reference, drop_zeros,
+                               progress=decode_images.report_progress)
+        return [False if r is None else r.tolist() for r in results]
     except Exception as e:
         print(traceback.format_exc())
         return False
@@ -169,25 +368,7 @@ def get_voxel_data(reference, x, y, z, get_pp=True):
     given DecodingSet--e.g., get z-score values of all term-based analyses.
     """
     try:
-        x, y, z = int(x), int(y), int(z)
-        ijk = xyz_to_mat(np.array([[x, y, z]]))
-        space = np.zeros((91, 109, 91))
-        space[tuple(ijk[0])] = 1
-        ind = np.nonzero(get_voxel_data.masker.mask(space))[0]
-
-        ref = get_voxel_data.references[reference + '_full']
-        labels = list(ref.labels.keys())
-        result = pd.Series(ref.data[ind, :].ravel(), index=labels, name='z')
-        result = result * ref.stats['std'].values + ref.stats['mean'].values
-
-        # Can get posterior probs as well
-        if get_pp:
-            ref = get_voxel_data.references[reference + '_pp_unif']
-            _pp = pd.Series(ref.data[ind, :].ravel(), index=labels, name='pp')
-            _pp = _pp * ref.stats['std'].values + ref.stats['mean'].values
-            result = pd.concat([result, _pp], axis=1)
-        return result.to_json()
-
+        return voxel_data(reference, x, y, z, get_pp).to_json()
     except Exception:
         print(traceback.format_exc())
         return False
@@ -197,10 +378,13 @@ def get_voxel_data(reference, x, y, z, get_pp=True):
 def make_coactivation_map(x, y, z, r=6, min_studies=0.01):
     """ Generate a coactivation map on-the-fly for the given seed voxel. """
     try:
+        make_coactivation_map.report_progress(0, 2, 'Selecting studies')
         dataset = make_coactivation_map.dataset
         ids = dataset.get_studies(peaks=[[x, y, z]], r=r)
         if len(ids) < 50:
             return False
+        make_coactivation_map.report_progress(
+            1, 2, 'Running meta-analysis of %d studies' % len(ids))
         ma = meta.MetaAnalysis(dataset, ids, min_studies=min_studies)
         outdir = join(settings.IMAGE_DIR, 'coactivation')
         prefix = 'metaanalytic_coactivation_%s_%s_%s' % (
@@ -237,10 +421,11 @@ def make_scatterplot(filename, analysis, base_id, reference='terms_full',
     """
     try:
         # Get the data
+        make_scatterplot.report_progress(0, 2, 'Loading images')
         x = load_image(make_scatterplot.masker, filename)
         # y = get_decoder_analysis_data(make_scatterplot.dd, analysis)
         ref = make_scatterplot.references[reference]
-        y = ref.data[:, ref.labels[analysis]]
+        y = ref.column(ref.labels[analysis])
 
         # Subsample random voxels
         if n_voxels is not None:
@@ -267,6 +452,7 @@ def make_scatterplot(filename, analysis, base_id, reference='terms_full',
             voxel_count_mask = None
 
         region_masks = [masks[l] for l in region_labels]
+        make_scatterplot.report_progress(1, 2, 'Plotting')
 
         scatter(x, y, region_masks=region_masks, mask_labels=region_labels,
                 unlabeled_alpha=0.15, alpha=0.5, fig_size=(12, 12),
@@ -287,6 +473,8 @@ def run_metaanalysis(ids, name):
         name (string): name of the analysis; used in filename of output images
     """
     try:
+        run_metaanalysis.report_progress(
+            0, 1, 'Running meta-analysis of %d studies' % len(ids))
         ma = meta.MetaAnalysis(run_metaanalysis.dataset, ids)
         outdir = join(settings.IMAGE_DIR, 'custom')
         ma.save_results(outdir, name, image_list=['association-test_z_FDR_0.01',
@@ -0,0 +1,145 @@
+""" A fast-loading cache of the Neurosynth Dataset.
+
+Unpickling the Dataset takes several seconds, and gives every process a
+private copy of the activations, the image table and the feature table. The
+cache instead stores those tables as .npy files that are memory-mapped on
+load, so that a Dataset is reconstructed almost instantly and its data are
+shared by all processes through the page cache. Everything else (the Masker,
+smoothing radius, etc.) is small, and is pickled as usual.
+"""
+
+from scipy import sparse
+import numpy as np
+import pandas as pd
+from os.path import join, exists, getmtime
+from collections import OrderedDict
+import copy
+import json
+import os
+import pickle
+import shutil
+
+
+def _to_python(value):
+    """ Convert numpy scalars to JSON-serializable Python values. """
+    if pd.isnull(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _save_csr(path, name, matrix):
+    matrix = sparse.csr_matrix(matrix)
+    for attr in ['data', 'indices', 'indptr']:
+        np.save(join(path, '%s_%s.npy' % (name, attr)), getattr(matrix, attr))
+    return list(matrix.shape)
+
+
+def _load_csr(path, name, shape):
+    arrays = [np.load(join(path, '%s_%s.npy' % (name, attr)), mmap_mode='r')
+              for attr in ['data', 'indices', 'indptr']]
+    return sparse.csr_matrix(tuple(arrays), shape=tuple(shape), copy=False)
+
+
+def save_dataset(dataset, path):
+    """ Write a Dataset to a cache directory, replacing any existing cache.
+    The directory is written under a temporary name and then moved into
+    place, so readers never see a partial cache. """
+    tmp_path = path + '.tmp'
+    if exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # Activations: numeric columns are stored as is, and text columns (which
+    # mostly repeat study details across peaks) as codes into a list of values
+    activations = dataset.activations
+    columns = []
+    for i, col in enumerate(activations.columns):
+        values = activations[col]
+        if values.dtype.kind in 'biuf':
+            np.save(join(tmp_path, 'activations_%d.npy' % i), values.values)
+            columns.append({'name': col, 'values': None})
+        else:
+            codes, uniques = pd.factorize(values)
+            np.save(join(tmp_path, 'activations_%d.npy' % i),
+                    codes.astype('int32'))
+            # Missing values get a code of -1
+            columns.append({'name': col,
+                            'values': [_to_python(v) for v in uniques]})
+
+    metadata = {'activations': columns}
+
+    # Pickle everything but the large tables
+    shell = copy.copy(dataset)
+    shell.activations = None
+    image_table = getattr(dataset, 'image_table', None)
+    if image_table is not None:
+        metadata['image_table'] = _save_csr(tmp_path, 'images',
+                                            image_table.data)
+        shell.image_table = copy.copy(image_table)
+        shell.image_table.data = None
+    feature_table = getattr(dataset, 'feature_table', None)
+    if feature_table is not None:
+        data = feature_table.data
+        try:
+            values = data.sparse.to_coo()
+        except AttributeError:
+            # Not a sparse DataFrame
+            values = data.values
+        metadata['feature_table'] = {
+            'shape': _save_csr(tmp_path, 'features', values),
+            'index': [_to_python(i) for i in data.index],
+            'columns': list(data.columns)
+        }
+        shell.feature_table = copy.copy(feature_table)
+        shell.feature_table.data = None
+        shell.feature_table.dataset = shell
+    with open(join(tmp_path, 'dataset.pkl'), 'wb') as f:
+        pickle.dump(shell, f, -1)
+
+    # Written last, and used to tell when the cache was built
+    with open(join(tmp_path, 'dataset.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    if exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_dataset(path):
+    """ Reconstruct a Dataset from a cache directory written by
+    save_dataset(). The large tables are memory-mapped read-only. """
+    metadata = json.load(open(join(path, 'dataset.json')))
+    dataset = pickle.load(open(join(path, 'dataset.pkl'), 'rb'))
+
+    columns = OrderedDict()
+    for i, col in enumerate(metadata['activations']):
+        values = np.load(join(path, 'activations_%d.npy' % i), mmap_mode='r')
+        if col['values'] is not None:
+            values = np.array(col['values'] + [np.nan], dtype=object)[values]
+        columns[col['name']] = values
+    dataset.activations = pd.DataFrame(columns)
+
+    if 'image_table' in metadata:
+        dataset.image_table.data = _load_csr(path, 'images',
+                                             metadata['image_table'])
+    if 'feature_table' in metadata:
+        ft = metadata['feature_table']
+        values = _load_csr(path, 'features', ft['shape'])
+        try:
+            # Some versions of pandas leave out zeros as missing values
+            data = pd.DataFrame.sparse.from_spmatrix(
+                values, index=ft['index'], columns=ft['columns']).fillna(0.0)
+        except AttributeError:
+            # Older pandas
+            data = pd.DataFrame(values.toarray(), index=ft['index'],
+                                columns=ft['columns']).to_sparse()
+        dataset.feature_table.data = data
+    return dataset
+
+
+def is_current(path, source):
+    """ Whether a cache exists and was written after the source pickle. """
+    meta_file = join(path, 'dataset.json')
+    if not exists(meta_file):
+        return False
+    return not exists(source) or getmtime(meta_file) >= getmtime(source)
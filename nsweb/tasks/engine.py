@@ -0,0 +1,86 @@
+""" In-process access to the decoder for the web workers.
+
+Voxel lookups and most decodings are a memmap slice or a single matrix
+product, so sending them through the Celery broker and result backend costs
+more than the computation itself. The DecoderEngine opens the same read-only
+memmaps as the Celery workers and answers these requests directly, falling
+back to Celery for jobs that are too big to run inside a web request.
+"""
+
+from nsweb.initializers import settings
+from nsweb import tasks
+import numpy as np
+import traceback
+
+
+class DecoderEngine(object):
+    """ Runs decoder operations either in-process or via Celery.
+    Args:
+        mode (str): 'local' to run in the current process, or 'celery' to
+            always dispatch to the Celery workers. Defaults to
+            settings.DECODER_MODE.
+        max_local_images (int): batches with more images than this are
+            always sent to Celery. Defaults to
+            settings.DECODER_LOCAL_MAX_IMAGES.
+    """
+
+    def __init__(self, mode=None, max_local_images=None):
+        self._mode = mode
+        self._max_local_images = max_local_images
+
+    @property
+    def mode(self):
+        mode = self._mode or settings.DECODER_MODE
+        if mode not in ('local', 'celery'):
+            raise ValueError("DECODER_MODE must be either 'local' or "
+                             "'celery'.")
+        return mode
+
+    @property
+    def max_local_images(self):
+        if self._max_local_images is not None:
+            return self._max_local_images
+        return settings.DECODER_LOCAL_MAX_IMAGES
+
+    def runs_locally(self, n_images=1):
+        """ Whether a job involving n_images images runs in-process. """
+        return self.mode == 'local' and n_images <= self.max_local_images
+
+    def get_voxel_data(self, reference, x, y, z, get_pp=True):
+        """ Return JSON-serialized values at the given voxel for all images in
+        the reference, or False if the lookup failed. """
+        if not self.runs_locally():
+            return tasks.get_voxel_data.delay(reference, x, y, z,
+                                              get_pp).wait()
+        try:
+            return tasks.voxel_data(reference, x, y, z, get_pp).to_json()
+        except Exception:
+            print(traceback.format_exc())
+            return False
+
+    def decode_image(self, filename, reference, drop_zeros=False):
+        """ Decode a single image. Returns a float32 vector of correlations
+        with the reference images, or None if decoding failed. """
+        return self.decode_images([filename], reference, drop_zeros)[0]
+
+    def decode_images(self, filenames, reference, drop_zeros=False):
+        """ Decode a batch of images. Returns a list with a vector of
+        correlations (or None, on failure) for each image. """
+        if not self.runs_locally(len(filenames)):
+            if len(filenames) == 1:
+                results = [tasks.decode_image.delay(
+                    filenames[0], reference, drop_zeros=drop_zeros).wait()]
+            else:
+                results = tasks.decode_images.delay(
+                    filenames, reference, drop_zeros=drop_zeros).wait()
+            results = results or [False] * len(filenames)
+            return [np.array(r, dtype='float32') if r else None
+                    for r in results]
+        try:
+            return tasks.decode_files(filenames, reference, drop_zeros)
+        except Exception:
+            print(traceback.format_exc())
+            return [None] * len(filenames)
+
+
+engine = DecoderEngine()
@@ -0,0 +1,229 @@
+""" Memory-mapped reference image sets used by the decoder. """
+
+from nsweb.initializers import settings
+import numpy as np
+import pandas as pd
+from os.path import join, exists
+from collections import OrderedDict
+
+
+# Dimensions of the 2 mm MNI volume all images are stored in
+MNI_SHAPE = (91, 109, 91)
+
+# Storage types supported for reference memmaps. Lower precision types trade
+# a small loss of accuracy for a smaller page cache footprint.
+MEMMAP_DTYPES = ('float32', 'float16', 'int8')
+
+
+def quantize(data, dtype='float32'):
+    """ Convert an n_voxels x n_images array of standardized image data to
+    the requested storage type.
+    Args:
+        data (ndarray): standardized image data, one image per column
+        dtype (str): one of 'float32', 'float16', or 'int8'. Int8 images are
+            scaled individually so that the largest absolute value in each
+            column maps onto 127.
+    Returns: A tuple of (quantized data, scale factors), where multiplying each
+        column of the quantized data by its scale factor recovers (an
+        approximation to) the original values.
+    """
+    if dtype not in MEMMAP_DTYPES:
+        raise ValueError("Memmap dtype must be one of %s." %
+                         ', '.join(MEMMAP_DTYPES))
+    scale = np.ones(data.shape[1], dtype='float32')
+    if dtype == 'int8':
+        scale = np.abs(data).max(axis=0) / 127.
+        scale[scale == 0] = 1.
+        data = np.round(data / scale)
+    return data.astype(dtype), scale.astype('float32')
+
+
+def quantization_error(data, quantized, scale, n_probes=20, probes=None):
+    """ Return the largest absolute difference between correlations computed
+    from full-precision and quantized data. Correlations are computed against
+    a random sample of the images themselves, which is what the decoder does
+    when a Neurosynth map is decoded. To check data a block of images at a
+    time, pass the same probe images (an n_voxels x n_probes array of
+    standardized data) with each block.
+    """
+    n_voxels, n_images = data.shape
+    if probes is None:
+        probes = np.random.choice(n_images, min(n_probes, n_images),
+                                  replace=False)
+        probes = data[:, probes]
+    probes = np.asarray(probes, dtype='float32')
+    r_full = np.dot(data.T, probes) / n_voxels
+    r_quant = np.dot(quantized.T.astype('float32'), probes) / n_voxels
+    r_quant *= scale[:, None]
+    return np.abs(r_full - r_quant).max()
+
+
+def xyz_to_ijk(xyz):
+    """ Convert MNI coordinates to matrix indices in the 2 mm MNI volume.
+    Args:
+        xyz: a single x/y/z triple, or an N x 3 array of coordinates.
+    Returns: An integer array with the same shape as the input.
+    """
+    xyz = np.asarray(xyz, dtype='float64')
+    ijk = xyz * [-0.5, 0.5, 0.5] + [45, 63, 36]
+    return np.round(ijk).astype(int)  # need to round indices to ints
+
+
+def ijk_to_xyz(ijk):
+    """ Convert matrix indices in the 2 mm MNI volume to MNI coordinates. """
+    ijk = np.asarray(ijk, dtype='float64')
+    return ((ijk - [45, 63, 36]) / [-0.5, 0.5, 0.5]).astype(int)
+
+
+def in_volume(xyz):
+    """ Whether MNI coordinates fall inside the 2 mm MNI volume. """
+    ijk = xyz_to_ijk(xyz)
+    return np.all((ijk >= 0) & (ijk < MNI_SHAPE), axis=-1)
+
+
+class MaskIndex(object):
+    """ Lookup table mapping positions in the MNI volume onto rows of masked
+    image data (i.e., rows of a full reference memmap).
+
+    Building the table runs the Masker once; after that, finding the row for
+    any number of coordinates is a single array lookup.
+    """
+
+    def __init__(self, masker):
+        # Mask a volume whose values are the (1-based) flat voxel indices, so
+        # the masked vector tells us where each in-mask voxel came from.
+        n = int(np.prod(MNI_SHAPE))
+        volume = np.arange(1, n + 1, dtype='float64').reshape(MNI_SHAPE)
+        flat = np.round(masker.mask(volume)).astype(int) - 1
+        table = np.full(n, -1, dtype='int32')
+        table[flat] = np.arange(len(flat), dtype='int32')
+        self.table = table.reshape(MNI_SHAPE)
+        self.n_voxels = len(flat)
+
+    def ijk_to_rows(self, ijk):
+        """ Return the mask row(s) for one or more i/j/k matrix indices.
+        Indices outside the volume or the mask map onto -1. """
+        ijk = np.asarray(ijk, dtype=int)
+        single = (ijk.ndim == 1)
+        ijk = np.atleast_2d(ijk)
+        valid = np.all((ijk >= 0) & (ijk < MNI_SHAPE), axis=1)
+        rows = np.full(len(ijk), -1, dtype='int32')
+        i, j, k = ijk[valid].T
+        rows[valid] = self.table[i, j, k]
+        return int(rows[0]) if single else rows
+
+    def xyz_to_rows(self, xyz):
+        """ Return the mask row(s) for one or more MNI coordinates. Points
+        outside the volume or the mask map onto -1. """
+        return self.ijk_to_rows(xyz_to_ijk(xyz))
+
+
+class Reference(object):
+    """ A memmapped set of standardized images.
+
+    Images are always stored voxel-major (one row per voxel), which makes
+    voxel lookups and full correlations cheap. References built with the
+    'images' layout also have an image-major copy (one row per image), which
+    is used whenever a single image is extracted, so that a map can be read
+    contiguously instead of touching every page of the voxel-major file.
+    """
+
+    def __init__(self, name, n_voxels, n_images, is_subsampled,
+                 dtype='float32', layouts=('voxels',), **kwargs):
+
+        self.name = name
+        self.n_voxels = n_voxels
+        self.n_images = n_images
+        self.is_subsampled = is_subsampled
+        self.dtype = dtype
+        self.layouts = list(layouts)
+
+        # Link to memmap data
+        mm_file = join(settings.MEMMAP_DIR, name + '_images.dat')
+        self.data = np.memmap(mm_file, dtype=dtype, mode='r',
+                              shape=(n_voxels, n_images))
+
+        # Link to image-major copy, if available
+        self.image_data = None
+        if 'images' in self.layouts:
+            mm_file = join(settings.MEMMAP_DIR, name + '_images_t.dat')
+            self.image_data = np.memmap(mm_file, dtype=dtype, mode='r',
+                                        shape=(n_images, n_voxels))
+
+        # Link to labels
+        lab_file = join(settings.MEMMAP_DIR, name + '_labels.txt')
+        _labels = open(lab_file).read().splitlines()
+        self.labels = OrderedDict(zip(_labels, range(len(_labels))))
+
+        # Image stats
+        stat_file = join(settings.MEMMAP_DIR, name + '_stats.txt')
+        self.stats = pd.read_csv(stat_file, sep='\t')
+
+        # Per-image scale factors for quantized data
+        self.scale = None
+        if 'scale' in self.stats.columns and dtype == 'int8':
+            self.scale = self.stats['scale'].values.astype('float32')
+
+    @property
+    def voxels(self):
+        """ Indices of the in-mask voxels stored in the reference. """
+        if not hasattr(self, '_voxels'):
+            index_file = join(settings.MEMMAP_DIR, self.name + '_voxels.npy')
+            if self.is_subsampled and exists(index_file):
+                self._voxels = np.load(index_file)
+            else:
+                self._voxels = np.arange(self.n_voxels)
+        return self._voxels
+
+    def find_rows(self, voxels):
+        """ Map in-mask voxel indices onto rows of the reference. Voxels that
+        aren't stored in the reference (e.g., because it's subsampled) map
+        onto -1. """
+        voxels = np.asarray(voxels)
+        if not self.is_subsampled:
+            return np.where(voxels < self.n_voxels, voxels, -1)
+        order = np.argsort(self.voxels)
+        pos = np.searchsorted(self.voxels, voxels, sorter=order)
+        pos = np.minimum(pos, len(order) - 1)
+        rows = order[pos]
+        return np.where(self.voxels[rows] == voxels, rows, -1)
+
+    def rows(self, voxels):
+        """ Return standardized values for all images at the given voxels. """
+        data = np.asarray(self.data[voxels], dtype='float32')
+        if self.scale is not None:
+            data *= self.scale
+        return data
+
+    def column(self, index):
+        """ Return the standardized values for a single image. """
+        if self.image_data is not None:
+            data = np.asarray(self.image_data[index], dtype='float32')
+        else:
+            data = np.asarray(self.data[:, index], dtype='float32')
+        if self.scale is not None:
+            data *= self.scale[index]
+        return data
+
+    def correlate(self, data, block_size=None):
+        """ Correlate one or more standardized images with all reference
+        images. The memmap is streamed in blocks of rows, so each block is
+        read from disk once no matter how many images are being decoded.
+        Args:
+            data (ndarray): an n_voxels x n_targets array of standardized
+                images
+            block_size (int): number of voxels to read from the memmap at a
+                time
+        Returns: An n_images x n_targets array of correlations.
+        """
+        if block_size is None:
+            block_size = settings.DECODER_BLOCK_SIZE
+        data = np.asarray(data, dtype='float32')
+        r = np.zeros((self.n_images, data.shape[1]), dtype='float32')
+        for start in range(0, self.n_voxels, block_size):
+            stop = start + block_size
+            block = np.asarray(self.data[start:stop], dtype='float32')
+            r += np.dot(block.T, data[start:stop])
+        if self.scale is not None:
+            r *= self.scale[:, None]
+        return r / self.n_voxels
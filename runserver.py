@@ -1,9 +1,14 @@
 from nsweb.core import create_app, app
+from nsweb.models.peaks import peak_index
 
 
 # set up the flask app
 create_app()
 
+# Build the in-memory peak index before serving requests
+with app.app_context():
+    peak_index.load()
+
 
 def main():
 
@@ -1,3 +1,13 @@
 #!/bin/sh
 
-celery worker --autoscale=10,3 --app=nsweb.core:celery --workdir=/code --time-limit=60 --logfile=/logs/celery.log
+# Usage: run_celery.sh [queue]
+# Starts a worker for one task queue (see CELERY_TASK_QUEUES in settings), or
+# for all queues if none is given. The number of processes and the number of
+# tasks each one reserves ahead of time can be set with CELERY_AUTOSCALE
+# (max,min) and CELERY_PREFETCH.
+QUEUE=${1:-interactive,heavy}
+NAME=${1:-all}
+# Tells the worker which resources to preload (see WORKER_PRELOAD in settings)
+export CELERY_QUEUES=$QUEUE
+
+celery worker --autoscale=${CELERY_AUTOSCALE:-10,3} --prefetch-multiplier=${CELERY_PREFETCH:-1} -Ofair --queues=$QUEUE --hostname=$NAME@%h --app=nsweb.core:celery --workdir=/code --time-limit=60 --logfile=/logs/celery-$NAME.log
@@ -43,10 +43,11 @@ def main():
 
     print("Adding feature-based meta-analysis images...")
     builder.generate_analysis_images(
-        analyses=analyses, add_to_db=False, overwrite=True)
+        analyses=analyses, add_to_db=False, overwrite=False)
 
     print("Adding topic sets...")
-    builder.add_topics(generate_images=True, add_images=True, reset=True, top_n=40)
+    builder.add_topics(generate_images=True, add_images=True, reset=True, top_n=40,
+                       overwrite=False)
 
     # print "Adding cognitive atlas information for available terms..."
     # builder.add_cognitive_atlas_nodes()
@@ -57,6 +58,18 @@ def main():
     print("Memory-mapping key image sets...")
     builder.memory_map_images(include=['terms', 'topics', 'genes'], reset=True)
 
+    print("Indexing studies near each voxel...")
+    builder.build_location_index()
+
+    print("Indexing for full-text search...")
+    builder.build_search_index()
+
+    print("Writing bulk data snapshots...")
+    builder.write_dumps()
+
+    print("Publishing new data version...")
+    builder.publish()
+
 
 
 if __name__ == '__main__':
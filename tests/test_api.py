@@ -83,3 +83,27 @@ def test_decode_api():
     assert float(dec['id'])
     assert float(dec['neurovault_id'])
 
+    # Decodings can be retrieved by image content hash
+    by_hash = get_json(url + '?hash=%s' % dec['image_hash'])
+    assert by_hash['id'] == dec['id']
+
+
+def test_batch_decode_api():
+
+    url = api_url + '/decode/batch'
+
+    # Results come in the order of the request
+    decs = get_json(url + '?neurovault=4933&image=1,-1')
+    assert len(decs) == 3
+    assert 'reward' in decs[0]['values']
+    assert float(decs[1]['id'])
+    assert decs[2]['status'] == 404
+
+    # Repeated images are decoded once, and bad IDs only fail their entry
+    decs = get_json(url + '?image=1,abc,1')
+    assert decs[0]['id'] == decs[2]['id']
+    assert decs[1]['status'] == 400
+
+    # Batch results should match single-image decoding
+    single = get_json(api_url + '/decode?neurovault=4933')
+    assert single['values'] == decs[0]['values']
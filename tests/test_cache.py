@@ -0,0 +1,53 @@
+""" Test the shared response cache backend. """
+import threading
+import time
+from nsweb.initializers import settings
+from nsweb.initializers.cache import VersionedCache
+
+
+def test_versioned_cache(monkeypatch):
+    monkeypatch.setattr(settings, 'CACHE_VERSION_CHECK', 0)
+    monkeypatch.setattr(settings, 'CACHE_EARLY_REFRESH', 0)
+    cache = VersionedCache(None)
+
+    assert cache.get('a') is None
+    assert cache.set('a', {'data': [1, 2, 3]})
+    assert cache.get('a') == {'data': [1, 2, 3]}
+
+    # Large values are compressed
+    value = 'x' * 100000
+    cache.set('big', value)
+    stored = cache.store.get(cache._key('big'))
+    assert stored[:1] == b'z' and len(stored) < 10000
+    assert cache.get('big') == value
+
+    # Bumping the version invalidates everything
+    cache.bump_version()
+    assert cache.get('a') is None and cache.get('big') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 3
+
+
+def test_cache_stampede(monkeypatch):
+    monkeypatch.setattr(settings, 'CACHE_LOCK_WAIT', 5)
+    monkeypatch.setattr(settings, 'CACHE_LOCK_POLL', 0.01)
+    cache = VersionedCache(None)
+    computed = []
+
+    def request():
+        value = cache.get('key')
+        if value is None:
+            computed.append(1)
+            time.sleep(0.2)
+            value = 'value'
+            cache.set('key', value)
+        assert value == 'value'
+
+    threads = [threading.Thread(target=request) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Only the first request computed the value
+    assert len(computed) == 1
@@ -0,0 +1,57 @@
+""" Test data-version tokens and conditional GETs. """
+from os.path import join
+from flask import Flask, jsonify
+from nsweb.initializers import data_version as dv
+from nsweb.api.utils import conditional
+
+
+def test_data_version(tmpdir):
+    version = dv.DataVersion(join(str(tmpdir), 'data', 'version.json'))
+    assert version.get() is None
+    token = version.bump()
+    assert version.get()[0] == token
+    # Changes made by other processes are picked up
+    other = dv.DataVersion(version.path).bump()
+    assert other != token and version.get()[0] == other
+
+    # The build token only changes with new builds
+    assert version.build() is None
+    build = version.bump(build=True)
+    version.bump()
+    assert version.build() == build != version.get()[0]
+
+
+def test_conditional(tmpdir, monkeypatch):
+    version = dv.DataVersion(join(str(tmpdir), 'version.json'))
+    monkeypatch.setattr(dv, 'data_version', version)
+    monkeypatch.setattr('nsweb.api.utils.data_version', version)
+    calls = []
+
+    app = Flask(__name__)
+
+    @app.route('/data/')
+    @conditional
+    def data():
+        calls.append(1)
+        return jsonify(data=[1, 2, 3])
+
+    client = app.test_client()
+    # No validators until a version has been written
+    resp = client.get('/data/')
+    assert resp.status_code == 200 and 'ETag' not in resp.headers
+
+    version.bump()
+    resp = client.get('/data/?a=1')
+    etag = resp.headers['ETag']
+    assert resp.status_code == 200 and 'Last-Modified' in resp.headers
+
+    resp = client.get('/data/?a=1', headers={'If-None-Match': etag})
+    assert resp.status_code == 304 and len(calls) == 2
+    # Validators differ by URL...
+    resp = client.get('/data/?a=2', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    # ...and by data version
+    version.bump()
+    resp = client.get('/data/?a=1', headers={'If-None-Match': etag})
+    assert resp.status_code == 200 and resp.headers['ETag'] != etag
+    assert len(calls) == 4
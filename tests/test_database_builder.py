@@ -5,3 +5,62 @@
 
 #     def test_initialize_database(self):
 #         '''Clears and sets up tables in database. The tables in studies, features, and images should exist, but no data'''
+
+
+import numpy as np
+import pandas as pd
+from nsweb.initializers.database_builder import DatabaseBuilder
+from nsweb.models.studies import Study
+from nsweb.models.peaks import Peak
+from nsweb.models.frequencies import Frequency
+from nsweb.models.analyses import TermAnalysis
+
+
+class FixtureDataset(object):
+    """ The parts of a neurosynth Dataset the builder reads studies from. """
+
+    def __init__(self):
+        self.activations = pd.DataFrame({
+            'id': [1, 1, 2, 3],
+            'x': [0, 2, -4, 6], 'y': [0, 0, 8, 10], 'z': [0, 0, 0, 12],
+            'table_num': ['1', '2', '1', np.nan],
+            'doi': ['10.1/a', '10.1/a', np.nan, '10.1/c'],
+            'space': 'MNI', 'journal': 'J', 'authors': 'A',
+            'title': ['one', 'one', 'two', 'three'],
+            'year': [2001, 2001, 2002, 2003]})
+        self.features = pd.DataFrame({
+            'memory': [0.1, 0., 0.2],
+            'emotion': [0., 0.05, 0.0001]}, index=[1, 2, 3])
+
+    def get_feature_names(self):
+        return list(self.features.columns)
+
+    def get_feature_data(self, features=None):
+        return self.features[features]
+
+
+def make_builder(db):
+    # Skip loading a real Dataset
+    builder = DatabaseBuilder.__new__(DatabaseBuilder)
+    builder.db = db
+    builder.dataset = FixtureDataset()
+    return builder
+
+
+def test_add_studies_is_resumable(db):
+    builder = make_builder(db)
+    builder.add_term_analyses()
+    builder.add_studies()
+
+    def counts():
+        return (Study.query.count(), Peak.query.count(),
+                Frequency.query.count(),
+                dict((a.name, (a.n_studies, a.n_activations))
+                     for a in TermAnalysis.query))
+
+    first = counts()
+    assert first == (3, 4, 3, {'memory': (2, 3), 'emotion': (1, 1)})
+
+    # Running again adds nothing, and leaves the counts alone
+    builder.add_studies()
+    assert counts() == first
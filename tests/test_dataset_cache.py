@@ -0,0 +1,54 @@
+""" Test the memory-mapped Dataset cache. """
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from nsweb.tasks.dataset_cache import save_dataset, load_dataset, is_current
+
+
+class FakeTable(object):
+    pass
+
+
+class FakeDataset(object):
+    """ Has the attributes of a neurosynth Dataset that the cache stores. """
+
+    def __init__(self):
+        self.r = 6
+        self.activations = pd.DataFrame({
+            'id': [1, 1, 2], 'x': [0., 2., -4.], 'y': [10., 8., 6.],
+            'z': [4., 4., 0.], 'space': ['MNI', 'MNI', 'TAL'],
+            'doi': ['a', 'a', np.nan]})
+        self.image_table = FakeTable()
+        self.image_table.ids = np.array([1, 2])
+        self.image_table.data = sparse.random(50, 2, 0.3, format='csr')
+        self.feature_table = FakeTable()
+        self.feature_table.dataset = self
+        self.feature_table.data = pd.DataFrame(
+            {'emotion': [0.1, 0.], 'pain': [0., 0.02]}, index=[1, 2])
+
+
+def test_dataset_cache(tmpdir):
+    path = str(tmpdir.join('dataset'))
+    source = tmpdir.join('dataset.pkl')
+    source.write('')
+    assert not is_current(path, str(source))
+
+    dataset = FakeDataset()
+    save_dataset(dataset, path)
+    assert is_current(path, str(source))
+
+    loaded = load_dataset(path)
+    assert loaded.r == 6
+    assert list(loaded.activations.columns) == \
+        list(dataset.activations.columns)
+    assert np.allclose(loaded.activations['x'], dataset.activations['x'])
+    assert list(loaded.activations['space']) == ['MNI', 'MNI', 'TAL']
+    assert pd.isnull(loaded.activations['doi'][2])
+    assert list(loaded.image_table.ids) == [1, 2]
+    assert np.allclose(loaded.image_table.data.toarray(),
+                       dataset.image_table.data.toarray())
+    assert loaded.feature_table.dataset is loaded
+    features = loaded.feature_table.data
+    assert list(features.columns) == ['emotion', 'pain']
+    assert np.allclose(np.asarray(features.values, dtype=float),
+                       dataset.feature_table.data.values)
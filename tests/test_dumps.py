@@ -0,0 +1,64 @@
+""" Test the bulk data snapshots and their downloads. """
+import hashlib
+import json
+import numpy as np
+from scipy import sparse
+from nsweb.core import app
+from nsweb.initializers import settings
+from nsweb.initializers.database_builder import DatabaseBuilder
+from nsweb.models.studies import Study
+from nsweb.models.peaks import Peak
+from nsweb.models.frequencies import Frequency
+from nsweb.models.analyses import TermAnalysis
+
+
+def test_dumps(db, tmpdir, monkeypatch):
+    memory = TermAnalysis(name='memory')
+    emotion = TermAnalysis(name='emotion')
+    for pmid in [2, 1]:
+        study = Study(pmid=pmid, title='study %d' % pmid, year=2000 + pmid)
+        study.peaks = [Peak(x=pmid, y=0, z=0, table='1')]
+        db.session.add(study)
+    db.session.add_all([memory, emotion])
+    db.session.commit()
+    db.session.add_all([Frequency(pmid=1, analysis=memory, frequency=0.5),
+                        Frequency(pmid=2, analysis=emotion, frequency=0.25)])
+    db.session.commit()
+
+    # Skip the Dataset setup; writing dumps only needs the database
+    builder = DatabaseBuilder.__new__(DatabaseBuilder)
+    builder.db = db
+    path = str(tmpdir)
+    for i in range(3):
+        manifest = builder.write_dumps(path, keep=2)
+        if i < 2:
+            tmpdir.join(manifest['version']).move(
+                tmpdir.join('2000010%d-000000' % i))
+    assert sorted(d.basename for d in tmpdir.listdir()) == [
+        '20000101-000000', manifest['version'], 'latest.json']
+
+    out = tmpdir.join(manifest['version'])
+    for f in manifest['files']:
+        data = out.join(f['name']).read_binary()
+        assert hashlib.sha256(data).hexdigest() == f['sha256']
+        assert len(data) == f['bytes']
+
+    studies = np.load(str(out.join('studies.npz')))
+    assert list(studies['pmid']) == [1, 2]
+    assert list(studies['title']) == ['study 1', 'study 2']
+    freqs = sparse.load_npz(str(out.join('frequencies.npz')))
+    terms = np.load(str(out.join('frequencies.npz')))['terms']
+    assert list(terms) == ['emotion', 'memory']
+    assert freqs.toarray().tolist() == [[0, 0.5], [0.25, 0]]
+
+    monkeypatch.setattr(settings, 'DUMP_DIR', path)
+    client = app.test_client()
+    resp = json.loads(client.get('/api/dumps/').get_data(True))['data']
+    assert resp['version'] == manifest['version']
+    assert resp['versions'] == [manifest['version'], '20000101-000000']
+    url = '/api/dumps/%s/peaks.npz' % manifest['version']
+    resp = client.get(url, headers={'Range': 'bytes=0-9'})
+    assert resp.status_code == 206
+    assert resp.get_data() == out.join('peaks.npz').read_binary()[:10]
+    assert client.get('/api/dumps/x/peaks.npz').status_code == 404
+    assert client.get(url.replace('peaks', '..')).status_code == 404
@@ -0,0 +1,36 @@
+""" Test the streaming bulk exports. """
+import csv
+import gzip
+import io
+import json
+from nsweb.core import app
+from nsweb.models.studies import Study
+from nsweb.models.peaks import Peak
+
+
+def test_exports(db):
+    for pmid, year in [(1, 2005), (2, 2010), (3, 2015)]:
+        study = Study(pmid=pmid, title='study %d' % pmid, year=year)
+        study.peaks = [Peak(x=pmid, y=0, z=0, table='1'),
+                       Peak(x=-pmid, y=0, z=0, table='2')]
+        db.session.add(study)
+    db.session.commit()
+    client = app.test_client()
+
+    resp = client.get('/api/exports/studies.ndjson?min_year=2006')
+    studies = [json.loads(l) for l in resp.get_data(True).splitlines()]
+    assert [s['pmid'] for s in studies] == [2, 3]
+    assert studies[0]['title'] == 'study 2'
+
+    resp = client.get('/api/exports/peaks.csv?pmid=1,3&max_year=2010')
+    rows = list(csv.reader(io.StringIO(resp.get_data(True))))
+    assert rows[0] == ['pmid', 'table', 'x', 'y', 'z']
+    assert [(r[0], float(r[2])) for r in rows[1:]] == [('1', 1.), ('1', -1.)]
+
+    resp = client.get('/api/exports/peaks.ndjson',
+                      headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert len(gzip.decompress(resp.get_data()).splitlines()) == 6
+
+    assert client.get('/api/exports/peaks.xml').status_code == 404
+    assert client.get('/api/exports/peaks.csv?pmid=x').status_code == 400
@@ -0,0 +1,68 @@
+""" Test memmapped reference helpers. """
+import numpy as np
+from pytest import raises
+from nsweb.tasks.memmaps import quantize, quantization_error
+
+
+def test_quantize():
+    data = np.random.normal(size=(5000, 30)).astype('float32')
+    data = (data - data.mean(0)) / data.std(0)
+
+    q, scale = quantize(data, 'float32')
+    assert q.dtype == np.float32 and np.all(scale == 1)
+
+    for dtype, tol in [('float16', 0.001), ('int8', 0.005)]:
+        q, scale = quantize(data, dtype)
+        assert q.dtype == np.dtype(dtype)
+        assert np.allclose(q * scale, data, atol=0.05)
+        assert quantization_error(data, q, scale) < tol
+
+    with raises(ValueError):
+        quantize(data, 'int16')
+
+
+def test_reference_layouts(tmpdir, monkeypatch):
+    from nsweb.initializers import settings
+    from nsweb.tasks.memmaps import Reference
+    monkeypatch.setattr(settings, 'MEMMAP_DIR', str(tmpdir))
+
+    data = np.random.normal(size=(100, 4)).astype('float32')
+    q, scale = quantize(data, 'int8')
+    q.tofile(str(tmpdir.join('test_images.dat')))
+    np.ascontiguousarray(q.T).tofile(str(tmpdir.join('test_images_t.dat')))
+    tmpdir.join('test_labels.txt').write('a\nb\nc\nd')
+    tmpdir.join('test_stats.txt').write(
+        '\tscale\n' + '\n'.join('%s\t%f' % (l, s)
+                                for l, s in zip('abcd', scale)))
+    np.save(str(tmpdir.join('test_voxels.npy')), np.arange(100) * 2)
+
+    ref = Reference('test', 100, 4, True, dtype='int8',
+                    layouts=['voxels', 'images'])
+    assert np.allclose(ref.column(2), ref.rows(np.arange(100))[:, 2])
+    assert np.allclose(ref.column(2), data[:, 2], atol=0.05)
+    assert list(ref.find_rows([0, 3, 10])) == [0, -1, 5]
+
+
+def test_mask_index():
+    from nsweb.tasks.memmaps import MaskIndex, MNI_SHAPE, xyz_to_ijk
+
+    class FakeMasker(object):
+        """ Keeps every other voxel, in flat order. """
+        def mask(self, image):
+            return np.asarray(image).ravel()[::2]
+
+    index = MaskIndex(FakeMasker())
+    assert index.n_voxels == (np.prod(MNI_SHAPE) + 1) // 2
+    assert list(xyz_to_ijk([0, 0, 0])) == [45, 63, 36]
+
+    # Match the row found by masking a volume with a single voxel set
+    xyz = np.array([[0, 14, 42], [-12, 14, 40], [2, 0, 0], [300, 0, 0]])
+    rows = index.xyz_to_rows(xyz)
+    for (x, y, z), row in zip(xyz[:3], rows[:3]):
+        space = np.zeros(MNI_SHAPE)
+        i, j, k = xyz_to_ijk([x, y, z])
+        space[i, j, k] = 1
+        found = np.nonzero(FakeMasker().mask(space))[0]
+        assert row == (found[0] if len(found) else -1)
+    assert rows[3] == -1
+    assert index.xyz_to_rows([0, 14, 42]) == rows[0]
@@ -1,6 +1,8 @@
 """ Test model functionality. """
 from nsweb.models.studies import Study
 from nsweb.models.peaks import Peak
+from nsweb.models.decodings import Decoding, DecodingSet
+import numpy as np
 
 def test_studies(db):
     study = Study(pmid=345345, title='test study',
@@ -12,3 +14,88 @@ def test_studies(db):
     db.session.commit()
     assert Peak.query.count() == 2
     assert Study.query.count() == 1
+
+
+def test_decoding_values(db):
+    ds = DecodingSet(name='terms_20k', labels=['pain', 'reward', 'memory'])
+    dec = Decoding(uuid='abc123', decoding_set=ds)
+    dec.values = [0.1, 0.5, -0.2]
+    db.session.add(dec)
+    db.session.commit()
+    dec = Decoding.query.filter_by(uuid='abc123').first()
+    assert dec.values.dtype == np.float32
+    assert list(dec.top(2).index) == ['reward', 'pain']
+    data = Decoding.get_values(['abc123', 'missing'])
+    assert list(data.columns) == ['abc123']
+    assert np.isclose(data.loc['memory', 'abc123'], -0.2)
+
+
+def test_jobs(db):
+    from nsweb.models.jobs import Job
+    job = Job(id='f00', kind='decode', params={'uuids': ['abc123']})
+    ds = DecodingSet(name='terms_20k')
+    db.session.add(Decoding(uuid='abc123', decoding_set=ds, job=job))
+    db.session.commit()
+    job = Job.query.get('f00')
+    assert job.pending and job.params['uuids'] == ['abc123']
+    assert job.decodings[0].uuid == 'abc123'
+
+
+def test_finish_decoding(db):
+    from nsweb.core import app
+    from nsweb.models.jobs import Job
+    from nsweb.api.decode import _finish_decoding
+    # A second request for the same image joined the first one's job
+    job = Job(id='f01', kind='decode', params={
+        'uuids': ['first'], 'filenames': ['a.nii.gz']})
+    ds = DecodingSet(name='terms_20k', labels=['pain', 'reward'])
+    for uid in ['first', 'second']:
+        db.session.add(Decoding(uuid=uid, filename='a.nii.gz',
+                                decoding_set=ds, job=job))
+    db.session.commit()
+    with app.test_request_context():
+        url = _finish_decoding(job, [[0.25, -0.5]])
+    assert url.endswith('uuid=first')
+    for dec in Decoding.query.all():
+        assert dec.image_decoded_at is not None
+        assert list(dec.values) == [0.25, -0.5]
+
+
+def test_peak_index(db, tmpdir, monkeypatch):
+    from nsweb.models.peaks import peak_index, VoxelStudyIndex
+    from nsweb.initializers.data_version import DataVersion
+    from nsweb.tasks.memmaps import MNI_SHAPE, xyz_to_ijk
+    study = Study(pmid=1, title='test')
+    study.peaks = [Peak(x=0, y=14, z=42), Peak(x=0, y=14, z=42),
+                   Peak(x=2, y=12, z=40), Peak(x=20, y=20, z=20)]
+    db.session.add(Study(pmid=2, peaks=[Peak(x=0, y=10, z=42)]))
+    db.session.add(study)
+    db.session.commit()
+
+    ids, pmids, dists = peak_index.query(0, 14, 42, 6)
+    expected = Peak.closestPeaks(6, 0, 14, 42).all()
+    assert sorted(ids) == sorted(p.id for p in expected)
+    assert list(pmids) == [1, 1, 1, 2] and np.isclose(dists[-1], 4)
+
+    ids, pmids, dists = peak_index.query(0, 14, 42, 6, distinct=True)
+    assert list(pmids) == [1, 1, 2]
+
+    # Precomputed results should match the peak index
+    voxels = np.full(MNI_SHAPE, -1, dtype='int32')
+    voxels[tuple(xyz_to_ijk([0, 14, 42]))] = 0
+    VoxelStudyIndex.write(str(tmpdir), voxels, [6], peak_index)
+    index = VoxelStudyIndex(str(tmpdir))
+    # Only used once published, and until the next build
+    version = DataVersion(str(tmpdir.join('version.json')))
+    monkeypatch.setattr('nsweb.models.peaks.data_version', version)
+    build = version.bump(build=True)
+    assert index.studies(0, 14, 42, 6) is None
+    VoxelStudyIndex.stamp(str(tmpdir), build)
+    version.bump()
+    for found, expected in zip(index.studies(0, 14, 42, 6),
+                               peak_index.studies(0, 14, 42, 6)):
+        assert list(found) == list(expected)
+    assert index.studies(0, 14, 42, 8) is None
+    assert index.studies(2, 14, 42, 6) is None
+    version.bump(build=True)
+    assert index.studies(0, 14, 42, 6) is None
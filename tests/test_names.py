@@ -0,0 +1,33 @@
+""" Test the name registry used for autocompletion. """
+from nsweb.models.names import NameRegistry
+
+
+def test_name_registry():
+    registry = NameRegistry()
+    registry.load([
+        ('term', 1, 'memory', 2000),
+        ('term', 2, 'working memory', 900),
+        ('term', 3, 'memory retrieval', 300),
+        ('term', 4, 'emotion', 1500),
+        ('topic', 5, 'v5-topics-50_12', 400),
+        ('gene', 6, 'MEMO1', 0)
+    ])
+
+    def names(query, **kwargs):
+        return [m['name'] for m in registry.complete(query, **kwargs)]
+
+    # Exact matches first, then names and later words starting with the query
+    assert names('memory') == ['memory', 'memory retrieval', 'working memory']
+    assert names('mem') == ['memory', 'memory retrieval', 'MEMO1',
+                            'working memory']
+    assert names('mem', kinds=['gene']) == ['MEMO1']
+    assert names('mem', limit=2) == ['memory', 'memory retrieval']
+    assert names('topics-50')[0] == 'v5-topics-50_12'
+    # Misspellings
+    assert names('emtion') == ['emotion']
+    assert names('emtion', fuzzy=False) == []
+
+    assert registry.find('working memory', 'term') == 2
+    assert registry.find('working memory', 'topic') is None
+    assert registry.names('term') == ['emotion', 'memory', 'memory retrieval',
+                                      'working memory']
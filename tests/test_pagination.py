@@ -0,0 +1,62 @@
+""" Test server-side pagination of DataTables tables. """
+from nsweb.core import app
+from nsweb.models.studies import Study
+from nsweb.api.pagination import datatable_page, encode_cursor
+from pytest import raises
+from werkzeug.exceptions import HTTPException
+
+
+def _page(start, length=4, order=3, direction='asc', search='', cursor=''):
+    args = {'draw': 1, 'start': start, 'length': length, 'search[value]':
+            search, 'order[0][column]': order, 'order[0][dir]': direction,
+            'cursor': cursor}
+    columns = [Study.title, Study.authors, Study.journal, Study.year,
+               Study.pmid]
+    with app.test_request_context('/api/studies/dt/', query_string=args):
+        rows, result = datatable_page(
+            Study.query, columns, lambda s: Study.title.ilike('%' + s + '%'))
+    return [r.pmid for r in rows], result
+
+
+def test_datatable_page(db):
+    # Years repeat, and some are missing, so ties and NULLs must be handled
+    for pmid in range(1, 11):
+        db.session.add(Study(pmid=pmid, title='study %d' % pmid,
+                             year=None if pmid % 5 == 0 else 2000 + pmid % 3))
+    db.session.commit()
+    full, result = _page(0, length=100)
+    assert result['recordsTotal'] == result['recordsFiltered'] == 10
+    assert full == [3, 6, 9, 1, 4, 7, 2, 8, 5, 10]
+
+    # Consecutive pages seek from the end of the previous one, explicitly or
+    # through the cursor remembered by the server, and match OFFSET pages
+    pages = []
+    cursor = ''
+    for start in range(0, 12, 4):
+        pmids, result = _page(start, cursor=cursor)
+        cursor = result['next_cursor'] or ''
+        pages += pmids
+    assert pages == full
+    assert _page(4)[0] == full[4:8]
+    assert _page(8)[0] == full[8:]
+
+    desc = _page(0, length=100, direction='desc')[0]
+    assert _page(0, direction='desc')[0] + \
+        _page(4, direction='desc')[0] == desc[:8]
+
+    pmids, result = _page(0, search='study 1')
+    assert sorted(pmids) == [1, 10] and result['recordsFiltered'] == 2
+
+    # Cursors must be for the requested page, and of the sort column's type
+    deep = _page(4)[1]['next_cursor']
+    for start, cursor in [(0, deep), (8, encode_cursor([3, False, 'x', 1, 8])),
+                          (8, encode_cursor([3, False, 2001, 'x', 8])),
+                          (8, 'garbage')]:
+        with raises(HTTPException) as error:
+            _page(start, cursor=cursor)
+        assert error.value.code == 400
+
+    # and cursors sent by clients aren't remembered for other requests
+    forged = encode_cursor([3, False, 2000, 3, 4])
+    assert _page(4, cursor=forged)[0] == [6, 9, 1, 4]
+    assert _page(8)[0] == full[8:]
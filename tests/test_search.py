@@ -0,0 +1,39 @@
+""" Test the full-text search indexes. """
+from nsweb.models.studies import Study
+from nsweb.models.search import study_search
+
+
+def _search(query, extra=None):
+    return [s.pmid for s in study_search.search(Study.query, query, extra)]
+
+
+def test_study_search(db):
+    db.session.add_all([
+        Study(pmid=1, title='Working memory load', authors='Smith, J',
+              journal='NeuroImage', year=2008),
+        Study(pmid=2, title='Pain and emotion', authors='Memmert, D',
+              journal='Brain', year=2010),
+        Study(pmid=3, title='Language', authors='Jones, K',
+              journal='Journal of Memory', year=2012)
+    ])
+    db.session.commit()
+
+    # Words match as prefixes, and matches in titles rank first
+    assert _search('mem') == [1, 2, 3]
+    assert _search('work mem') == [1]
+    assert _search('memory') == [1, 3]
+    # Queries without words don't filter anything
+    assert sorted(_search('?!')) == [1, 2, 3]
+    assert Study.query.filter(study_search.matches('pain')).count() == 1
+    assert sorted(_search('brain', Study.year == 2012)) == [2, 3]
+
+    # ORM writes keep the index up to date
+    study = Study.query.get(2)
+    study.title = 'Working memory and pain'
+    db.session.delete(Study.query.get(3))
+    db.session.commit()
+    assert sorted(_search('work')) == [1, 2]
+    assert _search('language') == []
+
+    study_search.rebuild()
+    assert sorted(_search('memory')) == [1, 2]
@@ -0,0 +1,33 @@
+""" Test single-flight locking. """
+import threading
+import time
+from nsweb.api.singleflight import SingleFlight, flight_key
+
+
+def test_flight_key():
+    assert flight_key('task', 2, 4.0, z=[1, 2]) == \
+        flight_key('task', 2.0, 4, z=(1, 2))
+    assert flight_key('task', 2, 4) != flight_key('task', 4, 2)
+    assert flight_key('task', 2) != flight_key('other', 2)
+
+
+def test_local_single_flight(monkeypatch):
+    from nsweb.initializers import settings
+    monkeypatch.setattr(settings, 'SINGLE_FLIGHT_URL', None)
+    flight = SingleFlight(timeout=5, wait=5)
+    started = []
+
+    # Only the first caller should find nothing and start the task
+    def run():
+        with flight('make_coactivation_map', 0, 14, 42):
+            if not started:
+                time.sleep(0.1)
+                started.append(1)
+
+    threads = [threading.Thread(target=run) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert started == [1]
+    assert not flight._local